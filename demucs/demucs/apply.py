@@ -8,6 +8,10 @@ Code to apply a model to a mix. It will handle chunking with overlaps and
 inteprolation between chunks, as well as the "shift trick".
 """
 
+import collections
+import contextlib
+import logging
+import threading
 import typing as tp
 from .demucs import Demucs
 from .utils import center_trim, DummyPoolExecutor
@@ -20,6 +24,8 @@ from torch.nn import functional as F
 
 Model = tp.Union[Demucs]
 
+logger = logging.getLogger(__name__)
+
 
 class BagOfModels(nn.Module):
     def __init__(self, models: tp.List[Model],
@@ -65,6 +71,14 @@ class BagOfModels(nn.Module):
         raise NotImplementedError("Call `apply_model` on this.")
 
 
+def set_segment(model, segment):
+    """Override the segment length (in seconds) used when splitting, for a model
+    or all the models of a bag."""
+    models = model.models if isinstance(model, BagOfModels) else [model]
+    for sub_model in models:
+        sub_model.segment = segment
+
+
 class TensorChunk:
     def __init__(self, tensor, offset=0, length=None):
         total_length = tensor.shape[-1]
@@ -114,9 +128,168 @@ def tensor_chunk(tensor_or_chunk):
         return TensorChunk(tensor_or_chunk)
 
 
+def _run_model(model, chunks, device):
+    """Run `model` once on a list of `TensorChunk` sharing the same length.
+    Each chunk is padded to the valid length of the model, then all chunks are
+    stacked on the batch dimension so that a single forward is performed.
+    Returns a list with the output for each chunk, trimmed to its length.
+    """
+    length = chunks[0].length
+    assert all(chunk.length == length for chunk in chunks)
+    if hasattr(model, 'valid_length'):
+        valid_length = model.valid_length(length)
+    else:
+        valid_length = length
+    padded = [chunk.padded(valid_length) for chunk in chunks]
+    padded_mix = (padded[0] if len(padded) == 1 else th.cat(padded)).to(device)
+    with th.no_grad():
+        out = model(padded_mix)
+    out = center_trim(out, length)
+    return list(out.split([chunk.shape[0] for chunk in chunks]))
+
+
+def _apply_chunks(model, chunks, shifts, device, seeds=None, max_views=None):
+    """Apply `model` on a list of `TensorChunk` sharing the same length, using
+    the shift trick if `shifts` > 0. All the shifted versions of all the chunks
+    are evaluated together with a single call to `_run_model`, or by groups
+    of at most `max_views` if provided.
+    `seeds` gives for each chunk the seed of the random shifts, or None
+    to use the global random generator.
+    """
+    if not shifts:
+        return _run_model(model, chunks, device)
+    if seeds is None:
+        seeds = [None] * len(chunks)
+    length = chunks[0].length
+    max_shift = int(0.5 * model.samplerate)
+    views = []
+    offsets = []
+    for chunk, seed in zip(chunks, seeds):
+        rng = random if seed is None else random.Random(seed)
+        padded_mix = chunk.padded(length + 2 * max_shift)
+        for _ in range(shifts):
+            offset = rng.randint(0, max_shift)
+            # All the shifted views have the same length so that they can be batched.
+            views.append(TensorChunk(padded_mix, offset, length + max_shift))
+            offsets.append(offset)
+    if max_views is None:
+        max_views = len(views)
+    outs = []
+    for index in range(0, len(views), max_views):
+        outs += _run_model(model, views[index:index + max_views], device)
+    results = []
+    for index in range(len(chunks)):
+        shifted_outs = []
+        for view_out, offset in zip(outs[index * shifts:(index + 1) * shifts],
+                                    offsets[index * shifts:(index + 1) * shifts]):
+            shifted_outs.append(view_out[..., max_shift - offset:max_shift - offset + length])
+        results.append(th.stack(shifted_outs).mean(0))
+    return results
+
+
+def _chunk_context(model, segment, shifts):
+    """Return the number of samples of the mixture read by `_apply_chunks` before
+    and after a chunk of length `segment`, zero padding being only used beyond that.
+    With shifts, all the shifted views are extracted from the chunk padded with `max_shift`
+    on each side, and are then padded to their valid length within this extract.
+    Otherwise, the chunk is directly padded to its valid length. The context before
+    also covers the shorter chunks at the end of a mixture, whose padding can be larger.
+    """
+    if shifts:
+        max_shift = int(0.5 * model.samplerate)
+        return max_shift, max_shift
+    if hasattr(model, 'valid_length'):
+        valid_length = model.valid_length(segment)
+        delta = valid_length - segment
+        return (valid_length - 1) // 2, delta - delta // 2
+    return 0, 0
+
+
+def _unsplit_max_views(model, length, batch, shifts, batch_size, max_batch_samples=None):
+    """Return how many shifted views of a whole mixture of length `length` can be
+    evaluated together, so that they fit in the same budget as a batch of chunks
+    when splitting, rather than evaluating all of them at once.
+    """
+    max_shift = int(0.5 * model.samplerate)
+    if max_batch_samples is None:
+        segment = int(model.samplerate * model.segment)
+        max_batch_samples = batch_size * max(1, shifts) * batch * (segment + max_shift)
+    return max(1, max_batch_samples // (batch * (length + max_shift)))
+
+
+def _rms(mix):
+    """Root mean square of `mix` of shape `(batch, channels, time)`, maximum over the batch."""
+    return mix.float().square().mean(dim=(1, 2)).sqrt().max().item()
+
+
+def _split_plan(model, mix, overlap, transition_power, device, silence_threshold=None):
+    """Return the chunk length used to split `mix`, the offsets of the chunks to evaluate,
+    the weight of a chunk for the overlap-add and the total weight at each time step.
+    See `apply_model` for the arguments.
+    """
+    length = mix.shape[-1]
+    segment = int(model.samplerate * model.segment)
+    stride = int((1 - overlap) * segment)
+    offsets: tp.Sequence[int] = range(0, length, stride)
+    total_chunks = len(offsets)
+    if silence_threshold is not None:
+        offsets = [offset for offset in offsets
+                   if _rms(mix[..., offset:offset + segment]) >= silence_threshold]
+    # We start from a triangle shaped weight, with maximal weight in the middle
+    # of the segment. Then we normalize and take to the power `transition_power`.
+    # Large values of transition power will lead to sharper transitions.
+    weight = th.cat([th.arange(1, segment // 2 + 1, device=device),
+                     th.arange(segment - segment // 2, 0, -1, device=device)])
+    assert len(weight) == segment
+    # If the overlap < 50%, this will translate to linear transition when
+    # transition_power is 1.
+    weight = (weight / weight.max())**transition_power
+    # The total weight only depends on the offsets, so we can compute it before hand
+    # and normalize each chunk as soon as it is available.
+    sum_weight = th.zeros(length, device=device)
+    for offset in offsets:
+        sum_weight[offset:offset + segment] += weight[:length - offset]
+    if silence_threshold is None:
+        assert sum_weight.min() > 0
+    elif len(offsets) < total_chunks:
+        # Skipped chunks do not contribute to `sum_weight`, so that the weights of the
+        # evaluated chunks still sum to one next to a skipped region.
+        silent = (sum_weight == 0).sum().item() / model.samplerate
+        logger.info("Skipped %d/%d silent chunks, %.1f seconds of silent output.",
+                    total_chunks - len(offsets), total_chunks, silent)
+    return segment, offsets, weight, sum_weight
+
+
+def _group_offsets(offsets, length, segment, batch_size, max_batch_samples=None,
+                   batch=1, padded_length=None):
+    """Group consecutive chunk offsets into batches of chunks with the same length.
+    At most `batch_size` chunks are grouped together, and if `max_batch_samples`
+    is given, the total number of samples fed to the model (as given by `padded_length`
+    for a chunk length, times `batch`) will not exceed it, unless a single chunk is already larger.
+    """
+    groups: tp.List[tp.List[int]] = []
+    last_length = None
+    for offset in offsets:
+        chunk_length = min(segment, length - offset)
+        limit = batch_size
+        if max_batch_samples is not None:
+            if padded_length is not None:
+                chunk_samples = batch * padded_length(chunk_length)
+            else:
+                chunk_samples = batch * chunk_length
+            limit = min(limit, max(1, max_batch_samples // chunk_samples))
+        if groups and chunk_length == last_length and len(groups[-1]) < limit:
+            groups[-1].append(offset)
+        else:
+            groups.append([offset])
+        last_length = chunk_length
+    return groups
+
+
 def apply_model(model, mix, shifts=1, split=True,
                 overlap=0.25, transition_power=1., progress=False, device=None,
-                num_workers=0, pool=None):
+                num_workers=0, pool=None, batch_size=1, max_batch_samples=None, seed=None,
+                silence_threshold=None):
     """
     Apply model to a given mixture.
 
@@ -124,7 +297,10 @@ def apply_model(model, mix, shifts=1, split=True,
         shifts (int): if > 0, will shift in time `mix` by a random amount between 0 and 0.5 sec
             and apply the oppositve shift to the output. This is repeated `shifts` time and
             all predictions are averaged. This effectively makes the model time equivariant
-            and improves SDR by up to 0.2 points.
+            and improves SDR by up to 0.2 points. All the shifted versions of a chunk are
+            evaluated with a single forward. Without splitting, the shifted versions of the
+            whole mixture are only batched within the limit of `max_batch_samples`, which
+            defaults to the size of a batch of `batch_size` chunks.
         split (bool): if True, the input will be broken down in 8 seconds extracts
             and predictions will be performed individually on each and concatenated.
             Useful for model with large memory footprint like Tasnet.
@@ -133,6 +309,18 @@ def apply_model(model, mix, shifts=1, split=True,
             execute the computation, otherwise `mix.device` is assumed.
             When `device` is different from `mix.device`, only local computations will
             be on `device`, while the entire tracks will be stored on `mix.device`.
+        num_workers (int): number of worker threads used to evaluate chunks on CPU.
+            For a bag of models, the chunks of all the models share these workers, and
+            without splitting, the models are evaluated concurrently by as many threads.
+        batch_size (int): when splitting, number of consecutive chunks that are padded,
+            stacked on the batch dimension and evaluated with a single forward.
+        max_batch_samples (int or None): if provided, limit the size of a batch so that
+            the total number of samples given to the model stays below this value.
+        seed (int or None): if provided, seed used for the random shifts, so that
+            the output is reproducible.
+        silence_threshold (float or None): when splitting, chunks with a RMS below this value
+            are not evaluated, and only the other chunks contribute to the overlap-add.
+            Audio not covered by any evaluated chunk gets silent sources.
     """
     if device is None:
         device = mix.device
@@ -151,85 +339,324 @@ def apply_model(model, mix, shifts=1, split=True,
         'progress': progress,
         'device': device,
         'pool': pool,
+        'batch_size': batch_size,
+        'max_batch_samples': max_batch_samples,
+        'silence_threshold': silence_threshold,
     }
+    assert transition_power >= 1, "transition_power < 1 leads to weird behavior."
+    batch, channels, length = mix.shape
+    estimates = th.zeros(batch, len(model.sources), channels, length, device=mix.device)
     if isinstance(model, BagOfModels):
         # Special treatment for bag of model.
-        # We explicitely apply multiple times `apply_model` so that the random shifts
-        # are different for each model.
-        estimates = 0
-        totals = [0] * len(model.sources)
-        for sub_model, weight in zip(model.models, model.weights):
-            original_model_device = next(iter(sub_model.parameters())).device
-            sub_model.to(device)
-
-            out = apply_model(sub_model, mix, **kwargs)
-            sub_model.to(original_model_device)
-            for k, inst_weight in enumerate(weight):
-                out[:, k, :, :] *= inst_weight
-                totals[k] += inst_weight
-            estimates += out
-            del out
-
-        for k in range(estimates.shape[1]):
-            estimates[:, k, :, :] /= totals[k]
+        # The models are kept on `device`. Each model adds its weighted estimate directly
+        # to `estimates`, with a different seed so that the random shifts are different
+        # for each model. When splitting, the chunks of the models already run on `pool`,
+        # so the models are only evaluated concurrently without splitting, by at most
+        # `num_workers` threads.
+        model.to(device)
+        if not split and num_workers > 0 and device.type == 'cpu':
+            bag_pool = ThreadPoolExecutor(min(num_workers, len(model.models)))
+        else:
+            bag_pool = DummyPoolExecutor()
+        rng = None if seed is None else random.Random(seed)
+        totals = [sum(weight[k] for weight in model.weights) for k in range(len(model.sources))]
+        lock = threading.Lock()
+        futures = []
+        with bag_pool:
+            for sub_model, weight in zip(model.models, model.weights):
+                # A source with a total weight of 0 is left silent.
+                source_weight = th.tensor([w / total if total else 0.
+                                           for w, total in zip(weight, totals)],
+                                          device=mix.device)
+                sub_seed = None if rng is None else rng.randrange(2**32)
+                futures.append(bag_pool.submit(
+                    _accumulate, sub_model, mix, estimates, source_weight, lock,
+                    seed=sub_seed, **kwargs))
+            for future in futures:
+                future.result()
         return estimates
 
+    _accumulate(model, mix, estimates, seed=seed, **kwargs)
+    return estimates
+
+
+def _accumulate(model, mix, estimates, source_weight=None, lock=None, shifts=1, split=True,
+                overlap=0.25, transition_power=1., progress=False, device=None,
+                pool=None, batch_size=1, max_batch_samples=None, seed=None,
+                silence_threshold=None):
+    """Apply a single `model` to `mix` and add its output to `estimates`, scaled per
+    source by `source_weight` if provided. If `lock` is given, it is held when
+    updating `estimates`, which can then be shared by concurrent calls.
+    See `apply_model` for the other arguments.
+    """
     model.to(device)
-    assert transition_power >= 1, "transition_power < 1 leads to weird behavior."
+    if lock is None:
+        lock = contextlib.nullcontext()
+    if source_weight is not None:
+        source_weight = source_weight[:, None, None]
     batch, channels, length = mix.shape
     if split:
-        kwargs['split'] = False
-        out = th.zeros(batch, len(model.sources), channels, length, device=mix.device)
-        sum_weight = th.zeros(length, device=mix.device)
-        segment = int(model.samplerate * model.segment)
-        stride = int((1 - overlap) * segment)
-        offsets = range(0, length, stride)
-        scale = stride / model.samplerate
-        # We start from a triangle shaped weight, with maximal weight in the middle
-        # of the segment. Then we normalize and take to the power `transition_power`.
-        # Large values of transition power will lead to sharper transitions.
-        weight = th.cat([th.arange(1, segment // 2 + 1, device=device),
-                         th.arange(segment - segment // 2, 0, -1, device=device)])
-        assert len(weight) == segment
-        # If the overlap < 50%, this will translate to linear transition when
-        # transition_power is 1.
-        weight = (weight / weight.max())**transition_power
+        segment, offsets, weight, sum_weight = _split_plan(
+            model, mix, overlap, transition_power, device, silence_threshold)
+        scale = int((1 - overlap) * segment) / model.samplerate
+        max_shift = int(0.5 * model.samplerate) if shifts else 0
+
+        def padded_length(chunk_length):
+            if hasattr(model, 'valid_length'):
+                return model.valid_length(chunk_length + max_shift)
+            return chunk_length + max_shift
+
+        groups = _group_offsets(offsets, length, segment, batch_size, max_batch_samples,
+                                batch * max(1, shifts), padded_length)
+        rng = None if seed is None else random.Random(seed)
         futures = []
-        for offset in offsets:
-            chunk = TensorChunk(mix, offset, segment)
-            future = pool.submit(apply_model, model, chunk, **kwargs)
-            futures.append((future, offset))
-            offset += segment
+        for group in groups:
+            chunks = [TensorChunk(mix, offset, segment) for offset in group]
+            # Seeds are drawn here so that they do not depend on the order of execution.
+            seeds = None if rng is None else [rng.randrange(2**32) for _ in group]
+            future = pool.submit(_apply_chunks, model, chunks, shifts, device, seeds)
+            futures.append((future, group))
         if progress:
-            futures = tqdm.tqdm(futures, unit_scale=scale, ncols=120, unit='seconds')
-        for future, offset in futures:
-            chunk_out = future.result()
-            chunk_length = chunk_out.shape[-1]
-            out[..., offset:offset + segment] += (weight[:chunk_length] * chunk_out).to(mix.device)
-            sum_weight[offset:offset + segment] += weight[:chunk_length].to(mix.device)
-        assert sum_weight.min() > 0
-        out /= sum_weight
-        return out
-    elif shifts:
-        kwargs['shifts'] = 0
-        max_shift = int(0.5 * model.samplerate)
-        mix = tensor_chunk(mix)
-        padded_mix = mix.padded(length + 2 * max_shift)
-        out = 0
-        for _ in range(shifts):
-            offset = random.randint(0, max_shift)
-            shifted = TensorChunk(padded_mix, offset, length + max_shift - offset)
-            shifted_out = apply_model(model, shifted, **kwargs)
-            out += shifted_out[..., max_shift - offset:]
-        out /= shifts
-        return out
+            futures = tqdm.tqdm(futures, unit_scale=scale * len(offsets) / max(1, len(groups)),
+                                ncols=120, unit='seconds')
+        for future, group in futures:
+            chunk_outs = future.result()
+            for offset, chunk_out in zip(group, chunk_outs):
+                chunk_length = chunk_out.shape[-1]
+                chunk_weight = weight[:chunk_length] / sum_weight[offset:offset + chunk_length]
+                chunk_out = (chunk_weight * chunk_out).to(estimates.device)
+                if source_weight is not None:
+                    chunk_out *= source_weight
+                with lock:
+                    estimates[..., offset:offset + chunk_length] += chunk_out
     else:
-        if hasattr(model, 'valid_length'):
-            valid_length = model.valid_length(length)
+        max_views = _unsplit_max_views(model, length, batch, shifts, batch_size,
+                                       max_batch_samples)
+        out = _apply_chunks(model, [tensor_chunk(mix)], shifts, device, [seed], max_views)[0]
+        out = out.to(estimates.device)
+        if source_weight is not None:
+            out *= source_weight
+        with lock:
+            estimates += out
+
+
+def apply_model_many(model, mixes, shifts=1, split=True, overlap=0.25, transition_power=1.,
+                     progress=False, device=None, num_workers=0, pool=None, batch_size=8,
+                     seed=None, silence_threshold=None):
+    """
+    Apply a model to several mixtures, evaluating chunks from different mixtures in the same
+    batches, so that short mixtures still fill the batches.
+
+    Args:
+        mixes (iterable of (key, torch.Tensor)): mixtures of shape `(batch, channels, time)`,
+            along with any key identifying them. Mixtures are only pulled from the iterable
+            when more chunks are needed to fill a batch.
+        batch_size (int): number of chunks evaluated with a single forward.
+        shifts, split, overlap, transition_power, progress, device, num_workers, pool,
+        seed, silence_threshold: see `apply_model`. The seed is used for every mixture,
+        so that the output for a mixture matches that of `apply_model`.
+
+    Yields `(key, estimates)` for each mixture as soon as all its chunks are evaluated.
+    Chunks are evaluated in order, so mixtures complete roughly in the order they are given.
+    Bags of models are applied to one mixture at a time.
+    """
+    assert transition_power >= 1, "transition_power < 1 leads to weird behavior."
+    if isinstance(model, BagOfModels):
+        for key, mix in mixes:
+            yield key, apply_model(model, mix, shifts=shifts, split=split, overlap=overlap,
+                                   transition_power=transition_power, progress=progress,
+                                   device=device, num_workers=num_workers, pool=pool,
+                                   batch_size=batch_size, seed=seed,
+                                   silence_threshold=silence_threshold)
+        return
+    if device is not None:
+        device = th.device(device)
+    own_pool = None
+    if pool is None:
+        if num_workers > 0 and (device is None or device.type == 'cpu'):
+            pool = own_pool = ThreadPoolExecutor(num_workers)
         else:
-            valid_length = length
-        mix = tensor_chunk(mix)
-        padded_mix = mix.padded(valid_length).to(device)
-        with th.no_grad():
-            out = model(padded_mix)
-        return center_trim(out, length)
+            pool = DummyPoolExecutor()
+    # Number of batches being evaluated at any time.
+    max_running = max(1, num_workers)
+    segment = int(model.samplerate * model.segment)
+
+    mixes = iter(mixes)
+    exhausted = False
+    # Pending chunks in order, as (track, offset, length, seed), and how many of them
+    # have the full length, and can thus be batched with chunks from other mixtures.
+    pending: tp.List[tp.Tuple[dict, int, int, tp.Optional[int]]] = []
+    full_chunks = 0
+    running: tp.Deque[tp.Tuple[tp.Any, list]] = collections.deque()
+    bar = tqdm.tqdm(ncols=120, unit='seconds', unit_scale=True) if progress else None
+    try:
+        while True:
+            # Pull new mixtures until there are enough chunks of the full length for a batch.
+            while not exhausted and full_chunks < batch_size:
+                try:
+                    key, mix = next(mixes)
+                except StopIteration:
+                    exhausted = True
+                    break
+                track_device = mix.device if device is None else device
+                length = mix.shape[-1]
+                estimates = th.zeros(mix.shape[0], len(model.sources), mix.shape[1], length,
+                                     device=mix.device)
+                if split:
+                    _, offsets, weight, sum_weight = _split_plan(
+                        model, mix, overlap, transition_power, track_device, silence_threshold)
+                else:
+                    offsets = [0]
+                    weight = sum_weight = th.ones(length, device=track_device)
+                if not offsets:
+                    yield key, estimates
+                    continue
+                track = {'key': key, 'mix': mix, 'estimates': estimates, 'weight': weight,
+                         'sum_weight': sum_weight, 'device': track_device,
+                         'remaining': len(offsets)}
+                rng = None if seed is None else random.Random(seed)
+                for offset in offsets:
+                    chunk_seed = None if rng is None else rng.randrange(2**32)
+                    chunk_length = min(segment, length - offset) if split else length
+                    pending.append((track, offset, chunk_length, chunk_seed))
+                    if not split or chunk_length == segment:
+                        full_chunks += 1
+
+            if pending and len(running) < max_running:
+                # Batch the first pending chunk with the next ones sharing its length and device.
+                first_track, _, first_length, _ = pending[0]
+                batch = [chunk for chunk in pending
+                         if chunk[2] == first_length and chunk[0]['device'] == first_track['device']]
+                batch = batch[:batch_size]
+                for chunk in batch:
+                    pending.remove(chunk)
+                    if not split or chunk[2] == segment:
+                        full_chunks -= 1
+                chunks = [TensorChunk(track['mix'], offset, length)
+                          for track, offset, length, _ in batch]
+                seeds = [chunk_seed for _, _, _, chunk_seed in batch]
+                max_views = None
+                if not split:
+                    max_views = _unsplit_max_views(model, first_length,
+                                                   first_track['mix'].shape[0], shifts, batch_size)
+                model.to(first_track['device'])
+                future = pool.submit(_apply_chunks, model, chunks, shifts,
+                                     first_track['device'], seeds, max_views)
+                running.append((future, batch))
+                continue
+            if not running:
+                break
+
+            future, batch = running.popleft()
+            for (track, offset, length, _), chunk_out in zip(batch, future.result()):
+                weight = track['weight'][:length] / track['sum_weight'][offset:offset + length]
+                chunk_out = (weight * chunk_out).to(track['estimates'].device)
+                track['estimates'][..., offset:offset + length] += chunk_out
+                track['remaining'] -= 1
+                if bar is not None:
+                    bar.update(length / model.samplerate)
+                if track['remaining'] == 0:
+                    yield track['key'], track['estimates']
+    finally:
+        if bar is not None:
+            bar.close()
+        if own_pool is not None:
+            own_pool.shutdown()
+
+
+def apply_model_stream(model, blocks, shifts=1, overlap=0.25, transition_power=1.,
+                       device=None, seed=None, silence_threshold=None):
+    """
+    Streaming version of `apply_model` with `split=True`, for arbitrarily long inputs.
+
+    Args:
+        blocks (iterable of torch.Tensor): successive extracts of the mixture, each of shape
+            `(batch, channels, time)`. Blocks can have any length.
+        shifts, overlap, transition_power, device, seed, silence_threshold: see `apply_model`.
+
+    Yields tensors of shape `(batch, sources, channels, time)`, which concatenated along
+    the last dimension give the same result as `apply_model` for a single model.
+    A block is yielded as soon as no future chunk can contribute to it, and the overlap-add
+    is performed in a buffer of the size of one segment, so that memory usage does not
+    depend on the mixture length.
+    For a bag of models, the shortest segment of all the models is used for every model.
+    """
+    assert transition_power >= 1, "transition_power < 1 leads to weird behavior."
+    models = model.models if isinstance(model, BagOfModels) else [model]
+    segment = int(model.samplerate * min(sub_model.segment for sub_model in models))
+    stride = int((1 - overlap) * segment)
+    # Amount of audio read before and after a chunk, which must be available before
+    # it can be processed, and kept as context for the next chunk.
+    context, lookahead = 0, 0
+    for sub_model in models:
+        left, right = _chunk_context(sub_model, segment, shifts)
+        context = max(context, left)
+        lookahead = max(lookahead, right)
+    kwargs = {
+        'shifts': shifts,
+        'split': False,
+        'overlap': overlap,
+        'transition_power': transition_power,
+        'device': device,
+    }
+    rng = None if seed is None else random.Random(seed)
+
+    blocks = iter(blocks)
+    buffer = None  # holds the mixture from `buffer_start` onward.
+    buffer_start = 0
+    ended = False
+    offset = 0
+    out = None
+    sum_weight = None
+    weight = None
+    while True:
+        buffer_end = buffer_start + (0 if buffer is None else buffer.shape[-1])
+        while not ended and buffer_end < offset + segment + lookahead:
+            try:
+                block = next(blocks)
+            except StopIteration:
+                ended = True
+                break
+            buffer = block if buffer is None else th.cat([buffer, block], dim=-1)
+            buffer_end += block.shape[-1]
+        if ended and offset >= buffer_end:
+            break
+        if out is None:
+            batch, channels, _ = buffer.shape
+            out = th.zeros(batch, len(model.sources), channels, segment, device=buffer.device)
+            sum_weight = th.zeros(segment, device=buffer.device)
+            # Same triangle shaped weight as `apply_model`.
+            weight = th.cat([th.arange(1, segment // 2 + 1, device=buffer.device),
+                             th.arange(segment - segment // 2, 0, -1, device=buffer.device)])
+            weight = (weight / weight.max())**transition_power
+
+        chunk = TensorChunk(buffer, offset - buffer_start, segment)
+        start = offset - buffer_start
+        if silence_threshold is None or \
+                _rms(buffer[..., start:start + segment]) >= silence_threshold:
+            # As with `apply_model`, seeds are only drawn for the evaluated chunks.
+            chunk_seed = None if rng is None else rng.randrange(2**32)
+            chunk_out = apply_model(model, chunk, seed=chunk_seed, **kwargs)
+            chunk_length = chunk_out.shape[-1]
+            out[..., :chunk_length] += weight[:chunk_length] * chunk_out.to(out.device)
+            sum_weight[:chunk_length] += weight[:chunk_length]
+
+        # Everything before the next offset is final. Where only skipped chunks contributed,
+        # both `out` and `sum_weight` are zero, and so is the output.
+        norm = sum_weight.clamp(min=th.finfo(sum_weight.dtype).tiny)
+        next_offset = offset + stride
+        if ended and next_offset >= buffer_end:
+            yield out[..., :buffer_end - offset] / norm[:buffer_end - offset]
+            break
+        yield out[..., :stride] / norm[:stride]
+        out = out.roll(-stride, dims=-1)
+        out[..., -stride:] = 0
+        sum_weight = sum_weight.roll(-stride, dims=-1)
+        sum_weight[-stride:] = 0
+
+        # Only keep the input that can still be used as context by a future chunk.
+        drop = max(0, next_offset - context - buffer_start)
+        if drop:
+            buffer = buffer[..., drop:].clone()
+            buffer_start += drop
+        offset = next_offset
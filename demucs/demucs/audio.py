@@ -6,10 +6,13 @@
 
 import subprocess as sp
 import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+import os
 import numpy as np
 import torch
 import torchaudio as ta
-from .utils import temp_filenames
+from .cache import cached_metadata
 from pathlib import Path
 import julius
 import lameenc
@@ -43,7 +46,7 @@ class AudioFile:
     @property
     def info(self):
         if self._info is None:
-            self._info = _read_info(self.path)
+            self._info = cached_metadata(self.path, "ffprobe", lambda: _read_info(self.path))
         return self._info
 
     @property
@@ -66,6 +69,21 @@ class AudioFile:
     def samplerate(self, stream=0):
         return int(self.info['streams'][self._audio_streams[stream]]['sample_rate'])
 
+    def _command(self, stream, seek_time=None, duration=None, samplerate=None):
+        command = ['ffmpeg', '-loglevel', 'panic']  # panic = Only show fatal errors.
+        if seek_time:
+            command += ['-ss', str(seek_time)]
+        command += ['-i', str(self.path)]
+        command += ['-map', f'0:{self._audio_streams[stream]}']  # One stream per pipe.
+        if duration is not None:
+            command += ['-t', str(duration)]  # -t = limit the duration of data read.
+        command += ['-threads', '1']
+        command += ['-f', 'f32le']  # f32le = 32-bit floating-point little-endian, interleaved.
+        if samplerate is not None:
+            command += ['-ar', str(samplerate)]
+        command += ['pipe:1']
+        return command
+
     def read(self,
              seek_time=None,
              duration=None,
@@ -73,6 +91,12 @@ class AudioFile:
              samplerate=None,
              channels=None,
              temp_folder=None):
+        """Decode the given `streams` with ffmpeg, returning a tensor of shape
+        `(streams, channels, time)`, or `(channels, time)` if `streams` is an int.
+        Each stream is decoded by its own ffmpeg process, straight from its stdout into a
+        preallocated channel-first buffer, without going through the disk.
+        `temp_folder` is ignored and kept for backward compatibility.
+        """
         streams = np.array(range(len(self)))[streams]
         single = not isinstance(streams, np.ndarray)
         if single:
@@ -81,44 +105,119 @@ class AudioFile:
         if duration is None:
             target_size = None
             query_duration = None
+            # Estimate from the container, the buffer is grown if it is too short.
+            try:
+                estimate = self.duration - (seek_time or 0.) + 1.
+            except KeyError:
+                estimate = 60.
+            size = max(1, int((samplerate or self.samplerate()) * estimate))
         else:
             target_size = int((samplerate or self.samplerate()) * duration)
             query_duration = float((target_size + 1) / (samplerate or self.samplerate()))
+            size = target_size
 
-        with temp_filenames(len(streams)) as filenames:
-            command = ['ffmpeg', '-y']  # -y = Overwrite output files without asking.
-            command += ['-loglevel', 'panic']  # -loglevel = Set logging level and flags used by the library
-                                               # panic =  Only show fatal errors which could lead the process to crash
-            if seek_time:
-                command += ['-ss', str(seek_time)]  # -start_at_zero = shift input timestamps so they start at zero
-            command += ['-i', str(self.path)]  # -i = input file url
-            for stream, filename in zip(streams, filenames):
-                command += ['-map', f'0:{self._audio_streams[stream]}']  # -map = Create one or more streams in the output file.
-                if query_duration is not None:
-                    command += ['-t', str(query_duration)]  # -t = limit the duration of data read from the input file
-                command += ['-threads', '1']
-                command += ['-f', 'f32le']  # -f = Force input or output file format
-                                            # f32le = 32-bit floating-point little-endian
-                if samplerate is not None:
-                    command += ['-ar', str(samplerate)]
-                command += [filename]
-
-            sp.run(command, check=True)
-            wavs = []
-            for filename in filenames:
-                wav = np.fromfile(filename, dtype=np.float32)
-                wav = torch.from_numpy(wav)
-                wav = wav.view(-1, self.channels()).t()
-                if channels is not None:
-                    wav = convert_audio_channels(wav, channels)
-                if target_size is not None:
-                    wav = wav[..., :target_size]
-                wavs.append(wav)
-        wav = torch.stack(wavs, dim=0)
+        wav = torch.empty(len(streams), self.channels(streams[0]), size)
+        length = size
+        with ExitStack() as stack:
+            # All the processes are started first so that they decode in parallel.
+            pipes = [stack.enter_context(_ffmpeg_pipe(self._command(
+                stream, seek_time, query_duration, samplerate))) for stream in streams]
+            for index, pipe in enumerate(pipes):
+                offset = _read_into(pipe, wav[index])
+                while target_size is None and offset == wav.shape[-1]:
+                    wav = torch.cat([wav, torch.empty_like(wav)], dim=-1)
+                    offset += _read_into(pipe, wav[index, :, offset:])
+                length = min(length, offset) if index else offset
+        wav = wav[..., :length]
+        if channels is not None:
+            wav = convert_audio_channels(wav, channels)
         if single:
             wav = wav[0]
         return wav
 
+    def stream(self, duration, stream=0, samplerate=None, channels=None):
+        """Iterate over the given audio `stream` in successive blocks of `duration`
+        seconds, each of shape `(channels, time)`. The last block can be shorter.
+        Contrary to :method:`read`, the entire file is never held in memory, and
+        a single ffmpeg process is used, the blocks being read one by one from its stdout.
+        """
+        block_size = int((samplerate or self.samplerate(stream)) * duration)
+        src_channels = self.channels(stream)
+        with _ffmpeg_pipe(self._command(stream, samplerate=samplerate)) as pipe:
+            while True:
+                wav = torch.empty(src_channels, block_size)
+                length = _read_into(pipe, wav)
+                if length:
+                    wav = wav[..., :length]
+                    if channels is not None:
+                        wav = convert_audio_channels(wav, channels)
+                    yield wav
+                if length < block_size:
+                    break
+
+    def normalization(self, stream=0, samplerate=None, channels=None, block_duration=30.):
+        """Return the mean and standard deviation of the mono mix of the given `stream`,
+        used to normalize the input of the models. The stream is decoded block by block,
+        and the result is kept in the metadata cache."""
+        def _compute():
+            total, total_sq, count = 0., 0., 0
+            for block in self.stream(block_duration, stream, samplerate, channels):
+                mono = block.mean(0).double()
+                total += mono.sum().item()
+                total_sq += mono.square().sum().item()
+                count += mono.numel()
+            mean = total / max(count, 1)
+            std = max((total_sq - count * mean**2) / max(count - 1, 1), 0) ** 0.5
+            return [mean, std]
+        kind = f"stats:{stream}:{samplerate}:{channels}"
+        mean, std = cached_metadata(self.path, kind, _compute)
+        return mean, std
+
+
+@contextmanager
+def _ffmpeg_pipe(command):
+    """Run the ffmpeg `command` writing to its stdout, and return the pipe.
+    Raises `subprocess.CalledProcessError` if ffmpeg fails."""
+    process = sp.Popen(command, stdin=sp.DEVNULL, stdout=sp.PIPE)
+    try:
+        yield process.stdout
+        # Drain what was not read, so that ffmpeg does not fail on a broken pipe.
+        process.stdout.read()
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode:
+        raise sp.CalledProcessError(returncode, command)
+
+
+def _read_into(pipe, out, block_size=2**16):
+    """Read interleaved float32 samples from `pipe` into the channel-first tensor `out`
+    of shape `(channels, time)`, going through a staging buffer of `block_size` samples.
+    Returns the number of samples read, which is less than `time` only at the end
+    of the stream."""
+    channels, length = out.shape
+    staging = np.empty((min(block_size, length), channels), dtype=np.float32)
+    view = memoryview(staging).cast('B')
+    frame = 4 * channels
+    offset = 0
+    while offset < length:
+        count = min(len(staging), length - offset)
+        size = 0
+        while size < count * frame:
+            read = pipe.readinto(view[size:count * frame])
+            if not read:
+                break
+            size += read
+        samples = size // frame
+        out[:, offset:offset + samples] = torch.from_numpy(staging[:samples]).t()
+        offset += samples
+        if samples < count:
+            break
+    return offset
+
 
 def convert_audio_channels(mp3, channels=2):
     """Convert audio to the given number of channels."""
@@ -153,17 +252,27 @@ def i16_pcm(wav):
     else:
         return wav
 
-def encode_mp3(wav, path, samplerate=44100, bitrate=320, verbose=False):
-    """Save given audio as mp3. This should work on all OSes."""
-    C, T = wav.shape
-    wav = i16_pcm(wav)
+# LAME quality of the mp3 encoder for each preset, 2 is the highest and 7 the fastest.
+MP3_PRESETS = {'best': 2, 'standard': 5, 'fast': 7}
+
+
+def _mp3_encoder(samplerate, channels, bitrate, verbose=False, preset='best'):
     encoder = lameenc.Encoder()
     encoder.set_bit_rate(bitrate)
     encoder.set_in_sample_rate(samplerate)
-    encoder.set_channels(C)
-    encoder.set_quality(2)  # 2-highest, 7-fastest
+    encoder.set_channels(channels)
+    encoder.set_quality(MP3_PRESETS[preset])
     if not verbose:
         encoder.silence()
+    return encoder
+
+
+def encode_mp3(wav, path, samplerate=44100, bitrate=320, verbose=False, preset='best'):
+    """Save given audio as mp3. This should work on all OSes.
+    `preset` is one of `MP3_PRESETS`, trading quality for encoding speed."""
+    C, T = wav.shape
+    wav = i16_pcm(wav)
+    encoder = _mp3_encoder(samplerate, C, bitrate, verbose, preset)
     wav = wav.data.cpu()
     wav = wav.transpose(0, 1).numpy()
     mp3_data = encoder.encode(wav.tobytes())
@@ -172,6 +281,33 @@ def encode_mp3(wav, path, samplerate=44100, bitrate=320, verbose=False):
         f.write(mp3_data)
 
 
+class MP3Writer:
+    """
+    Incrementally encode audio given block by block as mp3, e.g. the output
+    of `demucs.apply.apply_model_stream`. As the entire signal is never known,
+    clipping is always prevented by clamping.
+    """
+    def __init__(self, path, samplerate=44100, channels=2, bitrate=320, verbose=False,
+                 preset='best'):
+        self.encoder = _mp3_encoder(samplerate, channels, bitrate, verbose, preset)
+        self.file = open(path, "wb")
+
+    def write(self, wav):
+        wav = i16_pcm(prevent_clip(wav, mode='clamp'))
+        wav = wav.data.cpu().transpose(0, 1).numpy()
+        self.file.write(self.encoder.encode(wav.tobytes()))
+
+    def close(self):
+        self.file.write(self.encoder.flush())
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
 def prevent_clip(wav, mode='rescale'):
     """
     different strategies for avoiding raw clipping.
@@ -195,15 +331,81 @@ def convert_audio(mp3, from_samplerate, to_samplerate, channels):
 
 
 def save_audio(wav, path, samplerate, bitrate=320, clip='rescale',
-               bits_per_sample=16, as_float=False):
+               bits_per_sample=16, as_float=False, preset='best'):
     """Save audio file, automatically preventing clipping if necessary
     based on the given `clip` strategy. If the path ends in `.mp3`, this
-    will save as mp3 with the given `bitrate`.
+    will save as mp3 with the given `bitrate` and `preset`. If it ends in `.wav`
+    or `.flac`, the samples are stored with `bits_per_sample` bits, or as float32
+    if `as_float` is True (wav only).
     """
     wav = prevent_clip(wav, mode=clip)
     path = Path(path)
     suffix = path.suffix.lower()
     if suffix == ".mp3":
-        encode_mp3(wav, path, samplerate, bitrate)
+        encode_mp3(wav, path, samplerate, bitrate, preset=preset)
+    elif suffix == ".wav":
+        if as_float:
+            bits_per_sample = 32
+            encoding = 'PCM_F'
+        else:
+            encoding = 'PCM_S'
+        ta.save(str(path), wav.cpu(), sample_rate=samplerate,
+                encoding=encoding, bits_per_sample=bits_per_sample)
+    elif suffix == ".flac":
+        if as_float:
+            raise ValueError("Flac does not support float samples.")
+        ta.save(str(path), wav.cpu(), sample_rate=samplerate, bits_per_sample=bits_per_sample)
     else:
         raise ValueError(f"Invalid suffix for path: {suffix}")
+
+
+class StemWriter:
+    """
+    Encode and save stems concurrently in a pool of threads, so that all the stems
+    of a track are encoded in parallel, and while the next track is being separated.
+    Encoding is done by native code releasing the GIL, so threads avoid copying
+    the stems to other processes.
+
+    Args:
+        workers (int or None): number of encoding threads, defaults to the number of cpus.
+        max_pending (int or None): maximum number of stems waiting to be saved,
+            `save` blocks when it is reached. Defaults to twice the number of workers.
+        **kwargs: passed to `save_audio` for every stem, e.g. `bitrate` or `preset`.
+
+    Example:
+
+        with StemWriter(samplerate=44100, preset='fast') as writer:
+            for source, path in zip(sources, paths):
+                writer.save(source, path)
+    """
+    def __init__(self, workers=None, max_pending=None, **kwargs):
+        workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(workers)
+        self.max_pending = max_pending or 2 * workers
+        self.kwargs = kwargs
+        self._pending = []
+
+    def save(self, wav, path, **kwargs):
+        """Schedule the saving of `wav` to `path`, see `save_audio`. Errors from
+        previous stems are raised here or in `wait`."""
+        while len(self._pending) >= self.max_pending:
+            self._pending.pop(0).result()
+        kwargs = dict(self.kwargs, **kwargs)
+        self._pending.append(self.pool.submit(save_audio, wav, path, **kwargs))
+
+    def wait(self):
+        """Wait for all the stems to be saved."""
+        while self._pending:
+            self._pending.pop(0).result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
@@ -0,0 +1,165 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Find the fastest settings of `apply_model` for a given model on the current host.
+
+A grid of `segment`, `num_workers`, `batch_size` and `torch.set_num_threads` values
+is benchmarked on synthetic audio. The overlap is only tuned when candidate values are
+given with `--overlaps`, as a smaller overlap is always faster but lowers the quality.
+Each trial runs in a fresh process so that its peak memory usage can be measured.
+The best configuration is stored as a profile for the (host, model signature) pair,
+which is then loaded automatically by `separateTracks.py` and the GUI.
+
+    python -m demucs.autotune -n MODEL_SIGNATURE --repo ./release_models
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+from pathlib import Path
+import resource
+import socket
+import time
+import typing as tp
+
+import torch
+
+PROFILES = Path.home() / ".cache" / "demucs" / "autotune.json"
+SETTINGS = ["segment", "overlap", "jobs", "threads", "batch_size"]
+
+
+def _host():
+    return socket.gethostname()
+
+
+def load_profile(model_signature: str, path: Path = PROFILES) -> tp.Optional[dict]:
+    """Return the best settings found by the autotuner for this host and model,
+    as a dict with keys from `SETTINGS` (without `overlap` if it was not tuned),
+    or None if the model was never tuned on this host."""
+    try:
+        profiles = json.loads(Path(path).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    profile = profiles.get(_host(), {}).get(model_signature)
+    if profile is None:
+        return None
+    return {key: profile[key] for key in SETTINGS if key in profile}
+
+
+def save_profile(model_signature: str, profile: dict, path: Path = PROFILES):
+    path = Path(path)
+    try:
+        profiles = json.loads(path.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        profiles = {}
+    profiles.setdefault(_host(), {})[model_signature] = profile
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.parent / (path.name + ".tmp")
+    tmp.write_text(json.dumps(profiles, indent=2))
+    os.replace(tmp, path)
+
+
+def _trial(queue, name, repo, config, duration, shifts):
+    from .apply import apply_model, set_segment
+    from .pretrained import get_model
+
+    torch.set_num_threads(config["threads"])
+    model = get_model(name=name, repo=repo)
+    model.eval()
+    if config["segment"] is not None:
+        set_segment(model, config["segment"])
+    kwargs = {
+        'shifts': shifts,
+        'overlap': config["overlap"],
+        'num_workers': config["jobs"],
+        'batch_size': config["batch_size"],
+        'seed': 0,
+    }
+    generator = torch.Generator().manual_seed(1234)
+    mix = torch.randn(1, model.audio_channels, int(duration * model.samplerate),
+                      generator=generator)
+    # Warm up on a short extract, so that one time initializations are not counted.
+    apply_model(model, mix[..., :model.samplerate], **kwargs)
+    begin = time.time()
+    apply_model(model, mix, **kwargs)
+    elapsed = time.time() - begin
+    # ru_maxrss is given in kilobytes on Linux.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    queue.put({"rtf": elapsed / duration, "rss": rss})
+
+
+def benchmark(name, repo, config, duration=30., shifts=1):
+    """Run a single trial in a new process, and return the real time factor
+    (separation time over audio duration) and the peak RSS in MB."""
+    context = mp.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_trial, args=(queue, name, repo, config, duration, shifts))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        return None
+    return queue.get()
+
+
+def main():
+    from .pretrained import add_model_flags, get_model_signature
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser("demucs.autotune",
+                                     description="Find the fastest separation settings "
+                                                 "for a model on this host.")
+    add_model_flags(parser)
+    parser.add_argument("--duration", type=float, default=30.,
+                        help="Duration in seconds of the synthetic audio used for each trial.")
+    parser.add_argument("--shifts", type=int, default=1,
+                        help="Number of random shifts used for the benchmark.")
+    parser.add_argument("--segments", type=float, nargs='*', default=[],
+                        help="Segment lengths to try, the model default is always tried.")
+    parser.add_argument("--overlap", type=float, default=0.25,
+                        help="Overlap between the splits used for the benchmark.")
+    parser.add_argument("--overlaps", type=float, nargs='+',
+                        help="Overlaps to try, enables the tuning of the overlap. "
+                             "The fastest is always the smallest, at the cost of quality.")
+    parser.add_argument("--jobs", type=int, nargs='+', default=[0, 2, 4])
+    parser.add_argument("--threads", type=int, nargs='+', default=sorted({cpus // 2 or 1, cpus}))
+    parser.add_argument("--batch-sizes", type=int, nargs='+', default=[1, 4])
+    parser.add_argument("--max-rss", type=float,
+                        help="Ignore configurations using more than this many MB.")
+    parser.add_argument("--profiles", type=Path, default=PROFILES,
+                        help="File where the profiles are stored.")
+    args = parser.parse_args()
+
+    model_signature = get_model_signature(args.name, args.repo)
+    overlaps = [args.overlap] if args.overlaps is None else args.overlaps
+    grid = itertools.product([None] + args.segments, overlaps, args.jobs,
+                             args.threads, args.batch_sizes)
+    best = None
+    for segment, overlap, jobs, threads, batch_size in grid:
+        config = {"segment": segment, "overlap": overlap, "jobs": jobs,
+                  "threads": threads, "batch_size": batch_size}
+        result = benchmark(args.name, args.repo, config, args.duration, args.shifts)
+        desc = " ".join(f"{key}={value}" for key, value in config.items())
+        if result is None:
+            print(f"{desc} | failed")
+            continue
+        print(f"{desc} | rtf={result['rtf']:.3f} rss={result['rss']:.0f}MB")
+        if args.max_rss is not None and result["rss"] > args.max_rss:
+            continue
+        if best is None or result["rtf"] < best["rtf"]:
+            best = dict(config, **result)
+
+    if best is None:
+        print("No configuration succeeded.")
+        return
+    if args.overlaps is None:
+        del best["overlap"]
+    save_profile(model_signature, best, args.profiles)
+    print(f"Best configuration for {model_signature} on {_host()}: {best}")
+    print(f"Saved to {args.profiles}")
+
+
+if __name__ == "__main__":
+    main()
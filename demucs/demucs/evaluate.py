@@ -12,17 +12,19 @@ be reported as `nsdr` for `new sdr`).
 import logging
 import torch as th
 import torchaudio as ta
-from .mp3 import get_test_dataset
+from .mp3 import get_test_dataset, _stats
 from dora.log import LogProgress
 import numpy as np
 from . import distrib
 from .apply import apply_model
 from .audio import convert_audio, save_audio, AudioFile
+from .cache import cached_metadata
 from .utils import DummyPoolExecutor
 from concurrent import futures
 import museval
 from pathlib import Path
 import os
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -43,6 +45,34 @@ def new_sdr(references, estimates):
     return scores
 
 
+def compare_models(reference_model, model, mix, references=None, **kwargs):
+    """
+    Compare `model` to `reference_model`, typically an optimized (e.g. quantized) version
+    of it, on the mixture `mix` of shape `(channels, time)`. Extra arguments are given
+    to `apply_model`. Returns a dict with the time taken by each model, and the nSDR
+    of each source estimated by `model`, taking the estimates of `reference_model` as references.
+    If the ground truth `references` of shape `(sources, channels, time)` is given, the nSDR
+    of both models against it is also reported.
+    """
+    timings = []
+    estimates = []
+    for candidate in [reference_model, model]:
+        begin = time.time()
+        estimates.append(apply_model(candidate, mix[None], **kwargs)[0].cpu())
+        timings.append(time.time() - begin)
+    expected, estimate = estimates
+    result = {
+        'reference_time': timings[0],
+        'time': timings[1],
+        'nsdr': new_sdr(expected[None].double(), estimate[None].double())[0].tolist(),
+    }
+    if references is not None:
+        references = references[None].cpu().double()
+        result['reference_nsdr_truth'] = new_sdr(references, expected[None].double())[0].tolist()
+        result['nsdr_truth'] = new_sdr(references, estimate[None].double())[0].tolist()
+    return result
+
+
 def eval_track(references, estimates, win, hop, compute_sdr=True):
     references = references.transpose(1, 2).double()
     estimates = estimates.transpose(1, 2).double()
@@ -99,13 +129,15 @@ def evaluate(solver, compute_sdr=False, test_location="../datasets/remix_dataset
         other, _ = ta.load(str(otherMp3))
         vocals, _ = ta.load(str(vocalsMp3))
         guitars, _ = ta.load(str(guitarsMp3))
-        ref = mix.mean(dim=0)  # mono mixture
-        mix = (mix - ref.mean()) / ref.std()
+        # Normalization of the mono mixture, decoded with `ta.load` as for the datasets,
+        # so that the entry of the metadata cache is shared with `build_metadata`.
+        stats = cached_metadata(mixtureMp3, "ta.stats", lambda: _stats(mix))
+        mix = (mix - stats["mean"]) / stats["std"]
         mix = convert_audio(mix, src_rate, model.samplerate, model.audio_channels)
         estimates = apply_model(model, mix[None],
                                 shifts=args.test.shifts, split=args.test.split,
                                 overlap=args.test.overlap)[0]
-        estimates = estimates * ref.std() + ref.mean()
+        estimates = estimates * stats["std"] + stats["mean"]
         estimates = estimates.to(eval_device)
 
         references = th.stack(
@@ -0,0 +1,213 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Export a model as a TorchScript or ONNX graph traced for a fixed chunk shape, removing
+the Python overhead of eager mode during inference.
+
+The graph is only valid for the shape it was traced with, i.e. the padded length
+of a chunk of `model.segment` seconds (plus the extra half second used by the shift trick).
+`TracedModel` and `OnnxModel` can be given to `apply_model` like the original model:
+they run the graph on chunks with the traced shape, and fall back to the eager model
+for the last chunk of a track, which is usually shorter.
+"""
+
+import json
+from pathlib import Path
+import typing as tp
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from .apply import BagOfModels
+from .utils import center_trim
+
+METADATA = "demucs.json"
+
+
+def _chunk_length(model, shifts: bool):
+    length = int(model.segment * model.samplerate)
+    if shifts:
+        length += int(0.5 * model.samplerate)
+    return length
+
+
+def _metadata(model, chunk_length, length, batch_size):
+    return {
+        'sources': model.sources,
+        'samplerate': model.samplerate,
+        'audio_channels': model.audio_channels,
+        'segment': model.segment,
+        'chunk_length': chunk_length,
+        'length': length,
+        'batch_size': batch_size,
+    }
+
+
+def export_torchscript(model, path: tp.Union[str, Path], shifts: bool = True,
+                       batch_size: int = 1):
+    """
+    Trace `model` and save it to `path`, along with the metadata needed by `apply_model`.
+
+    Args:
+        model (Model): model to export, bags of models must be exported model by model.
+        shifts (bool): if True, the graph is traced for chunks used with the shift trick
+            (`shifts > 0` in `apply_model`), which are half a second longer.
+        batch_size (int): batch size of the graph. Larger batches are split
+            into multiple calls.
+    """
+    if isinstance(model, BagOfModels):
+        raise ValueError("Bags of models must be exported one model at a time.")
+    model = model.cpu().eval()
+    chunk_length = _chunk_length(model, shifts)
+    length = model.valid_length(chunk_length)
+    example = torch.zeros(batch_size, model.audio_channels, length)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    traced = torch.jit.freeze(traced)
+    metadata = _metadata(model, chunk_length, length, batch_size)
+    torch.jit.save(traced, str(path), _extra_files={METADATA: json.dumps(metadata)})
+
+
+class TracedModel(nn.Module):
+    """
+    Wraps a graph exported with `export_torchscript`, to be used with `apply_model`.
+
+    Args:
+        graph (torch.jit.ScriptModule): traced model.
+        metadata (dict): metadata stored with the graph.
+        eager (Model or None): original model, used for chunks whose shape differs from
+            the traced one. If None, such chunks are zero padded to the traced length instead.
+    """
+    def __init__(self, graph, metadata: dict, eager: tp.Optional[nn.Module] = None):
+        super().__init__()
+        self.graph = graph
+        self.eager = eager
+        self.sources = metadata['sources']
+        self.samplerate = metadata['samplerate']
+        self.audio_channels = metadata['audio_channels']
+        self.segment = metadata['segment']
+        self.chunk_length = metadata['chunk_length']
+        self.length = metadata['length']
+        self.batch_size = metadata['batch_size']
+        if eager is not None:
+            assert eager.sources == self.sources
+            assert eager.samplerate == self.samplerate
+            assert eager.audio_channels == self.audio_channels
+
+    def valid_length(self, length):
+        if length == self.chunk_length:
+            return self.length
+        if self.eager is not None:
+            return self.eager.valid_length(length)
+        return length
+
+    def _run_batch(self, x):
+        return self.graph(x)
+
+    def _run_graph(self, x):
+        batch = x.shape[0]
+        outs = []
+        for start in range(0, batch, self.batch_size):
+            part = x[start:start + self.batch_size]
+            missing = self.batch_size - part.shape[0]
+            if missing:
+                part = F.pad(part, (0, 0, 0, 0, 0, missing))
+            outs.append(self._run_batch(part)[:self.batch_size - missing])
+        return torch.cat(outs)
+
+    def forward(self, x):
+        length = x.shape[-1]
+        if length == self.length:
+            return self._run_graph(x)
+        if self.eager is not None:
+            return self.eager(x)
+        if length > self.length:
+            raise ValueError(f"Input of length {length} is too long for the traced graph, "
+                             f"expected at most {self.length}.")
+        delta = self.length - length
+        x = F.pad(x, (delta // 2, delta - delta // 2))
+        return center_trim(self._run_graph(x), length)
+
+
+def load_traced(path: tp.Union[str, Path], eager: tp.Optional[nn.Module] = None,
+                optimize: bool = True) -> TracedModel:
+    """Load a graph exported with `export_torchscript`. See `TracedModel` for `eager`.
+    If `optimize` is True, additional CPU specific optimizations are applied to the graph."""
+    extra_files = {METADATA: ""}
+    graph = torch.jit.load(str(path), map_location='cpu', _extra_files=extra_files)
+    if optimize:
+        graph = torch.jit.optimize_for_inference(graph)
+    metadata = json.loads(extra_files[METADATA])
+    return TracedModel(graph, metadata, eager)
+
+
+def export_onnx(model, path: tp.Union[str, Path], shifts: bool = True,
+                batch_size: int = 1, opset: int = 13):
+    """
+    Export `model` as an ONNX graph to `path`, see `export_torchscript` for the arguments.
+    The whole forward is exported, including the normalization, the resampling
+    and the attention. The metadata is stored in the `metadata_props` of the graph.
+    Requires the `onnx` package.
+    """
+    import onnx
+
+    if isinstance(model, BagOfModels):
+        raise ValueError("Bags of models must be exported one model at a time.")
+    model = model.cpu().eval()
+    chunk_length = _chunk_length(model, shifts)
+    length = model.valid_length(chunk_length)
+    example = torch.zeros(batch_size, model.audio_channels, length)
+    with torch.no_grad():
+        torch.onnx.export(model, example, str(path), input_names=['mix'],
+                          output_names=['sources'], opset_version=opset)
+    graph = onnx.load(str(path))
+    entry = graph.metadata_props.add()
+    entry.key = METADATA
+    entry.value = json.dumps(_metadata(model, chunk_length, length, batch_size))
+    onnx.save(graph, str(path))
+
+
+class OnnxModel(TracedModel):
+    """
+    Same as `TracedModel`, with the graph executed by the CPU execution provider
+    of onnxruntime.
+
+    Args:
+        session (onnxruntime.InferenceSession): session for the exported graph.
+        metadata (dict): metadata stored with the graph.
+        eager (Model or None): see `TracedModel`.
+    """
+    def __init__(self, session, metadata: dict, eager: tp.Optional[nn.Module] = None):
+        super().__init__(None, metadata, eager)
+        self.session = session
+
+    def _run_batch(self, x):
+        out, = self.session.run(None, {'mix': x.detach().cpu().float().numpy()})
+        return torch.from_numpy(out).to(x.device)
+
+
+def load_onnx(path: tp.Union[str, Path], eager: tp.Optional[nn.Module] = None,
+              threads: tp.Optional[int] = None) -> OnnxModel:
+    """Load a graph exported with `export_onnx`. See `TracedModel` for `eager`.
+    `threads` is the number of intra-op threads, by default that of torch.
+    Requires the `onnxruntime` package."""
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads or torch.get_num_threads()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = onnxruntime.InferenceSession(str(path), options,
+                                           providers=['CPUExecutionProvider'])
+    metadata = json.loads(session.get_modelmeta().custom_metadata_map[METADATA])
+    return OnnxModel(session, metadata, eager)
+
+
+def load_exported(path: tp.Union[str, Path], eager: tp.Optional[nn.Module] = None):
+    """Load a graph exported with either `export_onnx` (`.onnx` files)
+    or `export_torchscript` (any other extension)."""
+    if Path(path).suffix == '.onnx':
+        return load_onnx(path, eager)
+    return load_traced(path, eager)
@@ -0,0 +1,134 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Incremental separation of a live stream, with a bounded latency.
+
+Audio is pushed block by block, and the sources are emitted by hops of fixed size.
+Each hop is separated with some past audio as context and some future audio as lookahead,
+the input window being extended so that its length is valid for the model, avoiding any
+zero padding. The algorithmic latency is the hop plus the lookahead.
+"""
+
+import time
+import typing as tp
+
+import torch as th
+
+from .apply import BagOfModels, apply_model
+
+
+class RealtimeSeparator:
+    """
+    Separate a stream incrementally.
+
+    Args:
+        model (Model or BagOfModels): model to apply.
+        hop (float): duration in seconds of the output emitted at once.
+        lookahead (float): duration in seconds of future audio used to separate a hop.
+        context (float): minimum duration in seconds of past audio used to separate a hop.
+        device (torch.device, str, or None): device on which to run the model.
+        shifts (int): see `apply_model`, each shift is a full evaluation of the model.
+        mean, std (float or None): normalization of the input. If None, it is estimated
+            from the input received so far.
+
+    Example:
+
+        separator = RealtimeSeparator(model, hop=1.)
+        for block in blocks:
+            sources = separator.push(block)  # (sources, channels, time), possibly empty.
+        sources = separator.flush()
+        print(separator.rtf)
+    """
+    def __init__(self, model, hop: float = 1., lookahead: float = 0.5, context: float = 2.,
+                 device=None, shifts: int = 0, mean: tp.Optional[float] = None,
+                 std: tp.Optional[float] = None):
+        self.model = model
+        self.samplerate = model.samplerate
+        self.hop = int(hop * self.samplerate)
+        self.lookahead = int(lookahead * self.samplerate)
+        self.context = int(context * self.samplerate)
+        window = self.context + self.hop + self.lookahead
+        models = model.models if isinstance(model, BagOfModels) else [model]
+        if hasattr(models[0], 'valid_length'):
+            # Use more past context rather than zero padding.
+            self.context += max(sub_model.valid_length(window) for sub_model in models) - window
+        self.device = device
+        self.shifts = shifts
+        self.mean = mean
+        self.std = std
+        # Input from `context` samples before the next hop, silence before the stream start.
+        self._buffer = th.zeros(model.audio_channels, self.context)
+        self._received = 0
+        self._emitted = 0
+        self._sum = 0.
+        self._sum_sq = 0.
+        self._elapsed = 0.
+
+    @property
+    def latency(self) -> float:
+        """Algorithmic latency in seconds, between receiving a sample and emitting
+        its separated sources."""
+        return (self.hop + self.lookahead) / self.samplerate
+
+    @property
+    def rtf(self) -> float:
+        """Real time factor so far, i.e. the processing time divided by the
+        duration of the emitted audio. Must stay below 1 to keep up with a live stream."""
+        if not self._emitted:
+            return 0.
+        return self._elapsed / (self._emitted / self.samplerate)
+
+    def _normalization(self):
+        if self.mean is not None and self.std is not None:
+            return self.mean, self.std
+        count = max(1, self._received)
+        mean = self._sum / count
+        std = max((self._sum_sq - count * mean**2) / max(count - 1, 1), 0) ** 0.5
+        return (mean if self.mean is None else self.mean,
+                max(std, 1e-5) if self.std is None else self.std)
+
+    def _step(self):
+        window = self._buffer[:, :self.context + self.hop + self.lookahead]
+        mean, std = self._normalization()
+        begin = time.time()
+        sources = apply_model(self.model, ((window - mean) / std)[None], shifts=self.shifts,
+                              split=False, device=self.device)[0]
+        sources = sources[..., self.context:self.context + self.hop].cpu() * std + mean
+        self._elapsed += time.time() - begin
+        self._buffer = self._buffer[:, self.hop:]
+        return sources
+
+    def push(self, block: th.Tensor) -> th.Tensor:
+        """Add a block of audio of shape `(channels, time)`, and return the sources for
+        all the hops that are complete, with shape `(sources, channels, time)`."""
+        block = block.cpu()
+        mono = block.mean(0).double()
+        self._sum += mono.sum().item()
+        self._sum_sq += mono.square().sum().item()
+        self._received += block.shape[-1]
+        self._buffer = th.cat([self._buffer, block], dim=-1)
+        outs = []
+        while self._buffer.shape[-1] >= self.context + self.hop + self.lookahead:
+            outs.append(self._step())
+        return self._output(outs)
+
+    def flush(self) -> th.Tensor:
+        """Return the sources for the remaining audio, at the end of the stream."""
+        outs = []
+        while self._emitted + sum(out.shape[-1] for out in outs) < self._received:
+            missing = self.context + self.hop + self.lookahead - self._buffer.shape[-1]
+            if missing > 0:
+                self._buffer = th.cat([self._buffer, self._buffer.new_zeros(
+                    self._buffer.shape[0], missing)], dim=-1)
+            outs.append(self._step())
+        return self._output(outs)
+
+    def _output(self, outs):
+        if not outs:
+            return th.zeros(len(self.model.sources), self.model.audio_channels, 0)
+        out = th.cat(outs, dim=-1)
+        out = out[..., :self._received - self._emitted]
+        self._emitted += out.shape[-1]
+        return out
@@ -6,9 +6,10 @@
 """Main training loop."""
 
 import logging
+from pathlib import Path
 from dora import get_xp
 from dora.utils import write_and_rename
-from dora.log import LogProgress, bold
+from dora.log import LogProgress, bold, fatal
 import torch
 import torch.nn.functional as F
 from . import augment, distrib, states, pretrained
@@ -58,6 +59,22 @@ class Solver(object):
                 augments.append(getattr(augment, aug.capitalize())(**kw))
         self.augment = torch.nn.Sequential(*augments)
 
+        # Knowledge distillation: a frozen teacher gives additional targets during training.
+        self.teacher = None
+        if args.distill.teacher:
+            repo = args.distill.repo or args.pretrained_repo
+            if repo is None:
+                fatal("distill.teacher requires distill.repo (or pretrained_repo), "
+                      "the local repo containing the teacher.")
+            repo = Path(repo)
+            self.teacher = pretrained.get_model(name=args.distill.teacher, repo=repo)
+            assert self.teacher.sources == self.model.sources, \
+                "The teacher must separate the same sources as the model."
+            self.teacher.to(self.device)
+            self.teacher.eval()
+            for p in self.teacher.parameters():
+                p.requires_grad_(False)
+
         xp = get_xp()  # xp = ?
         self.folder = xp.folder
         # Checkpoints
@@ -149,6 +166,8 @@ class Solver(object):
             losses['penalty'] = format(metrics['penalty'], ".4f")
         if 'hloss' in metrics:
             losses['hloss'] = format(metrics['hloss'], ".4f")
+        if 'distill' in metrics:
+            losses['distill'] = format(metrics['distill'], ".4f")
         return losses
 
     def _format_test(self, metrics: dict) -> dict:
@@ -289,6 +308,23 @@ class Solver(object):
             if is_last:
                 break
 
+    def _loss(self, estimate, target):
+        """Return the loss of `estimate` against `target` for each source
+        (and each item of the batch for the mse), along with the reconstruction error."""
+        dims = tuple(range(2, target.dim()))
+        if self.args.optim.loss == 'l1':
+            loss = F.l1_loss(estimate, target, reduction='none')
+            loss = loss.mean(dims).mean(0)
+            reco = loss
+        elif self.args.optim.loss == 'mse':
+            loss = F.mse_loss(estimate, target, reduction='none')
+            loss = loss.mean(dims)
+            reco = loss**0.5
+            reco = reco.mean(0)
+        else:
+            raise ValueError(f"Invalid loss {self.args.optim.loss}")
+        return loss, reco
+
     def _run_one_epoch(self, epoch, train=True):
         args = self.args
         data_loader = self.loaders['train'] if train else self.loaders['valid']
@@ -320,21 +356,18 @@ class Solver(object):
             if train and hasattr(self.model, 'transform_target'):
                 sources = self.model.transform_target(mix, sources)
             assert estimate.shape == sources.shape, (estimate.shape, sources.shape)
-            dims = tuple(range(2, sources.dim()))
-
-            if args.optim.loss == 'l1':
-                loss = F.l1_loss(estimate, sources, reduction='none')
-                loss = loss.mean(dims).mean(0)
-                reco = loss
-            elif args.optim.loss == 'mse':
-                loss = F.mse_loss(estimate, sources, reduction='none')
-                loss = loss.mean(dims)
-                reco = loss**0.5
-                reco = reco.mean(0)
-            else:
-                raise ValueError(f"Invalid loss {self.args.loss}")
+
+            loss, reco = self._loss(estimate, sources)
             weights = torch.tensor(args.weights).to(sources)
+            distill = None
+            if train and self.teacher is not None:
+                with torch.no_grad():
+                    teacher_estimate = apply_model(self.teacher, mix, shifts=0, split=False)
+                distill, _ = self._loss(estimate, teacher_estimate)
+                distill = (distill * weights).sum() / weights.sum()
             loss = (loss * weights).sum() / weights.sum()
+            if distill is not None:
+                loss = args.distill.alpha * loss + (1 - args.distill.alpha) * distill
 
             ms = 0
             if self.quantizer is not None:
@@ -345,6 +378,8 @@ class Solver(object):
             losses = {}
             losses['reco'] = (reco * weights).sum() / weights.sum()
             losses['ms'] = ms
+            if distill is not None:
+                losses['distill'] = distill
 
             if not train:
                 nsdrs = new_sdr(sources, estimate.detach()).mean(0)
@@ -105,18 +105,25 @@ def serialize_model(model, training_args, quantizer=None, half=True):
     klass = model.__class__
 
     state = get_state(model, quantizer, half)
-    return {
+    package = {
         'klass': klass,
         'args': args,
         'kwargs': kwargs,
         'state': state,
         'training_args': OmegaConf.to_container(training_args, resolve=True),
     }
+    from .compress import get_lowrank_structure
+    lowrank = get_lowrank_structure(model)
+    if lowrank:
+        # Layers factorized by `demucs.compress`, rebuilt before loading the state.
+        package['lowrank'] = lowrank
+    return package
 
 
-def load_model(path_or_package, strict=False):
+def load_model(path_or_package, strict=False, quantize=None):
     """Load a model from the given serialized model, either given as a dict (already loaded)
-    or a path to a file on disk."""
+    or a path to a file on disk. If `quantize` is set (e.g. to `int8`), the model is
+    dynamically quantized for CPU inference, see `demucs.quantize`."""
     if isinstance(path_or_package, dict):
         package = path_or_package
     elif isinstance(path_or_package, (str, Path)):
@@ -141,7 +148,14 @@ def load_model(path_or_package, strict=False):
                 del kwargs[key]
         model = klass(*args, **kwargs)
 
+    if package.get("lowrank"):
+        from .compress import set_lowrank_structure
+        set_lowrank_structure(model, package["lowrank"])
+
     state = package["state"]
 
     set_state(model, state)
+    if quantize:
+        from .quantize import quantize_model
+        model = quantize_model(model, quantize)
     return model
\ No newline at end of file
@@ -96,10 +96,12 @@ def get_solver(args, model_only=False):
 def main(args):
     global __file__
     __file__ = hydra.utils.to_absolute_path(__file__)
-    for attr in ["remixdset", "metadata"]:
+    for attr in ["remixdset", "metadata", "shards"]:
         val = getattr(args.dset, attr)
         if val is not None:
             setattr(args.dset, attr, hydra.utils.to_absolute_path(val))
+    if args.distill.repo is not None:
+        args.distill.repo = hydra.utils.to_absolute_path(args.distill.repo)
 
     os.environ["OMP_NUM_THREADS"] = "1"
     os.environ["MKL_NUM_THREADS"] = "1"
@@ -7,7 +7,9 @@
 """Export a trained model from the full checkpoint (with optimizer etc.) to
 a final checkpoint, with only the model itself. The model is always stored as
 half float to gain space, and because this has zero impact on the final loss.
-When DiffQ was used for training, the model will actually be quantized and bitpacked."""
+When DiffQ was used for training, the model will actually be quantized and bitpacked.
+With `--torchscript` or `--onnx`, a TorchScript or ONNX graph traced for the model
+segment length is also exported, see `demucs.export`."""
 from argparse import ArgumentParser
 import logging
 from pathlib import Path
@@ -15,6 +17,7 @@ import sys
 import torch
 
 from demucs import train
+from demucs.export import export_onnx, export_torchscript
 from demucs.states import serialize_model, save_with_checksum
 
 
@@ -30,6 +33,14 @@ def main():
                         help="Path where to store release models (default release_models)")
     parser.add_argument('-s', '--sign', action='store_true',
                         help='Add sha256 prefix checksum to the filename.')
+    parser.add_argument('--torchscript', action='store_true',
+                        help='Also export a traced TorchScript graph, as SIG.ts.')
+    parser.add_argument('--onnx', action='store_true',
+                        help='Also export an ONNX graph, as SIG.onnx.')
+    parser.add_argument('--no-shifts', action='store_false', dest='shifts',
+                        help='Trace the graphs for chunks separated without the shift trick.')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Batch size of the traced graphs.')
 
     args = parser.parse_args()
     args.out.mkdir(exist_ok=True, parents=True)
@@ -60,6 +71,15 @@ def main():
             save_with_checksum(pkg, out_path)
         else:
             torch.save(pkg, out_path)
+        if args.torchscript:
+            ts_path = args.out / (sig + ".ts")
+            logger.info('Tracing %s to %s', sig, ts_path)
+            export_torchscript(solver.model, ts_path, shifts=args.shifts,
+                               batch_size=args.batch_size)
+        if args.onnx:
+            onnx_path = args.out / (sig + ".onnx")
+            logger.info('Exporting %s to %s', sig, onnx_path)
+            export_onnx(solver.model, onnx_path, shifts=args.shifts, batch_size=args.batch_size)
 
 
 if __name__ == '__main__':
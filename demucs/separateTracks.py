@@ -5,6 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import argparse
+import logging
 import sys
 from pathlib import Path
 import subprocess
@@ -12,9 +13,16 @@ import subprocess
 import torch as th
 import torchaudio as ta
 from dora.log import fatal
-from demucs.audio import AudioFile, convert_audio, save_audio
-from demucs.pretrained import get_model_from_args, add_model_flags, ModelLoadingError
-from demucs.apply import apply_model
+from demucs.audio import AudioFile, MP3Writer, MP3_PRESETS, StemWriter, convert_audio
+from demucs.pretrained import get_model_from_args, get_model_signature, add_model_flags, ModelLoadingError
+from demucs.apply import BagOfModels, apply_model_many, apply_model_stream, set_segment
+from demucs.parallel import ProcessPoolChunkExecutor
+from demucs.cache import SeparationCache, set_metadata_cache
+from demucs.autotune import load_profile
+from demucs.demucs import set_attention_window
+from demucs.quantize import quantize_model
+from demucs.export import load_exported
+from demucs.realtime import RealtimeSeparator
 
 
 def load_track(track, audio_channels, samplerate):
@@ -48,6 +56,119 @@ def load_track(track, audio_channels, samplerate):
     return wav
 
 
+def stem_path(out, filename, track, stem, ext):
+    path = out / filename.format(track=track.name.rsplit(".", 1)[0],
+                                 trackext=track.name.rsplit(".", 1)[-1],
+                                 stem=stem, ext=ext)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def silence_rms(threshold_db):
+    """Convert a silence threshold in dB relative to the RMS of the track into a RMS
+    for `apply_model`, which is given tracks normalized to unit variance."""
+    if threshold_db is None:
+        return None
+    return 10 ** (threshold_db / 20)
+
+
+def separate_stream(model, track, out, args, block_duration=30.):
+    """Separate `track` block by block using `apply_model_stream`, writing the stems
+    as they are produced, so that memory usage does not depend on the track length.
+    Only mp3 output is supported and clipping is prevented by clamping."""
+    audio = AudioFile(track)
+
+    def blocks():
+        return audio.stream(block_duration, samplerate=model.samplerate,
+                            channels=model.audio_channels)
+
+    # Normalization of the entire track, from a first pass or the metadata cache.
+    mean, std = audio.normalization(samplerate=model.samplerate, channels=model.audio_channels)
+
+    if args.stem is None:
+        names = model.sources
+    else:
+        names = [args.stem, "no_" + args.stem]
+    writers = [MP3Writer(stem_path(out, args.filename, track, name, "mp3"),
+                         model.samplerate, model.audio_channels, args.mp3_bitrate,
+                         preset=args.mp3_preset)
+               for name in names]
+    mixes = (((block - mean) / std)[None] for block in blocks())
+    try:
+        for sources in apply_model_stream(model, mixes, device=args.device, shifts=args.shifts,
+                                          overlap=args.overlap, seed=args.seed,
+                                          silence_threshold=silence_rms(args.silence_threshold)):
+            sources = sources[0] * std + mean
+            if args.stem is not None:
+                index = model.sources.index(args.stem)
+                sources = [sources[index], sources.sum(0) - sources[index]]
+            for writer, source in zip(writers, sources):
+                writer.write(source)
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+def separate_realtime(model, track, out, args):
+    """Separate `track` as if it was a live stream, fed by blocks of one hop
+    to a `RealtimeSeparator`, and report the latency and real time factor.
+    The normalization is estimated from the audio received so far."""
+    separator = RealtimeSeparator(model, hop=args.realtime, lookahead=args.lookahead,
+                                  device=args.device, shifts=args.shifts)
+    if args.stem is None:
+        names = model.sources
+    else:
+        names = [args.stem, "no_" + args.stem]
+    writers = [MP3Writer(stem_path(out, args.filename, track, name, "mp3"),
+                         model.samplerate, model.audio_channels, args.mp3_bitrate,
+                         preset=args.mp3_preset)
+               for name in names]
+
+    def write(sources):
+        if not sources.shape[-1]:
+            return
+        if args.stem is not None:
+            index = model.sources.index(args.stem)
+            sources = [sources[index], sources.sum(0) - sources[index]]
+        for writer, source in zip(writers, sources):
+            writer.write(source)
+
+    try:
+        for block in AudioFile(track).stream(args.realtime, samplerate=model.samplerate,
+                                             channels=model.audio_channels):
+            write(separator.push(block))
+        write(separator.flush())
+    finally:
+        for writer in writers:
+            writer.close()
+    print(f"Latency {separator.latency:.2f}s, real time factor {separator.rtf:.2f}")
+
+
+def save_sources(model, sources, track, out, args, writer):
+    """Schedule the saving of the stems of `track` with the `StemWriter` `writer`."""
+    if args.mp3:
+        ext = "mp3"
+    elif args.flac:
+        ext = "flac"
+    else:
+        ext = "wav"
+
+    if args.stem is None:
+        for source, name in zip(sources, model.sources):
+            stem = stem_path(out, args.filename, track, name, ext)
+            writer.save(source, str(stem))
+    else:
+        sources = list(sources)
+        stem = stem_path(out, args.filename, track, args.stem, ext)
+        writer.save(sources.pop(model.sources.index(args.stem)), str(stem))
+        # Warning : after poping the stem, selected stem is no longer in the list 'sources'
+        other_stem = th.zeros_like(sources[0])
+        for i in sources:
+            other_stem += i
+        stem = stem_path(out, args.filename, track, "no_" + args.stem, ext)
+        writer.save(other_stem, str(stem))
+
+
 def main():
     parser = argparse.ArgumentParser("demucs.separate",
                                      description="Separate the sources for the given tracks")
@@ -71,18 +192,29 @@ def main():
                         "--device",
                         default="cuda" if th.cuda.is_available() else "cpu",
                         help="Device to use, default is cuda if available else cpu")
-    parser.add_argument("--mp3", action="store_true",
-                        help="Convert the output wavs to mp3.")
+    format_group = parser.add_mutually_exclusive_group()
+    format_group.add_argument("--mp3", action="store_true",
+                              help="Convert the output wavs to mp3.")
+    format_group.add_argument("--flac", action="store_true",
+                              help="Convert the output wavs to flac.")
     parser.add_argument("--mp3-bitrate",
                         default=320,
                         type=int,
                         help="Bitrate of converted mp3.")
+    parser.add_argument("--mp3-preset", default="best", choices=list(MP3_PRESETS),
+                        help="Speed of the mp3 encoder, 'standard' and 'fast' encode faster "
+                             "than 'best' at the cost of some quality.")
+    parser.add_argument("--encode-workers", type=int,
+                        help="Number of threads encoding the stems concurrently, "
+                             "defaults to the number of cpus.")
     parser.add_argument("--shifts",
-                        default=1,
                         type=int,
                         help="Number of random shifts for equivariant stabilization."
                              "Increase separation time but improves quality for Demucs. 10 was used "
-                             "in the original paper.")
+                             "in the original paper. Default is 1, or 0 with --realtime.")
+    parser.add_argument("--seed",
+                        type=int,
+                        help="Seed for the random shifts, making the separation reproducible.")
     parser.add_argument("--overlap",
                         default=0.25,
                         type=float,
@@ -94,7 +226,7 @@ def main():
                              default=True,
                              help="Doesn't split audio in chunks. "
                                   "This can use large amounts of memory.")
-    split_group.add_argument("--segment", type=int,
+    split_group.add_argument("--segment", type=float,
                              help="Set split size of each chunk. "
                                   "This can help save memory of graphic card. ")
     parser.add_argument("--two-stems",
@@ -105,15 +237,90 @@ def main():
                         type=int,
                         help="Number of jobs. This can increase memory usage but will "
                              "be much faster when multiple cores are available.")
+    parser.add_argument("--processes", action="store_true",
+                        help="Run the jobs in worker processes instead of threads, "
+                             "each with its own share of the available cores.")
+    parser.add_argument("--threads",
+                        type=int,
+                        help="Number of threads used by torch for intra-op parallelism.")
+    parser.add_argument("-b", "--batch-size",
+                        default=1,
+                        type=int,
+                        help="Number of chunks evaluated together in a single forward "
+                             "when splitting. Chunks from different tracks can share a batch.")
     parser.add_argument("--clip-mode", default="rescale", choices=["rescale", "clamp"],
                         help="Strategy for avoiding clipping: rescaling entire signal "
                              "if necessary  (rescale) or hard clipping (clamp).")
+    parser.add_argument("--attention-window", type=int, metavar="STEPS",
+                        help="Only attend to this many time steps on each side in the "
+                             "attention layers, which uses less memory for long segments.")
+    parser.add_argument("--silence-threshold", type=float, metavar="DB",
+                        help="Do not evaluate chunks whose level is below this threshold, "
+                             "in dB relative to the level of the track (e.g. -50), "
+                             "their sources are silent.")
+    parser.add_argument("--no-autotune", action="store_false", dest="autotune",
+                        help="Do not load the settings found by demucs.autotune for this "
+                             "host and model.")
+    parser.add_argument("--cache", type=Path,
+                        help="Folder used to cache separation results, so that separating again "
+                             "the same track with the same model and settings is instantaneous. "
+                             "Shifts are seeded with --seed (0 by default) when caching.")
+    parser.add_argument("--cache-size", default=10., type=float,
+                        help="Maximum size of the cache in GB, least recently used results "
+                             "are removed first.")
+    parser.add_argument("--metadata-cache", type=Path,
+                        help="SQLite file caching the audio metadata and normalization "
+                             "statistics, shared with the datasets. Defaults to "
+                             "$DEMUCS_METADATA_CACHE or ~/.cache/demucs/metadata.sqlite.")
+    parser.add_argument("--no-metadata-cache", action="store_true",
+                        help="Do not use the audio metadata cache.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Decode and separate the tracks block by block and write the stems "
+                             "as they are produced, with a memory usage that does not depend "
+                             "on the track length. Requires --mp3, clipping is done by clamping.")
+    parser.add_argument("--realtime", type=float, metavar="HOP",
+                        help="Separate the tracks as live streams, emitting the stems by hops "
+                             "of HOP seconds, and report the achieved real time factor. "
+                             "Requires --mp3.")
+    parser.add_argument("--lookahead", type=float, default=0.5,
+                        help="Seconds of future audio used for each hop with --realtime, "
+                             "the latency is the hop plus the lookahead.")
+    parser.add_argument("--quantize", choices=["int8"],
+                        help="Quantize the model for faster inference on cpu. Only the LSTMs, "
+                             "linear layers and 1x1 convolutions are quantized, unless "
+                             "--calibrate is given.")
+    parser.add_argument("--calibrate", nargs='+', type=Path, metavar="TRACK",
+                        help="Tracks used to calibrate the quantization of all the "
+                             "convolutions. Only 30 seconds of each track are used.")
+    parser.add_argument("--check-quantization", action="store_true",
+                        help="Also separate each track with the original model and report "
+                             "the nSDR of the quantized model against it, along with the speedup.")
+    parser.add_argument("--traced", type=Path, metavar="GRAPH",
+                        help="TorchScript (.ts) or ONNX (.onnx) graph of the model exported "
+                             "with exportModel.py, used for all the chunks with the traced "
+                             "shape. ONNX graphs are run with onnxruntime.")
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--int24", action="store_true",
-                       help="Save wav output as 24 bits wav.")
+                       help="Save wav or flac output with 24 bits.")
     group.add_argument("--float32", action="store_true",
                        help="Save wav output as float32 (2x bigger).")
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.no_metadata_cache:
+        set_metadata_cache(None)
+    elif args.metadata_cache is not None:
+        set_metadata_cache(args.metadata_cache)
+    if args.autotune and args.repo is not None:
+        # Settings tuned for this host and model replace the defaults,
+        # but not the options given explicitly on the command line.
+        try:
+            profile = load_profile(get_model_signature(args.name, args.repo))
+        except ModelLoadingError:
+            profile = None
+        if profile is not None:
+            print(f"Using autotuned settings {profile}")
+            parser.set_defaults(**profile)
+            args = parser.parse_args()
 
     try:
         model = get_model_from_args(args)
@@ -122,62 +329,140 @@ def main():
 
     model.cpu()
     model.eval()
+    if args.segment is not None:
+        set_segment(model, args.segment)
+    if args.attention_window is not None:
+        set_attention_window(model, args.attention_window)
+    if args.threads:
+        th.set_num_threads(args.threads)
+
+    reference_model = None
+    if args.quantize:
+        if th.device(args.device).type != 'cpu':
+            fatal("Quantized models only run on cpu, please add -d cpu.")
+        if args.processes:
+            fatal("--quantize cannot be used with --processes.")
+        calibration = None
+        if args.calibrate:
+            calibration = []
+            length = 30 * model.samplerate
+            for track in args.calibrate:
+                wav = load_track(track, model.audio_channels, model.samplerate)
+                ref = wav.mean(0)
+                wav = (wav - ref.mean()) / ref.std()
+                start = max(0, (wav.shape[-1] - length) // 2)
+                calibration.append(wav[..., start:start + length])
+        if args.check_quantization:
+            reference_model = model
+        model = quantize_model(model, args.quantize, calibration)
+
+    if args.traced is not None:
+        if th.device(args.device).type != 'cpu':
+            fatal("Traced graphs only run on cpu, please add -d cpu.")
+        if isinstance(model, BagOfModels):
+            fatal("--traced is not supported with bags of models.")
+        if args.quantize or args.processes:
+            fatal("--traced cannot be used with --quantize or --processes.")
+        model = load_exported(args.traced, eager=model)
+        if args.segment is not None and args.segment != model.segment:
+            print(f"The graph was traced for segments of {model.segment} seconds, "
+                  "ignoring --segment.")
+
+    if args.stream and not args.mp3:
+        fatal("--stream only supports mp3 output, please add --mp3.")
+    if args.realtime is not None and not args.mp3:
+        fatal("--realtime only supports mp3 output, please add --mp3.")
+    if args.shifts is None:
+        # Each shift is a full evaluation of the model, which would multiply the real time factor.
+        args.shifts = 0 if args.realtime is not None else 1
+    if args.flac and args.float32:
+        fatal("--float32 is not supported with --flac.")
+
+    cache = None
+    if args.cache is not None:
+        cache = SeparationCache(args.cache, int(args.cache_size * 2**30))
+        model_signature = get_model_signature(args.name, args.repo)
+        # Traced graphs and batching give slightly different outputs than the eager model.
+        backend = 'eager' if args.traced is None else args.traced.name
+        if args.seed is None:
+            args.seed = 0
+
+    pool = None
+    if args.processes and args.jobs > 0 and th.device(args.device).type == 'cpu':
+        pool = ProcessPoolChunkExecutor(model, args.jobs)
 
     out = args.out / args.name
     out.mkdir(parents=True, exist_ok=True)
     print(f"Separated tracks will be stored in {out.resolve()}")
-    for track in args.tracks:
-        if not track.exists():
-            print(
-                f"File {track} does not exist. If the path contains spaces, "
-                "please try again after surrounding the entire path with quotes \"\".",
-                file=sys.stderr)
-            continue
-        print(f"Separating track {track}")
-        wav = load_track(track, model.audio_channels, model.samplerate)
-
-        ref = wav.mean(0)
-        wav = (wav - ref.mean()) / ref.std()
-        sources = apply_model(model, wav[None], device=args.device, shifts=args.shifts,
-                              split=args.split, overlap=args.overlap, progress=True,
-                              num_workers=args.jobs)[0]
-        sources = sources * ref.std() + ref.mean()
-
-        if args.mp3:
-            ext = "mp3"
-        else:
-            ext = "wav"
-        kwargs = {
-            'samplerate': model.samplerate,
-            'bitrate': args.mp3_bitrate,
-            'clip': args.clip_mode,
-            'as_float': args.float32,
-            'bits_per_sample': 24 if args.int24 else 16,
-        }
-
-        if args.stem is None:
-            for source, name in zip(sources, model.sources):
-                stem = out / args.filename.format(track=track.name.rsplit(".", 1)[0],
-                                                  trackext=track.name.rsplit(".", 1)[-1],
-                                                  stem=name, ext=ext)
-                stem.parent.mkdir(parents=True, exist_ok=True)
-                save_audio(source, str(stem), **kwargs)
-        else:
-            sources = list(sources)
-            stem = out / args.filename.format(track=track.name.rsplit(".", 1)[0],
-                                              trackext=track.name.rsplit(".", 1)[-1],
-                                              stem=args.stem, ext=ext)
-            stem.parent.mkdir(parents=True, exist_ok=True)
-            save_audio(sources.pop(model.sources.index(args.stem)), str(stem), **kwargs)
-            # Warning : after poping the stem, selected stem is no longer in the list 'sources'
-            other_stem = th.zeros_like(sources[0])
-            for i in sources:
-                other_stem += i
-            stem = out / args.filename.format(track=track.name.rsplit(".", 1)[0],
-                                              trackext=track.name.rsplit(".", 1)[-1],
-                                              stem="no_" + args.stem, ext=ext)
-            stem.parent.mkdir(parents=True, exist_ok=True)
-            save_audio(other_stem, str(stem), **kwargs)
+    # The stems are encoded in the background, while the next tracks are separated.
+    writer = StemWriter(args.encode_workers, samplerate=model.samplerate,
+                        bitrate=args.mp3_bitrate, preset=args.mp3_preset, clip=args.clip_mode,
+                        as_float=args.float32, bits_per_sample=24 if args.int24 else 16)
+
+    def mixes():
+        # Tracks are loaded lazily, when more chunks are needed to fill a batch.
+        for track in args.tracks:
+            if not track.exists():
+                print(
+                    f"File {track} does not exist. If the path contains spaces, "
+                    "please try again after surrounding the entire path with quotes \"\".",
+                    file=sys.stderr)
+                continue
+            print(f"Separating track {track}")
+            if args.stream:
+                separate_stream(model, track, out, args)
+                continue
+            if args.realtime is not None:
+                separate_realtime(model, track, out, args)
+                continue
+            wav = load_track(track, model.audio_channels, model.samplerate)
+
+            key = None
+            if cache is not None:
+                key = cache.key(wav, model_signature, shifts=args.shifts, overlap=args.overlap,
+                                split=args.split, segment=args.segment, seed=args.seed,
+                                silence_threshold=args.silence_threshold,
+                                attention_window=args.attention_window,
+                                quantize=args.quantize and ('static' if args.calibrate
+                                                            else 'dynamic'),
+                                backend=backend, batch_size=args.batch_size)
+                sources = cache.get(key)
+                if sources is not None:
+                    print("Using cached separation.")
+                    save_sources(model, sources, track, out, args, writer)
+                    continue
+            ref = wav.mean(0)
+            wav = (wav - ref.mean()) / ref.std()
+            if reference_model is not None:
+                from demucs.evaluate import compare_models
+                check = compare_models(reference_model, model, wav, device=args.device,
+                                       shifts=args.shifts, split=args.split,
+                                       overlap=args.overlap, num_workers=args.jobs,
+                                       batch_size=args.batch_size,
+                                       seed=0 if args.seed is None else args.seed)
+                nsdrs = ", ".join(f"{name}={nsdr:.2f}dB"
+                                  for name, nsdr in zip(model.sources, check['nsdr']))
+                print(f"Quantized model nSDR against the original: {nsdrs}, "
+                      f"speedup x{check['reference_time'] / check['time']:.2f}")
+            yield (track, ref.mean(), ref.std(), key), wav[None]
+
+    # Chunks from different tracks are evaluated in the same batches,
+    # and each track is saved as soon as all its chunks are done.
+    separated = apply_model_many(model, mixes(), device=args.device, shifts=args.shifts,
+                                 split=args.split, overlap=args.overlap, progress=True,
+                                 num_workers=args.jobs, pool=pool, batch_size=args.batch_size,
+                                 seed=args.seed,
+                                 silence_threshold=silence_rms(args.silence_threshold))
+    try:
+        for (track, mean, std, key), sources in separated:
+            sources = sources[0] * std + mean
+            if cache is not None:
+                cache.put(key, sources)
+            save_sources(model, sources, track, out, args, writer)
+        writer.close()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
 
 
 if __name__ == "__main__":
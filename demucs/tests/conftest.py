@@ -0,0 +1,31 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Make the `demucs` package importable when running `pytest` from any folder,
+and shared fixtures."""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def model_repo(tmp_path):
+    """Local model repo containing a tiny `Demucs` model, with the signature `tiny`."""
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("julius")
+    omegaconf = pytest.importorskip("omegaconf")
+    from demucs.demucs import Demucs
+    from demucs.states import save_with_checksum, serialize_model
+
+    torch.manual_seed(0)
+    model = Demucs(["drums", "bass"], channels=4, depth=2, samplerate=8000, segment=1.)
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    package = serialize_model(model, omegaconf.OmegaConf.create({}), half=False)
+    save_with_checksum(package, repo / "tiny.th")
+    return repo
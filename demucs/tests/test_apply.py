@@ -0,0 +1,160 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Batched, shifted and streamed evaluations must match the plain `apply_model`."""
+import gc
+import os
+import random
+
+import pytest
+
+th = pytest.importorskip("torch")
+pytest.importorskip("julius")
+
+from demucs.apply import (BagOfModels, TensorChunk, _apply_chunks, apply_model,  # noqa
+                          apply_model_many, apply_model_stream)
+from demucs.demucs import Demucs  # noqa
+from demucs.parallel import ProcessPoolChunkExecutor  # noqa
+
+SAMPLERATE = 8000
+
+
+def _model(segment=1., seed=0):
+    th.manual_seed(seed)
+    model = Demucs(["drums", "bass"], channels=4, depth=2, samplerate=SAMPLERATE,
+                   segment=segment)
+    return model.eval()
+
+
+def _mix(duration, batch=1, seed=1):
+    generator = th.Generator().manual_seed(seed)
+    return th.randn(batch, 2, int(duration * SAMPLERATE), generator=generator)
+
+
+def _blocks(mix, seed=2):
+    """Split `mix` into blocks of random lengths, as read from a stream."""
+    rng = random.Random(seed)
+    offset = 0
+    while offset < mix.shape[-1]:
+        size = rng.randint(1, SAMPLERATE)
+        yield mix[..., offset:offset + size]
+        offset += size
+
+
+def test_batched_chunks_match_serial():
+    model = _model()
+    mix = _mix(3.7)
+    serial = apply_model(model, mix, shifts=0, batch_size=1)
+    for batch_size in [2, 8]:
+        batched = apply_model(model, mix, shifts=0, batch_size=batch_size)
+        assert th.allclose(serial, batched, atol=1e-5)
+    limited = apply_model(model, mix, shifts=0, batch_size=8, max_batch_samples=3 * SAMPLERATE)
+    assert th.allclose(serial, limited, atol=1e-5)
+
+
+def test_many_mixtures_match_apply_model():
+    model = _model()
+    mixes = [_mix(duration, seed=seed) for seed, duration in enumerate([0.7, 2.9, 1.6])]
+    separated = dict(apply_model_many(model, enumerate(mixes), shifts=1, seed=7, batch_size=4))
+    assert sorted(separated) == [0, 1, 2]
+    for index, mix in enumerate(mixes):
+        expected = apply_model(model, mix, shifts=1, seed=7)
+        assert th.allclose(separated[index], expected, atol=1e-5)
+
+
+@pytest.mark.parametrize("split", [True, False])
+def test_concurrent_bag_matches_weighted_sum(split):
+    models = [_model(seed=seed) for seed in range(3)]
+    # The second source has a total weight of 0 and must be left silent.
+    weights = [[1., 0.], [2., 0.], [0.5, 0.]]
+    bag = BagOfModels(models, weights)
+    mix = _mix(2.7)
+    outs = [apply_model(sub_model, mix, shifts=0, split=split) for sub_model in models]
+    expected = sum(weight[0] * out[:, :1] for weight, out in zip(weights, outs)) / 3.5
+    for num_workers in [0, 2]:
+        estimates = apply_model(bag, mix, shifts=0, split=split, num_workers=num_workers)
+        assert th.allclose(estimates[:, :1], expected, atol=1e-5)
+        assert (estimates[:, 1:] == 0).all()
+
+
+def _open_files():
+    return len(os.listdir("/proc/self/fd"))
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="Counts the open files in /proc.")
+def test_process_pool_matches_threads():
+    model = _model()
+    mix = _mix(3.3)
+    kwargs = {'shifts': 1, 'seed': 3, 'num_workers': 2, 'batch_size': 2}
+    expected = apply_model(model, mix, **kwargs)
+    # The first run moves the weights to shared memory, where they stay with the model,
+    # and starts the listener used to send file descriptors to the workers.
+    with ProcessPoolChunkExecutor(model, 2, threads=1) as pool:
+        separated = apply_model(model, mix.clone(), pool=pool, **kwargs)
+    assert th.allclose(separated, expected, atol=1e-5)
+
+    gc.collect()
+    before = _open_files()
+    with ProcessPoolChunkExecutor(model, 2, threads=1) as pool:
+        separated = apply_model(model, mix.clone(), pool=pool, **kwargs)
+    assert th.allclose(separated, expected, atol=1e-5)
+    del separated
+    gc.collect()
+    # The shared mixture and outputs are released, as well as the workers.
+    assert _open_files() <= before
+
+    with pytest.raises(RuntimeError):
+        with ProcessPoolChunkExecutor(model, 2, threads=1) as pool:
+            # The model expects stereo audio, the workers fail on a mono mixture.
+            apply_model(model, mix[:, :1].clone(), pool=pool, **kwargs)
+    gc.collect()
+    assert _open_files() <= before
+
+
+def test_batched_shifts_match_serial():
+    model = _model()
+    mix = _mix(2.5)
+    chunks = [TensorChunk(mix, 0, SAMPLERATE), TensorChunk(mix, SAMPLERATE // 2, SAMPLERATE)]
+    batched = _apply_chunks(model, chunks, 4, 'cpu', seeds=[1, 2])
+    serial = _apply_chunks(model, chunks, 4, 'cpu', seeds=[1, 2], max_views=1)
+    for batched_out, serial_out in zip(batched, serial):
+        assert th.allclose(batched_out, serial_out, atol=1e-5)
+
+
+def test_seeded_shifts():
+    model = _model()
+    mix = _mix(2.6)
+    first = apply_model(model, mix, shifts=3, seed=1234)
+    again = apply_model(model, mix, shifts=3, seed=1234, batch_size=4)
+    assert th.allclose(first, again, atol=1e-5)
+    other = apply_model(model, mix, shifts=3, seed=4321)
+    assert not th.allclose(first, other, atol=1e-5)
+    # Without splitting, the shifted views of the whole mixture are evaluated by groups.
+    whole = apply_model(model, mix, shifts=3, split=False, seed=1234, max_batch_samples=10**9)
+    grouped = apply_model(model, mix, shifts=3, split=False, seed=1234, max_batch_samples=1)
+    assert th.allclose(whole, grouped, atol=1e-5)
+
+
+@pytest.mark.parametrize("shifts", [0, 2])
+def test_stream_matches_apply_model(shifts):
+    model = _model()
+    mix = _mix(4.3)
+    expected = apply_model(model, mix, shifts=shifts, seed=42)
+    streamed = th.cat(list(apply_model_stream(model, _blocks(mix), shifts=shifts, seed=42)),
+                      dim=-1)
+    assert streamed.shape == expected.shape
+    assert th.allclose(streamed, expected, atol=1e-4)
+
+
+def test_stream_skips_the_same_silent_chunks():
+    model = _model()
+    mix = _mix(5.2)
+    mix[..., SAMPLERATE:4 * SAMPLERATE] = 0
+    kwargs = {'shifts': 1, 'seed': 42, 'silence_threshold': 1e-3}
+    expected = apply_model(model, mix, **kwargs)
+    # Only silent chunks cover the middle of the silence.
+    assert (expected[..., 2 * SAMPLERATE:3 * SAMPLERATE] == 0).all()
+    streamed = th.cat(list(apply_model_stream(model, _blocks(mix), **kwargs)), dim=-1)
+    assert th.allclose(streamed, expected, atol=1e-4)
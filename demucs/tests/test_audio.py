@@ -0,0 +1,97 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Decoding through ffmpeg pipes against torchaudio, and concurrent encoding of stems."""
+import shutil
+
+import pytest
+
+th = pytest.importorskip("torch")
+ta = pytest.importorskip("torchaudio")
+pytest.importorskip("julius")
+pytest.importorskip("lameenc")
+
+from demucs.audio import AudioFile, MP3Writer, StemWriter  # noqa
+
+SAMPLERATE = 8000
+
+
+@pytest.fixture
+def wav_file(tmp_path, monkeypatch):
+    if shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None:
+        pytest.skip("ffmpeg is not available.")
+    monkeypatch.setenv("DEMUCS_METADATA_CACHE", "")
+    generator = th.Generator().manual_seed(0)
+    wav = 0.1 * th.randn(2, int(2.7 * SAMPLERATE), generator=generator)
+    path = tmp_path / "track.wav"
+    ta.save(str(path), wav, SAMPLERATE, encoding="PCM_F")
+    return path, wav
+
+
+def test_read(wav_file):
+    path, wav = wav_file
+    audio = AudioFile(path)
+    assert audio.samplerate() == SAMPLERATE
+    assert audio.channels() == 2
+    assert len(audio) == 1
+    read = audio.read(streams=0)
+    assert read.shape == wav.shape
+    assert th.allclose(read, wav, atol=1e-6)
+    assert th.allclose(audio.read(streams=0, channels=1), wav.mean(0, keepdim=True), atol=1e-6)
+    # Reading all the streams adds a dimension.
+    assert audio.read().shape == (1,) + wav.shape
+
+    part = audio.read(seek_time=0.5, duration=1., streams=0)
+    assert part.shape == (2, SAMPLERATE)
+    start = SAMPLERATE // 2
+    assert th.allclose(part, wav[:, start:start + SAMPLERATE], atol=1e-6)
+
+
+def test_stream(wav_file):
+    path, wav = wav_file
+    audio = AudioFile(path)
+    blocks = list(audio.stream(1.))
+    sizes = [block.shape[-1] for block in blocks]
+    assert sizes == [SAMPLERATE, SAMPLERATE, wav.shape[-1] % SAMPLERATE]
+    assert th.allclose(th.cat(blocks, dim=-1), wav, atol=1e-6)
+
+    resampled = th.cat(list(audio.stream(0.5, samplerate=2 * SAMPLERATE, channels=1)), dim=-1)
+    assert th.allclose(resampled, audio.read(streams=0, samplerate=2 * SAMPLERATE, channels=1),
+                       atol=1e-6)
+
+
+def test_stem_writer(tmp_path):
+    generator = th.Generator().manual_seed(0)
+    stems = [0.1 * th.randn(2, SAMPLERATE, generator=generator) for _ in range(4)]
+    paths = [tmp_path / name for name in ["a.wav", "b.flac", "c.mp3", "d.wav"]]
+    with StemWriter(workers=2, max_pending=2, samplerate=SAMPLERATE, clip='clamp',
+                    preset='fast') as writer:
+        for stem, path in zip(stems, paths):
+            writer.save(stem, path, bits_per_sample=24 if path.suffix == ".flac" else 16)
+        writer.save(stems[0], tmp_path / "float.wav", as_float=True)
+    assert all(path.exists() for path in paths)
+    for stem, path in [(stems[0], paths[0]), (stems[1], paths[1])]:
+        wav, samplerate = ta.load(str(path))
+        assert samplerate == SAMPLERATE
+        assert th.allclose(wav, stem, atol=1e-4)
+    wav, _ = ta.load(str(tmp_path / "float.wav"))
+    assert th.equal(wav, stems[0])
+
+    # Errors of the encoding threads are raised by the writer.
+    with pytest.raises(ValueError):
+        with StemWriter(workers=2, samplerate=SAMPLERATE) as writer:
+            writer.save(stems[0], tmp_path / "stem.ogg")
+
+
+def test_mp3_writer_presets(tmp_path):
+    generator = th.Generator().manual_seed(0)
+    wav = 0.1 * th.randn(2, 2 * SAMPLERATE, generator=generator)
+    for preset in ["best", "fast"]:
+        path = tmp_path / f"{preset}.mp3"
+        writer = MP3Writer(path, SAMPLERATE, 2, bitrate=64, preset=preset)
+        for block in wav.split(SAMPLERATE // 3, dim=-1):
+            writer.write(block)
+        writer.close()
+        assert path.stat().st_size > 0
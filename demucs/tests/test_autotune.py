@@ -0,0 +1,59 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Autotuner trials and profiles."""
+import json
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("dora")
+
+from demucs import autotune  # noqa
+from demucs.apply import BagOfModels, set_segment  # noqa
+
+
+def test_profiles(tmp_path, monkeypatch):
+    path = tmp_path / "autotune.json"
+    assert autotune.load_profile("sig", path) is None
+    path.write_text("{")
+    assert autotune.load_profile("sig", path) is None
+
+    best = {"segment": None, "jobs": 2, "threads": 4, "batch_size": 4, "rtf": 0.1, "rss": 50.}
+    autotune.save_profile("sig", best, path)
+    autotune.save_profile("other", dict(best, overlap=0.1), path)
+    # Only the settings are returned, and the overlap only when it was tuned.
+    assert autotune.load_profile("sig", path) == {
+        "segment": None, "jobs": 2, "threads": 4, "batch_size": 4}
+    assert autotune.load_profile("other", path)["overlap"] == 0.1
+    assert autotune.load_profile("unknown", path) is None
+    assert not path.with_name(path.name + ".tmp").exists()
+
+    # Profiles are specific to a host.
+    monkeypatch.setattr(autotune, "_host", lambda: "elsewhere")
+    assert autotune.load_profile("sig", path) is None
+    autotune.save_profile("sig", best, path)
+    hosts = json.loads(path.read_text())
+    assert sorted(hosts) == sorted(["elsewhere", autotune.socket.gethostname()])
+
+
+def test_set_segment(model_repo):
+    from demucs.pretrained import get_model
+    models = [get_model("tiny", model_repo) for _ in range(2)]
+    bag = BagOfModels(models)
+    set_segment(bag, 0.5)
+    assert [model.segment for model in models] == [0.5, 0.5]
+    set_segment(models[0], 2.)
+    assert models[0].segment == 2.
+
+
+def test_benchmark(model_repo):
+    config = {"segment": 0.5, "overlap": 0.25, "jobs": 0, "threads": 1, "batch_size": 2}
+    result = autotune.benchmark("tiny", model_repo, config, duration=2., shifts=0)
+    assert result is not None
+    assert result["rtf"] > 0
+    assert result["rss"] > 0
+    # A failing trial is reported as None.
+    assert autotune.benchmark("missing", model_repo, config, duration=2., shifts=0) is None
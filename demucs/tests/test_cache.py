@@ -0,0 +1,91 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Hits and misses of the separation and metadata caches."""
+import os
+
+import pytest
+
+th = pytest.importorskip("torch")
+
+from demucs import cache as cache_module  # noqa
+from demucs.cache import MetadataCache, SeparationCache, cached_metadata  # noqa
+
+
+def test_separation_cache(tmp_path):
+    cache = SeparationCache(tmp_path)
+    mix = th.randn(2, 1000)
+    params = {'shifts': 1, 'overlap': 0.25, 'seed': 0, 'backend': 'eager', 'batch_size': 1}
+    key = cache.key(mix, "sig", **params)
+    assert cache.get(key) is None
+
+    sources = th.randn(4, 2, 1000)
+    cache.put(key, sources)
+    assert cache.key(mix.clone(), "sig", **params) == key
+    cached = cache.get(cache.key(mix.clone(), "sig", **params))
+    assert cached is not None
+    # Entries are stored as half precision.
+    assert th.allclose(cached, sources, atol=1e-2, rtol=1e-3)
+
+    # Any change in the mixture, model or parameters is a miss.
+    other = mix.clone()
+    other[0, 0] += 1
+    assert cache.get(cache.key(other, "sig", **params)) is None
+    assert cache.get(cache.key(mix, "other_sig", **params)) is None
+    for name, value in [('seed', 1), ('backend', 'SIG.onnx'), ('batch_size', 8)]:
+        assert cache.get(cache.key(mix, "sig", **dict(params, **{name: value}))) is None
+
+
+def test_separation_cache_eviction(tmp_path):
+    cache = SeparationCache(tmp_path)
+    keys = []
+    for index in range(3):
+        mix = th.full((2, 1000), float(index))
+        keys.append(cache.key(mix, "sig"))
+        cache.put(keys[-1], th.randn(4, 2, 1000))
+        # Distinct access times, as the filesystem resolution could be too coarse.
+        os.utime(cache._path(keys[-1]), (index + 1, index + 1))
+    size = sum(path.stat().st_size for path in tmp_path.glob("*/*.th"))
+    # Only keep about two entries, the oldest is removed first.
+    cache.evict(size * 2 // 3 + 1)
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[2]) is not None
+
+
+def test_metadata_cache(tmp_path):
+    cache = MetadataCache(tmp_path / "metadata.sqlite")
+    file = tmp_path / "track.mp3"
+    file.write_bytes(b"abc")
+    calls = []
+
+    def compute():
+        calls.append(file)
+        return {"length": len(calls)}
+
+    assert cache.cached(file, "info", compute) == {"length": 1}
+    assert cache.cached(file, "info", compute) == {"length": 1}
+    assert len(calls) == 1
+    assert cache.get(file, "stats") is None
+
+    # A modified file is a miss.
+    file.write_bytes(b"abcd")
+    assert cache.get(file, "info") is None
+    assert cache.cached(file, "info", compute) == {"length": 2}
+    reopened = MetadataCache(tmp_path / "metadata.sqlite")
+    assert reopened.get(file, "info") == {"length": 2}
+
+
+@pytest.mark.parametrize("enabled", [True, False])
+def test_cached_metadata(tmp_path, monkeypatch, enabled):
+    monkeypatch.setattr(cache_module, "_metadata_cache", None)
+    monkeypatch.setattr(cache_module, "_metadata_pid", None)
+    monkeypatch.setattr(cache_module, "_metadata_path",
+                        tmp_path / "metadata.sqlite" if enabled else None)
+    file = tmp_path / "track.mp3"
+    file.write_bytes(b"abc")
+    calls = []
+    for _ in range(2):
+        cached_metadata(file, "info", lambda: calls.append(file) or len(calls))
+    assert len(calls) == (1 if enabled else 2)
@@ -0,0 +1,94 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Incremental scans and exports of the dataset catalog of the util scripts."""
+import csv
+import importlib
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+lameenc = pytest.importorskip("lameenc")
+pytest.importorskip("mutagen")
+
+UTIL_SCRIPTS = Path(__file__).resolve().parent.parent / "util_scripts"
+SAMPLERATE = 44100
+
+
+@pytest.fixture
+def dataset_catalog(monkeypatch):
+    # Also importable by name from the scanning processes.
+    monkeypatch.syspath_prepend(str(UTIL_SCRIPTS))
+    return importlib.import_module("dataset_catalog")
+
+
+def _write_mp3(path, duration):
+    encoder = lameenc.Encoder()
+    encoder.set_bit_rate(128)
+    encoder.set_in_sample_rate(SAMPLERATE)
+    encoder.set_channels(2)
+    encoder.silence()
+    rng = np.random.RandomState(len(path.name))
+    wav = (rng.randn(int(duration * SAMPLERATE), 2) * 1000).astype(np.int16)
+    path.write_bytes(encoder.encode(wav.tobytes()) + encoder.flush())
+
+
+def _originals(folder, stems, tracks):
+    (folder / "originals").mkdir(parents=True)
+    (folder / "stems").mkdir()
+    for name, duration in tracks.items():
+        _write_mp3(folder / "originals" / f"{name}.mp3", duration)
+        for stem in stems:
+            _write_mp3(folder / "stems" / f"{name}-{stem}.mp3", duration)
+
+
+def test_scan(tmp_path, capsys, dataset_catalog):
+    folder = tmp_path / "songs"
+    _originals(folder, dataset_catalog.STEMS, {"b_artist-song": 2., "a_artist-other": 1.})
+    catalog = dataset_catalog.Catalog(tmp_path / "catalog.sqlite")
+    catalog.scan(folder, workers=2)
+    assert "probing 12 files" in capsys.readouterr().out
+    tracks = list(catalog.tracks(folder))
+    assert [track["artist"] for track in tracks] == ["a_artist", "b_artist"]
+    assert [track["title"] for track in tracks] == ["other", "song"]
+    assert [round(length) for _, length in catalog.durations()] == [1, 2]
+    assert all(track["sample_rate"] == SAMPLERATE and track["channels"] == 2
+               for track in tracks)
+
+    # Unchanged files are not read again.
+    catalog.scan(folder, workers=2)
+    assert "probing 0 files" in capsys.readouterr().out
+
+    # Modified files are probed again, and removed tracks and files are dropped.
+    _write_mp3(folder / "originals" / "a_artist-other.mp3", 3.)
+    (folder / "stems" / "b_artist-song-drums.mp3").unlink()
+    catalog.scan(folder, workers=2)
+    assert "probing 1 files" in capsys.readouterr().out
+    tracks = list(catalog.tracks(folder))
+    assert [track["title"] for track in tracks] == ["other"]
+    assert round(tracks[0]["length"]) == 3
+    files = [path for path, in catalog.db.execute("SELECT path FROM files")]
+    assert len(files) == 6
+    assert not any("b_artist" in path for path in files)
+
+
+def test_export_csv(tmp_path, dataset_catalog):
+    folder = tmp_path / "songs"
+    _originals(folder, dataset_catalog.STEMS, {"x-1": 1., "y-2": 1., "z-3": 1.})
+    catalog = dataset_catalog.Catalog(tmp_path / "catalog.sqlite")
+    catalog.scan(folder, workers=1)
+    originals = folder.resolve() / "originals"
+    order = [originals / name for name in ["y-2.mp3", "z-3.mp3", "x-1.mp3"]]
+    out = tmp_path / "dataset_info.csv"
+    catalog.export_csv(out, folder, order=order)
+    with open(out, newline="", encoding="utf-8") as file:
+        rows = list(csv.DictReader(file))
+    assert [row["original"] for row in rows] == [str(path) for path in order]
+    assert [row["artist"] for row in rows] == ["y", "z", "x"]
+    for row in rows:
+        name = Path(row["original"]).stem
+        for stem in dataset_catalog.STEMS:
+            assert row[stem] == str(folder.resolve() / "stems" / f"{name}-{stem}.mp3")
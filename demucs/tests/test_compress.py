@@ -0,0 +1,47 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Low-rank compression must keep the outputs of the model when no energy is lost."""
+import pytest
+
+th = pytest.importorskip("torch")
+pytest.importorskip("julius")
+
+from demucs.compress import _factorizable, compress_model, get_lowrank_structure  # noqa
+from demucs.demucs import Demucs  # noqa
+from demucs.svd import low_rank  # noqa
+
+RANK = 2
+
+
+def _low_rank_model():
+    """Model whose factorizable convolutions have weights of rank `RANK`, so that
+    compressing them at that rank does not lose anything."""
+    th.manual_seed(0)
+    model = Demucs(["drums", "bass"], channels=8, depth=2, samplerate=8000, segment=1.)
+    for module in model.modules():
+        if _factorizable(module, 0):
+            weight = module.weight.data
+            rows = weight.shape[0]
+            left, right = low_rank(weight.reshape(rows, -1), RANK)
+            module.weight.data[:] = (left @ right).view_as(weight)
+    return model.eval()
+
+
+@pytest.mark.parametrize("params", [{'rank': RANK}, {'energy': 1 - 1e-6}])
+def test_compress_model_keeps_outputs(params):
+    model = _low_rank_model()
+    compressed = compress_model(model, min_size=0, **params)
+    structure = get_lowrank_structure(compressed)
+    assert structure
+    assert all(rank <= RANK for rank in structure.values())
+    # The original model is left untouched.
+    assert not get_lowrank_structure(model)
+
+    mix = th.randn(1, 2, model.valid_length(8000))
+    with th.no_grad():
+        expected = model(mix)
+        actual = compressed(mix)
+    assert th.allclose(expected, actual, atol=1e-4, rtol=1e-3)
@@ -0,0 +1,89 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Optimized layers of Demucs against straightforward implementations."""
+import pytest
+
+th = pytest.importorskip("torch")
+pytest.importorskip("julius")
+
+from demucs.demucs import BLSTM, LocalState  # noqa
+from demucs.utils import unfold  # noqa
+
+
+def _masked_attention(module, x, window):
+    """Full attention of `LocalState`, with the keys further than `window` masked."""
+    B, C, T = x.shape
+    heads = module.heads
+    indexes = th.arange(T)
+    delta = indexes[:, None] - indexes[None, :]
+    queries = module.query(x).view(B, heads, -1, T)
+    keys = module.key(x).view(B, heads, -1, T)
+    dots = th.einsum("bhct,bhcs->bhts", keys, queries) / keys.shape[2]**0.5
+    decays = th.arange(1, module.ndecay + 1, dtype=x.dtype)
+    decay_kernel = - decays.view(-1, 1, 1) * delta.abs() / module.ndecay**0.5
+    decay_q = th.sigmoid(module.query_decay(x).view(B, heads, -1, T)) / 2
+    dots += th.einsum("fts,bhfs->bhts", decay_kernel, decay_q)
+    dots.masked_fill_(delta.abs() > window, -float('inf'))
+    dots.masked_fill_(delta == 0, -100)
+    weights = th.softmax(dots, dim=2)
+    content = module.content(x).view(B, heads, -1, T)
+    result = th.einsum("bhts,bhct->bhcs", weights, content).reshape(B, -1, T)
+    return x + module.proj(result)
+
+
+@pytest.mark.parametrize("nfreqs", [0, 4])
+def test_banded_local_state_full_window(nfreqs):
+    th.manual_seed(0)
+    module = LocalState(16, heads=4, nfreqs=nfreqs).eval()
+    x = th.randn(2, 16, 101)
+    with th.no_grad():
+        dense = module(x)
+        # A window covering all the pairs of positions gives the full attention.
+        module.window = x.shape[-1] - 1
+        banded = module(x)
+    assert th.allclose(dense, banded, atol=1e-4)
+
+
+@pytest.mark.parametrize("window", [7, 16, 50])
+def test_banded_local_state(window):
+    th.manual_seed(0)
+    module = LocalState(16, heads=4, window=window).eval()
+    x = th.randn(2, 16, 101)
+    with th.no_grad():
+        assert th.allclose(module(x), _masked_attention(module, x, window), atol=1e-4)
+
+
+def _loop_blstm(blstm, x):
+    """`BLSTM` with the previous reassembly of the overlapping frames, one slice per frame."""
+    B, C, T = x.shape
+    width = blstm.max_steps
+    stride = width // 2
+    frames = unfold(x, width, stride)
+    nframes = frames.shape[2]
+    y = frames.permute(0, 2, 1, 3).reshape(-1, C, width).permute(2, 0, 1)
+    y = blstm.linear(blstm.lstm(y)[0]).permute(1, 2, 0)
+    frames = y.reshape(B, nframes, C, width)
+    limit = stride // 2
+    out = []
+    for k in range(nframes):
+        if k == 0:
+            out.append(frames[:, k, :, :-limit])
+        elif k == nframes - 1:
+            out.append(frames[:, k, :, limit:])
+        else:
+            out.append(frames[:, k, :, limit:-limit])
+    out = th.cat(out, -1)[..., :T]
+    return out + x if blstm.skip else out
+
+
+@pytest.mark.parametrize("length", [21, 40, 97, 200])
+@pytest.mark.parametrize("skip", [False, True])
+def test_blstm_reassembly(length, skip):
+    th.manual_seed(0)
+    blstm = BLSTM(8, layers=2, max_steps=20, skip=skip).eval()
+    x = th.randn(3, 8, length)
+    with th.no_grad():
+        assert th.allclose(blstm(x), _loop_blstm(blstm, x), atol=1e-6)
@@ -0,0 +1,74 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Exported graphs must give the same results as the eager model."""
+import pytest
+
+th = pytest.importorskip("torch")
+pytest.importorskip("julius")
+
+from demucs.apply import BagOfModels, apply_model  # noqa
+from demucs.demucs import Demucs  # noqa
+from demucs.export import (OnnxModel, export_onnx, export_torchscript, load_exported,  # noqa
+                           load_onnx, load_traced)
+
+SAMPLERATE = 8000
+
+
+def _model():
+    th.manual_seed(0)
+    model = Demucs(["drums", "bass"], channels=4, depth=2, samplerate=SAMPLERATE, segment=1.)
+    return model.eval()
+
+
+def _mix(duration):
+    generator = th.Generator().manual_seed(1)
+    return th.randn(1, 2, int(duration * SAMPLERATE), generator=generator)
+
+
+@pytest.mark.parametrize("shifts", [0, 1])
+def test_torchscript_matches_eager(tmp_path, shifts):
+    model = _model()
+    path = tmp_path / "tiny.ts"
+    export_torchscript(model, path, shifts=bool(shifts), batch_size=2)
+    traced = load_traced(path, eager=model)
+    assert traced.sources == model.sources
+    assert traced.segment == model.segment
+    # The last chunk is shorter and goes through the eager model.
+    mix = _mix(3.6)
+    kwargs = {'shifts': shifts, 'seed': 0, 'batch_size': 3}
+    expected = apply_model(model, mix, **kwargs)
+    assert th.allclose(apply_model(traced, mix, **kwargs), expected, atol=1e-4)
+    assert th.allclose(apply_model(load_exported(path, model), mix, **kwargs), expected,
+                       atol=1e-4)
+
+    # Without the eager model, the shorter chunks are padded to the traced shape.
+    alone = load_traced(path)
+    estimates = apply_model(alone, mix, **kwargs)
+    assert estimates.shape == expected.shape
+    full = int(3 * SAMPLERATE)
+    assert th.allclose(estimates[..., :SAMPLERATE // 2], expected[..., :SAMPLERATE // 2],
+                       atol=1e-4)
+    assert th.isfinite(estimates[..., full:]).all()
+
+
+def test_export_bag(tmp_path):
+    with pytest.raises(ValueError):
+        export_torchscript(BagOfModels([_model()]), tmp_path / "bag.ts")
+
+
+def test_onnx_matches_eager(tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    model = _model()
+    path = tmp_path / "tiny.onnx"
+    export_onnx(model, path, shifts=True, batch_size=2)
+    exported = load_onnx(path, eager=model, threads=1)
+    assert exported.sources == model.sources
+    assert isinstance(load_exported(path, model), OnnxModel)
+    mix = _mix(3.6)
+    kwargs = {'shifts': 1, 'seed': 0, 'batch_size': 3}
+    expected = apply_model(model, mix, **kwargs)
+    assert th.allclose(apply_model(exported, mix, **kwargs), expected, atol=1e-4)
@@ -0,0 +1,119 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Fast dataset access paths against a full decoding of the files."""
+import math
+
+import pytest
+
+th = pytest.importorskip("torch")
+ta = pytest.importorskip("torchaudio")
+pytest.importorskip("julius")
+pytest.importorskip("lameenc")
+
+from demucs.audio import encode_mp3  # noqa
+from demucs.mp3 import Mp3set, ShardSet, build_metadata, materialize  # noqa
+from demucs.mp3index import build_index, load_segment  # noqa
+
+SAMPLERATE = 44100
+
+
+@pytest.fixture
+def mp3_file(tmp_path):
+    generator = th.Generator().manual_seed(0)
+    time = th.arange(10 * SAMPLERATE) / SAMPLERATE
+    wav = 0.3 * th.sin(2 * math.pi * 440 * time) + 0.05 * th.randn(2, len(time),
+                                                                   generator=generator)
+    path = tmp_path / "track.mp3"
+    encode_mp3(wav, path, SAMPLERATE, bitrate=128)
+    try:
+        full, _ = ta.load(str(path))
+    except RuntimeError:
+        pytest.skip("torchaudio cannot decode mp3 files.")
+    return path, full
+
+
+def test_frame_index_seek(mp3_file):
+    path, full = mp3_file
+    index = build_index(path, stride=8)
+    assert index["samplerate"] == SAMPLERATE
+    assert index["channels"] == 2
+    assert index["frames"] * index["samples_per_frame"] >= full.shape[-1]
+    length = full.shape[-1]
+    for offset in [0, 1, 1151, 1152 * 8 + 17, length // 2, length - 5000]:
+        for num_frames in [1000, SAMPLERATE]:
+            num_frames = min(num_frames, length - offset)
+            segment, samplerate = load_segment(path, index, offset, num_frames)
+            expected = full[..., offset:offset + num_frames]
+            assert samplerate == SAMPLERATE
+            assert segment.shape == expected.shape
+            assert th.allclose(segment, expected, atol=1e-4)
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int16"])
+def test_shards_match_mp3set(tmp_path, monkeypatch, dtype):
+    # Also applies to the metadata workers, which are spawned.
+    monkeypatch.setenv("DEMUCS_METADATA_CACHE", "")
+    samplerate = 8000
+    sources = ["drums", "bass"]
+    root = tmp_path / "train"
+    generator = th.Generator().manual_seed(0)
+    for index, duration in enumerate([2.3, 0.6, 3.1]):
+        track = root / f"track{index}"
+        track.mkdir(parents=True)
+        for source in sources + ["mixture"]:
+            wav = 0.1 * th.randn(2, int(duration * samplerate), generator=generator)
+            ta.save(str(track / f"{source}.wav"), wav, samplerate)
+    metadata = build_metadata(root, sources, normalize=False, ext=".wav", workers=1)
+    dataset = Mp3set(root, metadata, sources, segment=1., shift=0.5, normalize=False,
+                     samplerate=samplerate, channels=2, ext=".wav")
+    materialize(dataset, tmp_path / "shards", dtype, workers=1)
+    shards = ShardSet(tmp_path / "shards", segment=1., shift=0.5, normalize=False)
+    assert len(shards) == len(dataset)
+    for index in range(len(dataset)):
+        example = dataset[index]
+        assert shards[index].shape == example.shape
+        assert th.allclose(shards[index], example, atol=1e-3)
+
+
+def test_incremental_metadata(tmp_path, monkeypatch):
+    monkeypatch.setenv("DEMUCS_METADATA_CACHE", "")
+    samplerate = 8000
+    sources = ["drums", "bass"]
+    root = tmp_path / "train"
+    generator = th.Generator().manual_seed(0)
+    for index in range(3):
+        track = root / f"track{index}"
+        track.mkdir(parents=True)
+        for source in sources + ["mixture"]:
+            wav = 0.1 * th.randn(2, samplerate, generator=generator)
+            ta.save(str(track / f"{source}.wav"), wav, samplerate)
+    metadata = build_metadata(root, sources, ext=".wav", workers=2)
+    for name, meta in metadata.items():
+        # Same decoder as the examples of `Mp3set`.
+        mono = ta.load(str(root / name / "mixture.wav"))[0].mean(0)
+        assert meta["mean"] == pytest.approx(mono.mean().item(), abs=1e-6)
+        assert meta["std"] == pytest.approx(mono.std().item(), rel=1e-5)
+
+    import concurrent.futures
+    pools = []
+
+    class Pool(concurrent.futures.ProcessPoolExecutor):
+        def __init__(self, max_workers=None, **kwargs):
+            pools.append(max_workers)
+            super().__init__(max_workers, **kwargs)
+
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", Pool)
+    # No process is started when nothing changed.
+    assert build_metadata(root, sources, ext=".wav", previous=metadata) == metadata
+    assert pools == []
+
+    wav = 0.2 * th.randn(2, 2 * samplerate, generator=generator)
+    for source in sources + ["mixture"]:
+        ta.save(str(root / "track1" / f"{source}.wav"), wav, samplerate)
+    updated = build_metadata(root, sources, ext=".wav", previous=metadata)
+    assert pools == [1]
+    assert updated["track1"]["length"] == 2 * samplerate
+    assert updated["track0"] == metadata["track0"]
@@ -0,0 +1,73 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Quantized models must stay close to the float model."""
+import pytest
+
+th = pytest.importorskip("torch")
+pytest.importorskip("julius")
+pytest.importorskip("museval")
+pytest.importorskip("dora")
+
+from demucs.apply import BagOfModels  # noqa
+from demucs.demucs import Demucs  # noqa
+from demucs.evaluate import compare_models  # noqa
+from demucs.quantize import PointwiseLinear, quantize_model  # noqa
+
+SAMPLERATE = 8000
+
+
+def _model(seed=0):
+    th.manual_seed(seed)
+    model = Demucs(["drums", "bass"], channels=8, depth=2, samplerate=SAMPLERATE, segment=1.)
+    return model.eval()
+
+
+def _mix(duration, seed=1):
+    generator = th.Generator().manual_seed(seed)
+    return 0.1 * th.randn(2, int(duration * SAMPLERATE), generator=generator)
+
+
+def _quantized_engine():
+    if not th.backends.quantized.supported_engines:
+        pytest.skip("No quantized engine available.")
+
+
+def test_dynamic_quantization_matches_float():
+    _quantized_engine()
+    model = _model()
+    quantized = quantize_model(model)
+    assert any(isinstance(module, PointwiseLinear) for module in quantized.modules())
+    # The original model is left untouched.
+    assert not any(isinstance(module, PointwiseLinear) for module in model.modules())
+    mix = _mix(2.5)
+    check = compare_models(model, quantized, mix, shifts=0)
+    assert check['time'] > 0 and check['reference_time'] > 0
+    assert min(check['nsdr']) > 20
+
+    references = th.randn(len(model.sources), 2, mix.shape[-1])
+    check = compare_models(model, quantized, mix, references=references, shifts=0)
+    assert len(check['nsdr_truth']) == len(model.sources)
+    for truth, reference_truth in zip(check['nsdr_truth'], check['reference_nsdr_truth']):
+        assert truth == pytest.approx(reference_truth, abs=0.5)
+
+
+def test_static_quantization_matches_float():
+    _quantized_engine()
+    model = _model()
+    quantized = quantize_model(model, calibration=[_mix(2., seed=seed) for seed in range(3)])
+    check = compare_models(model, quantized, _mix(2.5), shifts=0)
+    assert min(check['nsdr']) > 10
+
+
+def test_quantize_bag():
+    _quantized_engine()
+    bag = BagOfModels([_model(0), _model(1)], [[1., 2.], [3., 4.]])
+    quantized = quantize_model(bag)
+    assert isinstance(quantized, BagOfModels)
+    assert quantized.weights == bag.weights
+    assert len(quantized.models) == 2
+    with pytest.raises(ValueError):
+        quantize_model(bag, 'int4')
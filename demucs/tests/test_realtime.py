@@ -0,0 +1,71 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Output length, latency and content of the incremental real-time separation."""
+import random
+
+import pytest
+
+th = pytest.importorskip("torch")
+pytest.importorskip("julius")
+
+from demucs.apply import apply_model  # noqa
+from demucs.demucs import Demucs  # noqa
+from demucs.realtime import RealtimeSeparator  # noqa
+
+SAMPLERATE = 8000
+
+
+def _model():
+    th.manual_seed(0)
+    model = Demucs(["drums", "bass"], channels=4, depth=2, samplerate=SAMPLERATE, segment=1.)
+    return model.eval()
+
+
+def test_realtime_length_and_latency():
+    model = _model()
+    separator = RealtimeSeparator(model, hop=0.25, lookahead=0.125, context=0.5)
+    assert separator.latency == pytest.approx(0.375)
+    hop = separator.hop
+    lookahead = separator.lookahead
+    generator = th.Generator().manual_seed(1)
+    mix = th.randn(2, int(3.3 * SAMPLERATE), generator=generator)
+    rng = random.Random(2)
+    received = 0
+    emitted = 0
+    while received < mix.shape[-1]:
+        size = rng.randint(1, SAMPLERATE // 3)
+        block = mix[:, received:received + size]
+        received += block.shape[-1]
+        out = separator.push(block)
+        assert out.shape[:2] == (len(model.sources), model.audio_channels)
+        assert out.shape[-1] % hop == 0
+        emitted += out.shape[-1]
+        # Every hop is emitted as soon as its lookahead is available.
+        assert emitted == max(0, (received - lookahead) // hop) * hop
+        assert received - emitted < hop + lookahead
+    emitted += separator.flush().shape[-1]
+    assert emitted == mix.shape[-1]
+    assert separator.rtf > 0
+
+
+def test_realtime_matches_window():
+    model = _model()
+    mean, std = 0.1, 2.
+    separator = RealtimeSeparator(model, hop=0.25, lookahead=0.125, context=0.5,
+                                  mean=mean, std=std)
+    generator = th.Generator().manual_seed(1)
+    mix = th.randn(2, 2 * SAMPLERATE, generator=generator)
+    out = th.cat([separator.push(mix), separator.flush()], dim=-1)
+    assert out.shape[-1] == mix.shape[-1]
+
+    # Each hop is the separation of its window, the stream starting with silence.
+    context, hop, lookahead = separator.context, separator.hop, separator.lookahead
+    padded = th.cat([th.zeros(2, context), mix], dim=-1)
+    for index in [0, 3]:
+        window = padded[:, index * hop:index * hop + context + hop + lookahead]
+        expected = apply_model(model, ((window - mean) / std)[None], shifts=0, split=False)[0]
+        expected = expected[..., context:context + hop] * std + mean
+        assert th.allclose(out[..., index * hop:(index + 1) * hop], expected, atol=1e-5)
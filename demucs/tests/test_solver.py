@@ -0,0 +1,57 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Losses of the training loop, shared by the ground truth and the distillation targets."""
+import pytest
+
+th = pytest.importorskip("torch")
+pytest.importorskip("julius")
+pytest.importorskip("dora")
+pytest.importorskip("museval")
+omegaconf = pytest.importorskip("omegaconf")
+
+from demucs.solver import Solver  # noqa
+
+
+def _solver(loss):
+    # `_loss` only depends on the arguments of the solver.
+    solver = Solver.__new__(Solver)
+    solver.args = omegaconf.OmegaConf.create({'optim': {'loss': loss}})
+    return solver
+
+
+def _estimate_target():
+    generator = th.Generator().manual_seed(0)
+    estimate = th.randn(3, 4, 2, 100, generator=generator)
+    target = th.randn(3, 4, 2, 100, generator=generator)
+    return estimate, target
+
+
+def test_l1_loss():
+    estimate, target = _estimate_target()
+    loss, reco = _solver('l1')._loss(estimate, target)
+    assert loss.shape == (4,)
+    expected = (estimate - target).abs().mean(dim=(0, 2, 3))
+    assert th.allclose(loss, expected, atol=1e-6)
+    assert th.allclose(reco, expected, atol=1e-6)
+    # A student matching its teacher has no distillation loss.
+    loss, _ = _solver('l1')._loss(estimate, estimate.clone())
+    assert (loss == 0).all()
+
+
+def test_mse_loss():
+    estimate, target = _estimate_target()
+    loss, reco = _solver('mse')._loss(estimate, target)
+    # The mse is kept for each item of the batch, the reconstruction error is averaged.
+    assert loss.shape == (3, 4)
+    expected = (estimate - target).square().mean(dim=(2, 3))
+    assert th.allclose(loss, expected, atol=1e-6)
+    assert th.allclose(reco, expected.sqrt().mean(0), atol=1e-6)
+
+
+def test_invalid_loss():
+    estimate, target = _estimate_target()
+    with pytest.raises(ValueError, match="huber"):
+        _solver('huber')._loss(estimate, target)
@@ -0,0 +1,93 @@
+"""
+    File:           benchmark_blstm.py
+    Description:    Compares the reassembly of the overlapping frames in BLSTM with the
+                    previous loop based implementation, for chunk lengths matching the usual
+                    segment sizes, and checks that both give the same output.
+
+    Usage:          python util_scripts/benchmark_blstm.py [--channels 48] [--max-steps 200]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from demucs.demucs import BLSTM  # noqa
+from demucs.utils import unfold  # noqa
+
+
+def loop_reassembly(x, B, C, T, width, nframes):
+    """Previous implementation, with one slice per frame."""
+    stride = width // 2
+    out = []
+    frames = x.reshape(B, -1, C, width)
+    limit = stride // 2
+    for k in range(nframes):
+        if k == 0:
+            out.append(frames[:, k, :, :-limit])
+        elif k == nframes - 1:
+            out.append(frames[:, k, :, limit:])
+        else:
+            out.append(frames[:, k, :, limit:-limit])
+    return torch.cat(out, -1)[..., :T]
+
+
+def vectorized_reassembly(x, B, C, T, width, nframes):
+    stride = width // 2
+    frames = x.reshape(B, nframes, C, width)
+    limit = stride // 2
+    center = frames[..., limit:limit + stride].permute(0, 2, 1, 3)
+    center = center.reshape(B, C, nframes * stride)
+    out = torch.cat([frames[:, 0, :, :limit], center, frames[:, -1, :, limit + stride:]], -1)
+    return out[..., :T]
+
+
+def timeit(func, repeat):
+    func()
+    begin = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - begin) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=48)
+    parser.add_argument("--max-steps", type=int, default=200)
+    parser.add_argument("--samplerate", type=int, default=44100)
+    parser.add_argument("--segments", type=float, nargs="+", default=[8, 10, 40],
+                        help="Segment lengths in seconds.")
+    parser.add_argument("--strides", type=int, nargs="+", default=[4, 16, 64],
+                        help="Total stride of the DConv layers for which to benchmark.")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    blstm = BLSTM(args.channels, layers=2, max_steps=args.max_steps, skip=True).eval()
+    width = args.max_steps
+    print(f"{'segment':>8} {'T':>8} {'frames':>7} {'loop (ms)':>10} {'vector (ms)':>12} "
+          f"{'BLSTM (ms)':>11}")
+    for segment in args.segments:
+        for total_stride in args.strides:
+            # Resampling doubles the number of time steps in Demucs.
+            T = int(2 * segment * args.samplerate / total_stride)
+            if T <= width:
+                continue
+            B, C = 1, args.channels
+            nframes = unfold(torch.zeros(B, C, T), width, width // 2).shape[2]
+            x = torch.randn(B * nframes, C, width)
+            expected = loop_reassembly(x, B, C, T, width, nframes)
+            assert torch.equal(expected, vectorized_reassembly(x, B, C, T, width, nframes))
+            loop = timeit(lambda: loop_reassembly(x, B, C, T, width, nframes), args.repeat)
+            vector = timeit(lambda: vectorized_reassembly(x, B, C, T, width, nframes),
+                            args.repeat)
+            with torch.no_grad():
+                full = timeit(lambda: blstm(torch.randn(B, C, T)), max(1, args.repeat // 10))
+            print(f"{segment:>8} {T:>8} {nframes:>7} {loop * 1000:>10.2f} "
+                  f"{vector * 1000:>12.2f} {full * 1000:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
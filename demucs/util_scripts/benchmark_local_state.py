@@ -0,0 +1,68 @@
+"""
+    File:           benchmark_local_state.py
+    Description:    Checks that the banded LocalState attention matches the full attention
+                    when the window covers the whole input, then compares the speed of both
+                    modes for increasing input lengths.
+
+    Usage:          python util_scripts/benchmark_local_state.py [--channels 192] [--window 256]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from demucs.demucs import LocalState  # noqa
+
+
+def timeit(module, x, repeat):
+    with torch.no_grad():
+        module(x)
+        begin = time.time()
+        for _ in range(repeat):
+            module(x)
+    return (time.time() - begin) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=192)
+    parser.add_argument("--heads", type=int, default=4)
+    parser.add_argument("--nfreqs", type=int, default=0)
+    parser.add_argument("--window", type=int, default=256)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[512, 1024, 2048, 4096])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    module = LocalState(args.channels, heads=args.heads, nfreqs=args.nfreqs).eval()
+
+    # Parity: with a window covering all the pairs of positions, both modes are the same.
+    x = torch.randn(2, args.channels, 301)
+    with torch.no_grad():
+        module.window = None
+        exact = module(x)
+        module.window = x.shape[-1] - 1
+        banded = module(x)
+    error = (exact - banded).abs().max().item()
+    print(f"Max difference with a full window: {error:.2e}")
+    assert error < 1e-4, error
+
+    print(f"{'length':>8} {'full (ms)':>10} {'banded (ms)':>12} {'max diff':>10}")
+    for length in args.lengths:
+        x = torch.randn(1, args.channels, length)
+        module.window = None
+        full = timeit(module, x, args.repeat)
+        with torch.no_grad():
+            exact = module(x)
+        module.window = args.window
+        banded = timeit(module, x, args.repeat)
+        with torch.no_grad():
+            error = (module(x) - exact).abs().max().item()
+        print(f"{length:>8} {full * 1000:>10.1f} {banded * 1000:>12.1f} {error:>10.2e}")
+
+
+if __name__ == "__main__":
+    main()
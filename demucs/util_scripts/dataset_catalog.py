@@ -0,0 +1,220 @@
+# -----------------------------------------------------------
+# catalog of the songs dataset, stored in a SQLite database
+#
+# The originals/stems tree (or a remix dataset, with one folder
+# per track containing mixture.mp3 and the stems) is scanned once,
+# in parallel, opening each mp3 only once. Files are only read again
+# when their size or modification time change. The CSV export,
+# duration statistics and Mp3set metadata are then queries.
+#
+# Usage:
+#   python dataset_catalog.py scan FOLDER [--db catalog.sqlite]
+#   python dataset_catalog.py csv -o dataset_info.csv
+#   python dataset_catalog.py duration [FOLDER]
+#   python dataset_catalog.py metadata ROOT -o metadata.json
+#
+# The metadata command uses the demucs package, run it from the
+# demucs folder with: PYTHONPATH=. python util_scripts/dataset_catalog.py
+# -----------------------------------------------------------
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from mutagen.mp3 import MP3
+
+ORIGINALS_LOC = "originals"
+STEMS_LOC = "stems"
+MIXTURE = "mixture"
+STEMS = ["bass", "drums", "vocals", "guitars", "other"]
+DEFAULT_DB = "catalog.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER,
+    length REAL, bitrate INTEGER, sample_rate INTEGER, channels INTEGER);
+CREATE TABLE IF NOT EXISTS tracks (
+    name TEXT PRIMARY KEY, folder TEXT, layout TEXT,
+    original TEXT, artist TEXT, title TEXT, stems TEXT);
+CREATE TABLE IF NOT EXISTS mp3set (
+    root TEXT, name TEXT, meta TEXT, PRIMARY KEY (root, name));
+"""
+
+
+def probe(path):
+    """Open the mp3 once and return all its attributes."""
+    info = MP3(path).info
+    return {"length": info.length, "bitrate": info.bitrate // 1000,
+            "sample_rate": info.sample_rate, "channels": info.channels}
+
+
+def find_originals(folder):
+    """Tracks of an originals/stems tree, stems are named `{original}-{stem}.mp3`."""
+    originals_dir = folder / ORIGINALS_LOC
+    stems_dir = folder / STEMS_LOC
+    for original in sorted(originals_dir.glob("*.mp3")):
+        without_ext = original.stem
+        stems = {stem: stems_dir / f"{without_ext}-{stem}.mp3" for stem in STEMS}
+        missing = [stem for stem, path in stems.items() if not path.is_file()]
+        if missing:
+            print("No %s stem for file %s" % (missing[0], original.name))
+            continue
+        parts = without_ext.split("-")
+        yield {"name": str(original), "folder": str(folder), "layout": "originals",
+               "original": str(original), "artist": parts[0],
+               "title": parts[1] if len(parts) > 1 else "",
+               "stems": {stem: str(path) for stem, path in stems.items()}}
+
+
+def find_remixes(folder):
+    """Tracks of a remix dataset, one folder per track with the mixture and the stems."""
+    for mixture in sorted(folder.rglob(f"{MIXTURE}.mp3")):
+        track = mixture.parent
+        stems = {path.stem: str(path) for path in sorted(track.glob("*.mp3"))
+                 if path.stem != MIXTURE}
+        yield {"name": str(track), "folder": str(folder), "layout": "remix",
+               "original": str(mixture), "artist": "", "title": track.name, "stems": stems}
+
+
+class Catalog:
+    def __init__(self, path=DEFAULT_DB):
+        self.db = sqlite3.connect(str(path))
+        self.db.executescript(SCHEMA)
+
+    def scan(self, folder, workers=None):
+        """Add the tracks found in `folder` to the catalog, probing only the new
+        or modified files. Tracks and files that disappeared from `folder` are removed."""
+        folder = Path(folder).resolve()
+        if (folder / ORIGINALS_LOC).is_dir():
+            tracks = list(find_originals(folder))
+        else:
+            tracks = list(find_remixes(folder))
+
+        known = {path: (size, mtime) for path, size, mtime
+                 in self.db.execute("SELECT path, size, mtime FROM files")}
+        stale = []
+        seen = set()
+        for track in tracks:
+            for path in [track["original"]] + list(track["stems"].values()):
+                seen.add(path)
+                stat = os.stat(path)
+                if known.get(path) != (stat.st_size, stat.st_mtime_ns):
+                    stale.append((path, stat.st_size, stat.st_mtime_ns))
+        print(f"{len(tracks)} tracks in {folder}, probing {len(stale)} files.")
+        with ProcessPoolExecutor(workers) as pool:
+            infos = pool.map(probe, [path for path, _, _ in stale], chunksize=16)
+            rows = [(path, size, mtime, info["length"], info["bitrate"], info["sample_rate"],
+                     info["channels"]) for (path, size, mtime), info in zip(stale, infos)]
+
+        prefix = os.path.join(str(folder), "")
+        removed = [(path,) for path in known if path.startswith(prefix) and path not in seen]
+        with self.db:
+            self.db.executemany("DELETE FROM files WHERE path = ?", removed)
+            self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.execute("DELETE FROM tracks WHERE folder = ?", (str(folder),))
+            self.db.executemany(
+                "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(track["name"], track["folder"], track["layout"], track["original"],
+                  track["artist"], track["title"], json.dumps(track["stems"]))
+                 for track in tracks])
+
+    def tracks(self, folder=None):
+        """Tracks with the attributes of their original (or mixture) file."""
+        query = ("SELECT tracks.name, original, artist, title, length, bitrate, sample_rate, "
+                 "channels, stems FROM tracks JOIN files ON files.path = tracks.original")
+        params = ()
+        if folder is not None:
+            query += " WHERE tracks.folder = ?"
+            params = (str(Path(folder).resolve()),)
+        keys = ["name", "original", "artist", "title", "length", "bitrate", "sample_rate",
+                "channels", "stems"]
+        for row in self.db.execute(query + " ORDER BY tracks.name", params):
+            track = dict(zip(keys, row))
+            track["stems"] = json.loads(track["stems"])
+            yield track
+
+    def export_csv(self, path, folder=None, order=None):
+        """Write the dataset info csv, as expected by the dataset preparation scripts.
+        Rows are sorted by name, or follow `order` if given, a list of original files."""
+        columns = ["original", "artist", "title", "length", "bitrate", "sample_rate",
+                   "channels"] + STEMS
+        tracks = list(self.tracks(folder))
+        if order is not None:
+            rank = {str(original): index for index, original in enumerate(order)}
+            tracks.sort(key=lambda track: rank.get(track["original"], len(rank)))
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow(columns)
+            for track in tracks:
+                writer.writerow([track["original"], track["artist"], track["title"],
+                                 round(track["length"], 2), track["bitrate"],
+                                 track["sample_rate"], track["channels"]]
+                                + [track["stems"].get(stem, "") for stem in STEMS])
+
+    def durations(self, folder=None):
+        """Return the duration in seconds of each track, from the catalog."""
+        return [(track["name"], track["length"]) for track in self.tracks(folder)]
+
+    def mp3set_metadata(self, root, sources, workers=None):
+        """Return the metadata of the remix dataset `root` for `Mp3set`, computing
+        only the entries of the tracks that changed since the last call."""
+        from demucs.mp3 import build_metadata
+
+        root = str(Path(root).resolve())
+        previous = {name: json.loads(meta) for name, meta in self.db.execute(
+            "SELECT name, meta FROM mp3set WHERE root = ?", (root,))}
+        metadata = build_metadata(root, sources, previous=previous, workers=workers)
+        with self.db:
+            self.db.execute("DELETE FROM mp3set WHERE root = ?", (root,))
+            self.db.executemany("INSERT INTO mp3set VALUES (?, ?, ?)",
+                                [(root, name, json.dumps(meta))
+                                 for name, meta in metadata.items()])
+        return metadata
+
+
+def main():
+    parser = argparse.ArgumentParser("dataset_catalog",
+                                     description="SQLite catalog of the songs dataset.")
+    parser.add_argument("--db", default=DEFAULT_DB, help="Path to the catalog database.")
+    parser.add_argument("-j", "--workers", type=int,
+                        help="Number of processes used to read the files, default is all cpus.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    scan = commands.add_parser("scan", help="Scan an originals/stems or remix dataset folder.")
+    scan.add_argument("folder", type=Path)
+    export = commands.add_parser("csv", help="Export the dataset info csv.")
+    export.add_argument("-o", "--out", default="dataset_info.csv")
+    export.add_argument("--folder", type=Path, help="Only export the tracks of this folder.")
+    duration = commands.add_parser("duration", help="Print the duration of the tracks.")
+    duration.add_argument("folder", type=Path, nargs="?")
+    metadata = commands.add_parser("metadata", help="Build the Mp3set metadata of a remix "
+                                                    "dataset folder, e.g. remix_dataset/train.")
+    metadata.add_argument("root", type=Path)
+    metadata.add_argument("-o", "--out", required=True)
+    metadata.add_argument("--sources", nargs="+", default=["drums", "bass", "other", "vocals",
+                                                           "guitars"])
+    args = parser.parse_args()
+
+    catalog = Catalog(args.db)
+    if args.command == "scan":
+        catalog.scan(args.folder, args.workers)
+    elif args.command == "csv":
+        catalog.export_csv(args.out, args.folder)
+    elif args.command == "duration":
+        total = 0
+        for name, length in catalog.durations(args.folder):
+            print(name + ": " + str(datetime.timedelta(seconds=length)))
+            total += length
+        print("=================================")
+        print("Total duration of dataset [s]:", str(datetime.timedelta(seconds=total)))
+    elif args.command == "metadata":
+        json.dump(catalog.mp3set_metadata(args.root, args.sources, args.workers),
+                  open(args.out, "w"))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,23 @@
 import os
-from mutagen.mp3 import MP3
+import sys
 import datetime
+from dataset_catalog import Catalog, DEFAULT_DB
 
 dataset_directory = "/home/natali/Desktop/remix_dataset/test"
+if len(sys.argv) > 1:
+    dataset_directory = sys.argv[1]
+
+# the catalog only reads the files added or modified since the last run
+catalog = Catalog(os.path.join(dataset_directory, DEFAULT_DB))
+catalog.scan(dataset_directory)
 
 duration = 0
 
-# go over all song folders in dataset directory
-for song_directory in os.listdir(dataset_directory):
-    full_song_dir = os.path.join(dataset_directory, song_directory)
-    if os.path.isdir(full_song_dir):
-        print(song_directory + ": ", end="")
-        mixture_loc = os.path.join(full_song_dir, "mixture.mp3")
-        mixture = MP3(mixture_loc)
-        duration += mixture.info.length
-        print(str(datetime.timedelta(seconds=mixture.info.length)))
+# go over all songs in dataset directory
+for song_directory, length in catalog.durations(dataset_directory):
+    print(os.path.basename(song_directory) + ": ", end="")
+    duration += length
+    print(str(datetime.timedelta(seconds=length)))
 
 print("=================================")
 print("Total duration of dataset [s]:", str(datetime.timedelta(seconds=duration)))
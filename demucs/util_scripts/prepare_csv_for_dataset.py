@@ -8,11 +8,8 @@
 import os
 import sys
 import getopt
-import pandas as pd
-from mutagen.mp3 import MP3
-
-ORIGINALS_LOC = "originals"
-STEMS_LOC = "stems"
+from pathlib import Path
+from dataset_catalog import Catalog, DEFAULT_DB, ORIGINALS_LOC
 
 
 def get_arguments():
@@ -39,115 +36,14 @@ def get_arguments():
     return folder, csv
 
 
-def create_empty_df():
-    empty_df = pd.DataFrame({'original': pd.Series(dtype='str'),
-                             'artist': pd.Series(dtype='str'),
-                             'title': pd.Series(dtype='str'),
-                             'length': pd.Series(dtype='float'),  # in seconds
-                             'bitrate': pd.Series(dtype='int'),
-                             'sample_rate': pd.Series(dtype='int'),
-                             'channels': pd.Series(dtype='int'),
-                             'bass': pd.Series(dtype='str'),
-                             'drums': pd.Series(dtype='str'),
-                             'vocals': pd.Series(dtype='str'),
-                             'guitars': pd.Series(dtype='str'),
-                             'other': pd.Series(dtype='str')})
-    return empty_df
-
-
-def all_stems_exist(original_basename, stems_folder):
-    without_ext = os.path.splitext(original_basename)[0]  # filename without extension
-    if not os.path.isfile(os.path.join(stems_folder, without_ext + "-bass.mp3")):  # BASS
-        print("No bass stem for file %s" % original_basename)
-        return False
-    if not os.path.isfile(os.path.join(stems_folder, without_ext + "-drums.mp3")):  # DRUMS
-        print("No drums stem for file %s" % original_basename)
-        return False
-    if not os.path.isfile(os.path.join(stems_folder, without_ext + "-vocals.mp3")):  # VOCALS
-        print("No vocals stem for file %s" % original_basename)
-        return False
-    if not os.path.isfile(os.path.join(stems_folder, without_ext + "-guitars.mp3")):  # GUITARS
-        print("No guitars stem for file %s" % original_basename)
-        return False
-    if not os.path.isfile(os.path.join(stems_folder, without_ext + "-other.mp3")):  # OTHER
-        print("No other stem for file %s" % original_basename)
-        return False
-
-    return True
-
-
-def get_stem_locations(original_basename, stems_folder):
-    """
-    Make sure to call after verify with all_stems_exist() that stems really exist
-    :param original_basename: Original song basename
-    :param stems_folder: Folder where stems are located
-    :return:
-    """
-    without_ext = os.path.splitext(original_basename)[0]  # filename without extension
-    bass_loc = os.path.join(stems_folder, without_ext + "-bass.mp3")
-    drums_loc = os.path.join(stems_folder, without_ext + "-drums.mp3")
-    vocals_loc = os.path.join(stems_folder, without_ext + "-vocals.mp3")
-    guitars_loc = os.path.join(stems_folder, without_ext + "-guitars.mp3")
-    other_loc = os.path.join(stems_folder, without_ext + "-other.mp3")
-    return bass_loc, drums_loc, vocals_loc, guitars_loc, other_loc
-
-
-def get_mp3_length(song_loc):
-    audio = MP3(song_loc)
-    return audio.info.length
-
-
-def get_mp3_bitrate(song_loc):
-    audio = MP3(song_loc)
-    bitrate = audio.info.bitrate // 1000
-    return bitrate
-
-
-def get_mp3_sample_rate(song_loc):
-    audio = MP3(song_loc)
-    sample_rate = audio.info.sample_rate
-    return sample_rate
-
-
-def get_mp3_channels(song_loc):
-    audio = MP3(song_loc)
-    channels = audio.info.channels
-    return channels
-
-
 if __name__ == '__main__':
     directory, csv_loc = get_arguments()  # command line args
-    originals_dir = os.path.join(directory, ORIGINALS_LOC)
-    stems_dir = os.path.join(directory, STEMS_LOC)
-
-    df = create_empty_df()  # empty dataframe where will be dataset info
-
-    for filename in os.listdir(originals_dir):
-        f = os.path.join(originals_dir, filename)
-        f_basename = os.path.basename(f)
-        # checking if it is a file
-        if os.path.isfile(f) and os.path.splitext(f_basename)[1] == ".mp3":
-            # verify is all stems present
-            if not all_stems_exist(f_basename, stems_dir):
-                continue
-
-            # get stems locations
-            bass, drums, vocals, guitars, other = get_stem_locations(f_basename, stems_dir)
 
-            # add entry to dataframe
-            new_row = pd.DataFrame({'original': f,
-                                    'artist': f_basename.split("-")[0],
-                                    'title': f_basename.split("-")[1][:-4],  # [:-4] to remove extension
-                                    'length': round(get_mp3_length(f), 2),
-                                    'bitrate': get_mp3_bitrate(f),
-                                    'sample_rate': get_mp3_sample_rate(f),
-                                    'channels': get_mp3_channels(f),
-                                    'bass': bass,
-                                    'drums': drums,
-                                    'vocals': vocals,
-                                    'guitars': guitars,
-                                    'other': other}, index=[0])
-            df = pd.concat([new_row, df.loc[:]]).reset_index(drop=True)
+    # Files are only read again if they changed since the last run, see dataset_catalog.py
+    catalog = Catalog(os.path.join(directory, DEFAULT_DB))
+    catalog.scan(directory)
 
-    # Save dataframe to csv
-    df.to_csv(csv_loc, sep=',', encoding='utf-8', index=False)
+    # Save dataset info to csv, in the reverse listing order of the originals, as before
+    originals_dir = Path(directory, ORIGINALS_LOC).resolve()
+    order = [originals_dir / filename for filename in reversed(os.listdir(originals_dir))]
+    catalog.export_csv(csv_loc, directory, order)
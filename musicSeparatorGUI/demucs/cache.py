@@ -0,0 +1,189 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Content addressed cache of separation results.
+Entries are keyed by the decoded mixture, the model signature and the parameters
+given to `demucs.apply.apply_model`, so that separating the same track twice with the same
+model and settings skips the inference entirely.
+
+Also provides a persistent cache of audio file metadata (ffprobe output, length,
+normalization statistics), keyed by the path, size and modification time of each file,
+so that scanning a large library again only costs stat calls.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import typing as tp
+
+import torch
+
+
+class SeparationCache:
+    """
+    Stores the separated sources on disk, as half precision tensors. When the total size
+    of the cache goes over `max_size` (in bytes), the least recently used entries are removed.
+
+    Note that results are only reproducible, and thus worth caching, if the random shifts
+    are seeded, see the `seed` argument of `apply_model`.
+    """
+    def __init__(self, root: tp.Union[str, Path], max_size: tp.Optional[int] = None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+
+    def key(self, mix: torch.Tensor, model_signature: str, **params) -> str:
+        """Return the key for the given decoded mixture, model signature and
+        separation parameters (e.g. `shifts`, `overlap`, `split`, `seed`)."""
+        sha = hashlib.sha256()
+        sha.update(model_signature.encode())
+        sha.update(json.dumps(params, sort_keys=True).encode())
+        sha.update(str(tuple(mix.shape)).encode())
+        sha.update(mix.detach().cpu().float().contiguous().numpy().tobytes())
+        return sha.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / (key + ".th")
+
+    def get(self, key: str) -> tp.Optional[torch.Tensor]:
+        """Return the cached sources for `key`, or None if not in the cache."""
+        path = self._path(key)
+        try:
+            sources = torch.load(path, 'cpu')
+        except (FileNotFoundError, EOFError, RuntimeError):
+            return None
+        # Mark the entry as recently used.
+        os.utime(path)
+        return sources.float()
+
+    def put(self, key: str, sources: torch.Tensor):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.parent / (path.name + ".tmp")
+        torch.save(sources.detach().cpu().half(), tmp)
+        os.replace(tmp, path)
+        if self.max_size is not None:
+            self.evict(self.max_size)
+
+    def evict(self, max_size: int):
+        """Remove the least recently used entries until the cache is smaller than `max_size`."""
+        entries = []
+        for path in self.root.glob("*/*.th"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class MetadataCache:
+    """
+    Persistent cache of audio file metadata, stored in a SQLite database at `path`.
+    Each entry is a json value identified by the file path and a `kind`
+    (e.g. `"ffprobe"` or `"stats"`). Entries are invalidated when the size or modification
+    time of the file change. The cache is safe to share between threads and processes.
+    """
+    def __init__(self, path: tp.Union[str, Path]):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS metadata (path TEXT, kind TEXT, size INTEGER, "
+                "mtime INTEGER, value TEXT, PRIMARY KEY (path, kind))")
+
+    @staticmethod
+    def _stat(file: tp.Union[str, Path]):
+        file = Path(file).resolve()
+        stat = file.stat()
+        return str(file), stat.st_size, stat.st_mtime_ns
+
+    def get(self, file: tp.Union[str, Path], kind: str) -> tp.Any:
+        """Return the cached value for `file` and `kind`, or None if missing or stale."""
+        path, size, mtime = self._stat(file)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM metadata WHERE path=? AND kind=? AND size=? AND mtime=?",
+                (path, kind, size, mtime)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, file: tp.Union[str, Path], kind: str, value: tp.Any):
+        path, size, mtime = self._stat(file)
+        try:
+            with self._lock, self._db:
+                self._db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)",
+                                 (path, kind, size, mtime, json.dumps(value)))
+        except sqlite3.OperationalError:
+            # Read only or locked for too long, the cache is only an optimization.
+            pass
+
+    def cached(self, file: tp.Union[str, Path], kind: str, compute: tp.Callable[[], tp.Any]):
+        """Return the cached value for `file` and `kind`, calling `compute` on a miss."""
+        value = self.get(file, kind)
+        if value is None:
+            value = compute()
+            self.put(file, kind, value)
+        return value
+
+
+def _default_metadata_path() -> tp.Optional[Path]:
+    path = os.environ.get("DEMUCS_METADATA_CACHE")
+    if path is None:
+        root = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+        return root / "demucs" / "metadata.sqlite"
+    return Path(path) if path else None
+
+
+_metadata_path: tp.Optional[Path] = _default_metadata_path()
+_metadata_cache: tp.Optional[MetadataCache] = None
+_metadata_pid: tp.Optional[int] = None
+
+
+def set_metadata_cache(path: tp.Optional[tp.Union[str, Path]]):
+    """Use the metadata cache at `path`, or disable it if `path` is None.
+    By default, the cache is stored in `$DEMUCS_METADATA_CACHE` if defined
+    (disabled if empty), or `~/.cache/demucs/metadata.sqlite`."""
+    global _metadata_path, _metadata_pid
+    _metadata_path = None if path is None else Path(path)
+    _metadata_pid = None
+
+
+def get_metadata_cache() -> tp.Optional[MetadataCache]:
+    """Return the metadata cache shared by the process, see `set_metadata_cache`."""
+    global _metadata_cache, _metadata_pid
+    # SQLite connections must not be shared with forked processes, e.g. data loader workers.
+    if _metadata_pid != os.getpid():
+        _metadata_cache = None
+        if _metadata_path is not None:
+            try:
+                _metadata_cache = MetadataCache(_metadata_path)
+            except (OSError, sqlite3.Error):
+                pass
+        _metadata_pid = os.getpid()
+    return _metadata_cache
+
+
+def cached_metadata(file: tp.Union[str, Path], kind: str, compute: tp.Callable[[], tp.Any]):
+    """Return the metadata `kind` for `file` from the shared cache, or `compute()` it."""
+    cache = get_metadata_cache()
+    if cache is None:
+        return compute()
+    return cache.cached(file, kind, compute)
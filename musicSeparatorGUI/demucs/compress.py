@@ -0,0 +1,367 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Low-rank compression of the convolutions of a trained model.
+
+The weight of each large enough `nn.Conv1d` and `nn.ConvTranspose1d` (with the same
+`min_size` criterion as `svd.svd_penalty`) is factorized with `svd.low_rank` into two
+thinner convolutions, keeping either a fixed rank or enough singular values to preserve
+a fraction of the energy of the weight. The rank of each layer is stored by `serialize_model`,
+so that compressed models are loaded like any other model.
+The result can be briefly fine-tuned with the training loop of the `Solver` of the XP.
+
+    python -m demucs.compress release_models/SIG.th --energy 0.9 -o release_models/SIG_lr.th \\
+        --test ../datasets/remix_dataset/test
+"""
+
+import argparse
+import copy
+import logging
+import os
+from pathlib import Path
+import sys
+import typing as tp
+
+import torch
+from torch import nn
+
+from .svd import low_rank
+
+logger = logging.getLogger(__name__)
+
+
+class LowRankConv1d(nn.Module):
+    """`nn.Conv1d` with a weight of rank at most `rank`: a convolution
+    with `rank` output channels, followed by a 1x1 convolution."""
+    def __init__(self, in_channels, out_channels, kernel_size, rank,
+                 stride=1, padding=0, dilation=1, bias=True):
+        super().__init__()
+        self.rank = rank
+        self.first = nn.Conv1d(in_channels, rank, kernel_size, stride=stride,
+                               padding=padding, dilation=dilation, bias=False)
+        self.second = nn.Conv1d(rank, out_channels, 1, bias=bias)
+
+    @classmethod
+    def like(cls, conv: nn.Conv1d, rank: int):
+        return cls(conv.in_channels, conv.out_channels, conv.kernel_size[0], rank,
+                   stride=conv.stride[0], padding=conv.padding[0], dilation=conv.dilation[0],
+                   bias=conv.bias is not None)
+
+    def forward(self, x):
+        return self.second(self.first(x))
+
+
+class LowRankConvTranspose1d(nn.Module):
+    """`nn.ConvTranspose1d` with a weight of rank at most `rank`: a 1x1 convolution
+    with `rank` output channels, followed by a transposed convolution."""
+    def __init__(self, in_channels, out_channels, kernel_size, rank,
+                 stride=1, padding=0, output_padding=0, dilation=1, bias=True):
+        super().__init__()
+        self.rank = rank
+        self.first = nn.Conv1d(in_channels, rank, 1, bias=False)
+        self.second = nn.ConvTranspose1d(rank, out_channels, kernel_size, stride=stride,
+                                         padding=padding, output_padding=output_padding,
+                                         dilation=dilation, bias=bias)
+
+    @classmethod
+    def like(cls, conv: nn.ConvTranspose1d, rank: int):
+        return cls(conv.in_channels, conv.out_channels, conv.kernel_size[0], rank,
+                   stride=conv.stride[0], padding=conv.padding[0],
+                   output_padding=conv.output_padding[0], dilation=conv.dilation[0],
+                   bias=conv.bias is not None)
+
+    def forward(self, x):
+        return self.second(self.first(x))
+
+
+def _factorizable(module, min_size):
+    if not isinstance(module, (nn.Conv1d, nn.ConvTranspose1d)):
+        return False
+    if module.groups != 1 or module.padding_mode != 'zeros':
+        return False
+    # Same size criterion as `svd_penalty`.
+    return module.weight.numel() / 2**18 >= min_size
+
+
+def _low_rank(module, rank):
+    if isinstance(module, nn.ConvTranspose1d):
+        return LowRankConvTranspose1d.like(module, rank)
+    return LowRankConv1d.like(module, rank)
+
+
+def _set_module(model, name, module):
+    parent, _, child = name.rpartition('.')
+    setattr(model.get_submodule(parent) if parent else model, child, module)
+
+
+def get_lowrank_structure(model) -> tp.Dict[str, int]:
+    """Return the rank of each low-rank layer of `model`, by name."""
+    return {name: module.rank for name, module in model.named_modules()
+            if isinstance(module, (LowRankConv1d, LowRankConvTranspose1d))}
+
+
+def set_lowrank_structure(model, structure: tp.Dict[str, int]):
+    """Replace the layers of a freshly created `model` with uninitialized low-rank layers,
+    as given by `get_lowrank_structure`, so that the state of a compressed model can be loaded."""
+    for name, rank in structure.items():
+        _set_module(model, name, _low_rank(model.get_submodule(name), rank))
+
+
+def compress_model(model, rank: tp.Optional[int] = None, energy: tp.Optional[float] = None,
+                   min_size: float = 0.1):
+    """
+    Return a copy of `model` where the large convolutions are factorized.
+
+    Args:
+        model (Model): model to compress, it is not modified.
+        rank (int or None): rank kept for each layer.
+        energy (float or None): otherwise, fraction of the energy (sum of the squared
+            singular values) of the weight kept for each layer.
+        min_size (float): minimum size in MB of a layer to factorize.
+
+    Layers are left untouched if the factorization would not reduce their number of parameters.
+    """
+    assert (rank is None) != (energy is None), "Exactly one of rank and energy must be given."
+    model = copy.deepcopy(model)
+    for name, module in list(model.named_modules()):
+        if not _factorizable(module, min_size):
+            continue
+        weight = module.weight.data.float()
+        transposed = isinstance(module, nn.ConvTranspose1d)
+        # Conv1d: (out, in, kernel), ConvTranspose1d: (in, out, kernel).
+        rows, cols, kernel = weight.shape
+        # The 1x1 convolution is given by the left factor (transposed for ConvTranspose1d),
+        # and the kernels are kept in the right factor.
+        left, right = low_rank(weight.reshape(rows, cols * kernel), rank, energy)
+        layer_rank = left.shape[1]
+        if layer_rank * (rows + cols * kernel) >= rows * cols * kernel:
+            continue
+
+        layer = _low_rank(module, layer_rank)
+        dtype = module.weight.dtype
+        if transposed:
+            layer.first.weight.data[:] = left.t()[:, :, None].to(dtype)
+            layer.second.weight.data[:] = right.view(layer_rank, cols, kernel).to(dtype)
+        else:
+            layer.first.weight.data[:] = right.view(layer_rank, cols, kernel).to(dtype)
+            layer.second.weight.data[:] = left[:, :, None].to(dtype)
+        if module.bias is not None:
+            layer.second.bias.data[:] = module.bias.data
+        layer.to(module.weight.device)
+        _set_module(model, name, layer)
+    return model
+
+
+def model_size(model):
+    """Size of the parameters of `model` in MB, as float32."""
+    return sum(p.numel() for p in model.parameters()) * 4 / 2**20
+
+
+def count_flops(model, duration: float = 1.):
+    """Number of floating point operations performed by the convolutions, linear layers
+    and LSTMs of `model` for `duration` seconds of audio."""
+    macs = 0
+
+    def conv_hook(module, inputs, output):
+        nonlocal macs
+        if isinstance(module, nn.ConvTranspose1d):
+            macs += inputs[0].numel() * module.out_channels * module.kernel_size[0]
+        else:
+            macs += output.numel() * module.in_channels * module.kernel_size[0]
+
+    def linear_hook(module, inputs, output):
+        nonlocal macs
+        macs += output.numel() * module.in_features
+
+    def lstm_hook(module, inputs, output):
+        nonlocal macs
+        steps = inputs[0].shape[0] * inputs[0].shape[1]
+        directions = 2 if module.bidirectional else 1
+        for layer in range(module.num_layers):
+            size = module.input_size if layer == 0 else module.hidden_size * directions
+            macs += steps * directions * 4 * module.hidden_size * (size + module.hidden_size)
+
+    hooks = []
+    for module in model.modules():
+        if isinstance(module, (nn.Conv1d, nn.ConvTranspose1d)):
+            hooks.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            hooks.append(module.register_forward_hook(linear_hook))
+        elif isinstance(module, nn.LSTM):
+            hooks.append(module.register_forward_hook(lstm_hook))
+    length = int(duration * model.samplerate)
+    if hasattr(model, 'valid_length'):
+        length = model.valid_length(length)
+    device = next(iter(model.parameters())).device
+    try:
+        with torch.no_grad():
+            model(torch.zeros(1, model.audio_channels, length, device=device))
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return 2 * macs
+
+
+def _test_tracks(test_dir: Path):
+    # Same layout as the test set used by `evaluate.evaluate`.
+    for root, folders, files in os.walk(test_dir, followlinks=True):
+        root = Path(root)
+        if root.name.startswith('.') or folders or root == test_dir:
+            continue
+        yield root
+
+
+def evaluate_nsdr(models, test_dir: Path, max_tracks: tp.Optional[int] = None, **kwargs):
+    """Return for each model the nSDR of each source, averaged over the tracks of `test_dir`.
+    Extra arguments are given to `apply_model`."""
+    import torchaudio as ta
+    from .apply import apply_model
+    from .audio import convert_audio
+    from .evaluate import new_sdr
+
+    first = models[0]
+    totals = [torch.zeros(len(first.sources), dtype=torch.float64) for _ in models]
+    count = 0
+    for root in _test_tracks(test_dir):
+        if max_tracks is not None and count >= max_tracks:
+            break
+        mix, sr = ta.load(str(root / "mixture.mp3"))
+        mix = convert_audio(mix, sr, first.samplerate, first.audio_channels)
+        references = []
+        for source in first.sources:
+            wav, sr = ta.load(str(root / f"{source}.mp3"))
+            references.append(convert_audio(wav, sr, first.samplerate, first.audio_channels))
+        references = torch.stack(references)
+        ref = mix.mean(0)
+        mix = (mix - ref.mean()) / ref.std()
+        for index, model in enumerate(models):
+            estimates = apply_model(model, mix[None], **kwargs)[0]
+            estimates = estimates * ref.std() + ref.mean()
+            length = min(estimates.shape[-1], references.shape[-1])
+            totals[index] += new_sdr(references[None, ..., :length].double(),
+                                     estimates[None, ..., :length].double())[0]
+        logger.info("Evaluated %s", root.name)
+        count += 1
+    if not count:
+        raise ValueError(f"No test track found in {test_dir}.")
+    return [(total / count).tolist() for total in totals]
+
+
+def finetune(solver, model, epochs: int, lr: tp.Optional[float] = None):
+    """Fine-tune the compressed `model` for a few `epochs` with the training loop of `solver`,
+    and return it with the weights giving the best validation metric."""
+    from . import distrib, states
+
+    args = solver.args
+    model.to(solver.device)
+    solver.model = model
+    solver.dmodel = distrib.wrap(model)
+    solver.optimizer = torch.optim.Adam(model.parameters(), lr=lr or args.optim.lr)
+    solver.quantizer = None
+    solver.emas = {'batch': [], 'epoch': []}
+    key = args.test.metric
+    best, best_state = None, None
+    for epoch in range(epochs):
+        model.train()
+        train = solver._run_one_epoch(epoch)
+        model.eval()
+        with torch.no_grad():
+            valid = solver._run_one_epoch(epoch, train=False)
+        logger.info("Fine-tuning epoch %d | train loss=%.4f | valid %s=%.4f",
+                    epoch + 1, train['loss'], key, valid[key])
+        score = -valid[key] if key.startswith('nsdr') else valid[key]
+        if best is None or score < best:
+            best = score
+            best_state = states.copy_state(model.state_dict())
+    if best_state is not None:
+        model.load_state_dict(best_state)
+    return model
+
+
+def main():
+    from omegaconf import OmegaConf
+    from .states import load_model, save_with_checksum, serialize_model
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    parser = argparse.ArgumentParser("demucs.compress",
+                                     description="Factorize the convolutions of a model.")
+    parser.add_argument("model", nargs='?', type=Path,
+                        help="Exported model (see exportModel.py) to compress.")
+    parser.add_argument("--xp", help="Compress the best state of this XP instead. "
+                                     "Required for fine-tuning.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--rank", type=int, help="Rank kept for each layer.")
+    group.add_argument("--energy", type=float,
+                       help="Fraction of the energy of the weights kept for each layer.")
+    parser.add_argument("--min-size", type=float, default=0.1,
+                        help="Minimum size in MB of a layer to factorize.")
+    parser.add_argument("--epochs", type=int, default=0,
+                        help="Number of epochs of fine-tuning, requires --xp.")
+    parser.add_argument("--lr", type=float, help="Learning rate for the fine-tuning.")
+    parser.add_argument("--test", type=Path,
+                        help="Test set folder, used to report the nSDR before and after.")
+    parser.add_argument("--max-tracks", type=int, help="Only evaluate this many test tracks.")
+    parser.add_argument("-o", "--out", type=Path, required=True,
+                        help="Path of the compressed model.")
+    parser.add_argument("-s", "--sign", action="store_true",
+                        help="Add sha256 prefix checksum to the filename.")
+    args = parser.parse_args()
+
+    solver = None
+    if args.xp is not None:
+        from . import train
+        solver = train.get_solver_from_sig(args.xp)
+        solver.model.load_state_dict(solver.best_state)
+        model = solver.model
+        training_args = solver.args
+    elif args.model is not None:
+        package = torch.load(args.model, 'cpu')
+        model = load_model(package)
+        training_args = OmegaConf.create(package['training_args'])
+    else:
+        parser.error("Either a model or --xp must be given.")
+    if args.epochs and solver is None:
+        parser.error("Fine-tuning requires --xp.")
+    model.eval()
+
+    compressed = compress_model(model, rank=args.rank, energy=args.energy,
+                                min_size=args.min_size)
+    for name, rank in get_lowrank_structure(compressed).items():
+        logger.info("Factorized %s with rank %d", name, rank)
+    if args.epochs:
+        compressed = finetune(solver, compressed, args.epochs, args.lr)
+    model.cpu().eval()
+    compressed.cpu().eval()
+
+    report = {}
+    for label, candidate in [("original", model), ("compressed", compressed)]:
+        report[label] = {
+            'size': model_size(candidate),
+            'gflops': count_flops(candidate) / 1e9,
+        }
+    if args.test is not None:
+        nsdrs = evaluate_nsdr([model, compressed], args.test, args.max_tracks,
+                              shifts=training_args.test.shifts, split=training_args.test.split,
+                              overlap=training_args.test.overlap)
+        for label, nsdr in zip(["original", "compressed"], nsdrs):
+            report[label]['nsdr'] = sum(nsdr) / len(nsdr)
+            for source, value in zip(model.sources, nsdr):
+                report[label][f'nsdr_{source}'] = value
+    for label, metrics in report.items():
+        logger.info("%s | %s", label.capitalize(),
+                    " | ".join(f"{key}={value:.3f}" for key, value in metrics.items()))
+
+    pkg = serialize_model(compressed, training_args, half=True)
+    pkg['compression'] = report
+    args.out.parent.mkdir(exist_ok=True, parents=True)
+    if args.sign:
+        save_with_checksum(pkg, args.out)
+    else:
+        torch.save(pkg, args.out)
+    logger.info("Compressed model saved to %s", args.out)
+
+
+if __name__ == "__main__":
+    main()
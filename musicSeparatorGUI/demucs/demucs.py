@@ -4,6 +4,7 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import functools
 import math
 import typing as tp
 
@@ -48,19 +49,15 @@ class BLSTM(nn.Module):
         x = self.linear(x)
         x = x.permute(1, 2, 0)
         if framed:
-            out = []
-            frames = x.reshape(B, -1, C, width)
+            frames = x.reshape(B, nframes, C, width)
             limit = stride // 2
-            for k in range(nframes):
-                if k == 0:
-                    out.append(frames[:, k, :, :-limit])
-                elif k == nframes - 1:
-                    out.append(frames[:, k, :, limit:])
-                else:
-                    out.append(frames[:, k, :, limit:-limit])
-            out = torch.cat(out, -1)
-            out = out[..., :T]
-            x = out
+            # Each frame contributes its `stride` central steps, except for the
+            # first and last frames which also cover the beginning and end of the input.
+            center = frames[..., limit:limit + stride].permute(0, 2, 1, 3)
+            center = center.reshape(B, C, nframes * stride)
+            out = torch.cat([frames[:, 0, :, :limit], center,
+                             frames[:, -1, :, limit + stride:]], -1)
+            x = out[..., :T]
         if self.skip:
             x = x + y
         return x
@@ -166,18 +163,60 @@ class DConv(nn.Module):
         return x
 
 
+@functools.lru_cache(maxsize=8)
+def _local_state_kernels(length, window, ndecay, nfreqs, device, dtype):
+    """Return the masks and kernels used by `LocalState` for inputs of `length` time steps,
+    which only depend on the difference between the positions of keys and queries.
+    With `window=None`, they are given for all pairs of positions, with shape `(T, T)`.
+    Otherwise, they are given for a block of `window` queries and the `3 * window` keys
+    around it, with shape `(3 * window, window)`, and the mask of the positions
+    outside of the window or of the input has shape `(blocks, 3 * window, window)`.
+    """
+    if window is None:
+        indexes = torch.arange(length, device=device)
+        # left index are keys, right index are queries
+        delta = indexes[:, None] - indexes[None, :]
+        out_mask = None
+    else:
+        blocks = (length + window - 1) // window
+        keys = torch.arange(3 * window, device=device) - window
+        queries = torch.arange(window, device=device)
+        delta = keys[:, None] - queries[None, :]
+        positions = torch.arange(blocks, device=device)[:, None] * window + keys
+        outside = (positions < 0) | (positions >= length)
+        out_mask = (delta.abs() > window)[None] | outside[:, :, None]
+    self_mask = delta == 0
+    delta = delta.to(dtype)
+    freq_kernel = None
+    if nfreqs:
+        periods = torch.arange(1, nfreqs + 1, device=device, dtype=dtype)
+        freq_kernel = torch.cos(2 * math.pi * delta / periods.view(-1, 1, 1))
+    decay_kernel = None
+    if ndecay:
+        decays = torch.arange(1, ndecay + 1, device=device, dtype=dtype)
+        decay_kernel = - decays.view(-1, 1, 1) * delta.abs() / ndecay**0.5
+    return self_mask, out_mask, freq_kernel, decay_kernel
+
+
 class LocalState(nn.Module):
     """Local state allows to have attention based only on data (no positional embedding),
     but while setting a constraint on the time window (e.g. decaying penalty term).
 
     Also a failed experiments with trying to provide some frequency based attention.
+
+    If `window` is set, each query only attends to the keys at most `window` time steps away.
+    Queries are then processed by blocks of `window`, so that memory and time grow linearly
+    with the input length instead of quadratically. With `window >= T - 1`, this is
+    the same as the full attention, which is used when `T <= window`.
     """
-    def __init__(self, channels: int, heads: int = 4, nfreqs: int = 0, ndecay: int = 4):
+    def __init__(self, channels: int, heads: int = 4, nfreqs: int = 0, ndecay: int = 4,
+                 window: tp.Optional[int] = None):
         super().__init__()
         assert channels % heads == 0, (channels, heads)
         self.heads = heads
         self.nfreqs = nfreqs
         self.ndecay = ndecay
+        self.window = window
         self.content = nn.Conv1d(channels, channels, 1)
         self.query = nn.Conv1d(channels, channels, 1)
         self.key = nn.Conv1d(channels, channels, 1)
@@ -193,10 +232,11 @@ class LocalState(nn.Module):
 
     def forward(self, x):
         B, C, T = x.shape
+        if self.window is not None and self.window < T:
+            return x + self.proj(self._banded(x))
         heads = self.heads
-        indexes = torch.arange(T, device=x.device, dtype=x.dtype)
-        # left index are keys, right index are queries
-        delta = indexes[:, None] - indexes[None, :]
+        self_mask, _, freq_kernel, decay_kernel = _local_state_kernels(
+            T, None, self.ndecay, self.nfreqs, x.device, x.dtype)
 
         queries = self.query(x).view(B, heads, -1, T)
         keys = self.key(x).view(B, heads, -1, T)
@@ -204,19 +244,15 @@ class LocalState(nn.Module):
         dots = torch.einsum("bhct,bhcs->bhts", keys, queries)
         dots /= keys.shape[2]**0.5
         if self.nfreqs:
-            periods = torch.arange(1, self.nfreqs + 1, device=x.device, dtype=x.dtype)
-            freq_kernel = torch.cos(2 * math.pi * delta / periods.view(-1, 1, 1))
             freq_q = self.query_freqs(x).view(B, heads, -1, T) / self.nfreqs ** 0.5
             dots += torch.einsum("fts,bhfs->bhts", freq_kernel, freq_q)
         if self.ndecay:
-            decays = torch.arange(1, self.ndecay + 1, device=x.device, dtype=x.dtype)
             decay_q = self.query_decay(x).view(B, heads, -1, T)
             decay_q = torch.sigmoid(decay_q) / 2
-            decay_kernel = - decays.view(-1, 1, 1) * delta.abs() / self.ndecay**0.5
             dots += torch.einsum("fts,bhfs->bhts", decay_kernel, decay_q)
 
         # Kill self reference.
-        dots.masked_fill_(torch.eye(T, device=dots.device, dtype=torch.bool), -100)
+        dots.masked_fill_(self_mask, -100)
         weights = torch.softmax(dots, dim=2)
 
         content = self.content(x).view(B, heads, -1, T)
@@ -227,6 +263,62 @@ class LocalState(nn.Module):
         result = result.reshape(B, -1, T)
         return x + self.proj(result)
 
+    def _banded(self, x):
+        B, C, T = x.shape
+        heads = self.heads
+        window = self.window
+        assert window is not None
+        blocks = (T + window - 1) // window
+        padded = blocks * window
+        self_mask, out_mask, freq_kernel, decay_kernel = _local_state_kernels(
+            T, window, self.ndecay, self.nfreqs, x.device, x.dtype)
+
+        def query_blocks(y):
+            # (B, heads, C, T) -> (B, heads, C, blocks, window)
+            y = F.pad(y, (0, padded - T))
+            return y.view(*y.shape[:-1], blocks, window)
+
+        def key_blocks(y):
+            # (B, heads, C, T) -> (B, heads, C, blocks, 3 * window)
+            y = F.pad(y, (window, padded - T + window))
+            return y.unfold(-1, 3 * window, window)
+
+        queries = query_blocks(self.query(x).view(B, heads, -1, T))
+        keys = key_blocks(self.key(x).view(B, heads, -1, T))
+        # n are blocks, t are keys, s are queries
+        dots = torch.einsum("bhcnt,bhcns->bhnts", keys, queries)
+        dots /= keys.shape[2]**0.5
+        if self.nfreqs:
+            freq_q = query_blocks(self.query_freqs(x).view(B, heads, -1, T))
+            freq_q = freq_q / self.nfreqs ** 0.5
+            dots += torch.einsum("fts,bhfns->bhnts", freq_kernel, freq_q)
+        if self.ndecay:
+            decay_q = query_blocks(self.query_decay(x).view(B, heads, -1, T))
+            decay_q = torch.sigmoid(decay_q) / 2
+            dots += torch.einsum("fts,bhfns->bhnts", decay_kernel, decay_q)
+
+        dots.masked_fill_(out_mask, -float('inf'))
+        # Kill self reference, after the out of window mask, so that padded queries
+        # always have a finite weight.
+        dots.masked_fill_(self_mask, -100)
+        weights = torch.softmax(dots, dim=3)
+
+        content = key_blocks(self.content(x).view(B, heads, -1, T))
+        result = torch.einsum("bhnts,bhcnt->bhcns", weights, content)
+        if self.nfreqs:
+            time_sig = torch.einsum("bhnts,fts->bhfns", weights, freq_kernel)
+            result = torch.cat([result, time_sig], 2)
+        result = result.reshape(B, heads, -1, padded)[..., :T]
+        return result.reshape(B, -1, T)
+
+
+def set_attention_window(model, window: tp.Optional[int]):
+    """Set the `window` of all the `LocalState` layers of `model` (or of a bag of models),
+    None restoring the full attention."""
+    for module in model.modules():
+        if isinstance(module, LocalState):
+            module.window = window
+
 
 class Demucs(nn.Module):
     @capture_init
@@ -12,12 +12,13 @@ be reported as `nsdr` for `new sdr`).
 import logging
 import torch as th
 import torchaudio as ta
-from .mp3 import get_test_dataset
+from .mp3 import get_test_dataset, _stats
 from dora.log import LogProgress
 import numpy as np
 from . import distrib
 from .apply import apply_model
 from .audio import convert_audio, save_audio, AudioFile
+from .cache import cached_metadata
 from .utils import DummyPoolExecutor
 from concurrent import futures
 import museval
@@ -99,13 +100,15 @@ def evaluate(solver, compute_sdr=False):
         other, _ = ta.load(str(otherMp3))
         vocals, _ = ta.load(str(vocalsMp3))
         guitars, _ = ta.load(str(guitarsMp3))
-        ref = mix.mean(dim=0)  # mono mixture
-        mix = (mix - ref.mean()) / ref.std()
+        # Normalization of the mono mixture, decoded with `ta.load` as for the datasets,
+        # so that the entry of the metadata cache is shared with `build_metadata`.
+        stats = cached_metadata(mixtureMp3, "ta.stats", lambda: _stats(mix))
+        mix = (mix - stats["mean"]) / stats["std"]
         mix = convert_audio(mix, src_rate, model.samplerate, model.audio_channels)
         estimates = apply_model(model, mix[None],
                                 shifts=args.test.shifts, split=args.test.split,
                                 overlap=args.test.overlap)[0]
-        estimates = estimates * ref.std() + ref.mean()
+        estimates = estimates * stats["std"] + stats["mean"]
         estimates = estimates.to(eval_device)
         print("ESTIMATES SHAPE: ", estimates.shape)
 
@@ -3,17 +3,25 @@
 #
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
-"""Loading mp3 based datasets, including MedleyDB."""
+"""Loading mp3 based datasets, including MedleyDB.
 
+Datasets can also be materialized once into memory mapped shards, decoded at the target
+sample rate and number of channels, see `materialize` and `ShardSet`.
+"""
+
+import bisect
 import os.path
 from pathlib import Path
 from collections import OrderedDict
 import math
+import numpy as np
 import torch as th
 import torchaudio as ta
 from torch.nn import functional as F
 import tqdm
 from .audio import convert_audio_channels
+from .cache import cached_metadata
+from .mp3index import build_index, load_segment
 import julius
 import json
 import hashlib
@@ -22,6 +30,32 @@ from torch import distributed
 
 MIXTURE = "mixture"
 EXT = ".mp3"
+SHARDS_INDEX = "shards.json"
+
+
+def _file_info(file):
+    try:
+        info = ta.info(str(file))
+    except RuntimeError:
+        print(file)
+        raise
+    return {"length": info.num_frames, "samplerate": info.sample_rate}
+
+
+def _stats(wav):
+    """Mean and standard deviation of the mono mix of `wav`, used to normalize the tracks."""
+    mono = wav.mean(0)
+    return {"mean": mono.mean().item(), "std": mono.std().item()}
+
+
+def _file_stats(file):
+    # Decoded with `ta.load`, as the examples of `Mp3set`.
+    try:
+        wav, _ = ta.load(str(file))
+    except RuntimeError:
+        print(file)
+        raise
+    return _stats(wav)
 
 
 def _track_metadata(track, sources, normalize=True, ext=EXT):
@@ -29,39 +63,46 @@ def _track_metadata(track, sources, normalize=True, ext=EXT):
     track_samplerate = None
     mean = 0
     std = 1
+    frame_index = {}
     for source in sources + [MIXTURE]:
         file = track / f"{source}{ext}"
-        try:
-            info = ta.info(str(file))
-        except RuntimeError:
-            print(file)
-            raise
-        length = info.num_frames
+        info = cached_metadata(file, "ta.info", lambda: _file_info(file))
+        if ext == ".mp3":
+            frame_index[source] = cached_metadata(file, "mp3.index", lambda: build_index(file))
+        length = info["length"]
         if track_length is None:
             track_length = length
-            track_samplerate = info.sample_rate
+            track_samplerate = info["samplerate"]
         elif track_length != length:
             raise ValueError(
                 f"Invalid length for file {file}: "
                 f"expecting {track_length} but got {length}.")
-        elif info.sample_rate != track_samplerate:
+        elif info["samplerate"] != track_samplerate:
             raise ValueError(
                 f"Invalid sample rate for file {file}: "
-                f"expecting {track_samplerate} but got {info.sample_rate}.")
+                f"expecting {track_samplerate} but got {info['samplerate']}.")
         if source == MIXTURE and normalize:
-            try:
-                mp3, _ = ta.load(str(file))
-            except RuntimeError:
-                print(file)
-                raise
-            mp3 = mp3.mean(0)
-            mean = mp3.mean().item()
-            std = mp3.std().item()
+            stats = cached_metadata(file, "ta.stats", lambda: _file_stats(file))
+            mean = stats["mean"]
+            std = stats["std"]
 
-    return {"length": length, "mean": mean, "std": std, "samplerate": track_samplerate}
+    meta = {"length": length, "mean": mean, "std": std, "samplerate": track_samplerate}
+    if frame_index:
+        # Frame index of each file, see `demucs.mp3index`.
+        meta["index"] = frame_index
+    return meta
+
+
+def _track_stamp(track, sources, ext=EXT):
+    """Size and modification time of the files of `track`, to detect changes."""
+    stamp = []
+    for source in sources + [MIXTURE]:
+        stat = (track / f"{source}{ext}").stat()
+        stamp.append([source, stat.st_size, stat.st_mtime_ns])
+    return stamp
 
 
-def build_metadata(path, sources, normalize=True, ext=EXT):
+def build_metadata(path, sources, normalize=True, ext=EXT, previous=None, workers=None):
     """
     Build the metadata for `Wavset`.
     Args:
@@ -70,23 +111,62 @@ def build_metadata(path, sources, normalize=True, ext=EXT):
         normalize (bool): if True, loads full track and store normalization
             values based on the mixture file.
         ext (str): extension of audio files (default is .wav).
+        previous (dict or None): metadata from a previous call, the entries of the tracks
+            whose files have the same sizes and modification times are reused.
+        workers (int or None): number of processes, defaults to the number of cpus, and is
+            at most the number of added or modified tracks.
+    For mp3 files, the frame index of each file is also stored, allowing `Mp3set`
+    to decode only the requested segments.
     """
 
     meta = {}
     path = Path(path)
-    pendings = []
-    from concurrent.futures import ThreadPoolExecutor
-    with ThreadPoolExecutor(8) as pool:
-        for root, folders, files in os.walk(path, followlinks=True):
-            root = Path(root)
-            if root.name.startswith('.') or folders or root == path:
-                continue
-            name = str(root.relative_to(path))
-            pendings.append((name, pool.submit(_track_metadata, root, sources, normalize, ext)))
-            # meta[name] = _track_metadata(root, sources, normalize, ext)
-        for name, pending in tqdm.tqdm(pendings, ncols=120):
-            meta[name] = pending.result()
-    return meta
+    previous = previous or {}
+    stale = {}
+    for root, folders, files in os.walk(path, followlinks=True):
+        root = Path(root)
+        if root.name.startswith('.') or folders or root == path:
+            continue
+        name = str(root.relative_to(path))
+        stamp = _track_stamp(root, sources, ext)
+        old = previous.get(name)
+        if old is not None and old.get("stamp") == stamp:
+            meta[name] = old
+        else:
+            stale[name] = root, stamp
+    if stale:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        import multiprocessing as mp
+        workers = min(workers or os.cpu_count(), len(stale))
+        with ProcessPoolExecutor(workers, mp_context=mp.get_context('spawn')) as pool:
+            pendings = {pool.submit(_track_metadata, root, sources, normalize, ext): name
+                        for name, (root, _) in stale.items()}
+            # tqdm reports the rate and the remaining time.
+            for pending in tqdm.tqdm(as_completed(pendings), total=len(pendings), ncols=120,
+                                     desc=f"Metadata for {path} ({len(meta)} tracks unchanged)"):
+                name = pendings[pending]
+                meta[name] = pending.result()
+                meta[name]["stamp"] = stale[name][1]
+    # Keep the order of the tracks stable, as it defines the example indexes.
+    return {name: meta[name] for name in sorted(meta)}
+
+
+def _refresh_metadata(metadata_file, paths, sources):
+    """Build or update the metadata of each of `paths`, stored as a list in `metadata_file`.
+    Only the tracks that were added or modified since the last call are processed."""
+    previous = [None] * len(paths)
+    if metadata_file.is_file():
+        content = json.load(open(metadata_file))
+        # Older files contain a single dict when there is a single path.
+        if isinstance(content, list) and len(content) == len(paths):
+            previous = content
+    metadata = [build_metadata(path, sources, previous=old)
+                for path, old in zip(paths, previous)]
+    if metadata != previous:
+        metadata_file.parent.mkdir(exist_ok=True, parents=True)
+        tmp = metadata_file.parent / (metadata_file.name + ".tmp")
+        json.dump(metadata, open(tmp, "w"))
+        os.replace(tmp, metadata_file)
 
 
 class Mp3set:
@@ -131,40 +211,175 @@ class Mp3set:
             else:
                 examples = int(math.ceil((track_duration - self.segment) / self.shift) + 1)
             self.num_examples.append(examples)
+        self._names = list(self.metadata)
+        # Index of the first example of each track, and total number of examples.
+        self._offsets = np.cumsum([0] + self.num_examples)
 
     def __len__(self):
-        return sum(self.num_examples)
+        return int(self._offsets[-1])
+
+    def _locate(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        track = bisect.bisect_right(self._offsets, index) - 1
+        return self._names[track], index - int(self._offsets[track])
+
+    def locate(self, indices):
+        """Map a batch of example `indices` to `(tracks, examples)`, two arrays giving
+        for each one the position of its track in `metadata`, and the index
+        of the example within the track, e.g. for custom samplers."""
+        indices = np.asarray(indices)
+        if indices.size and not (0 <= indices.min() and indices.max() < len(self)):
+            raise IndexError("Example index out of range.")
+        tracks = np.searchsorted(self._offsets, indices, side='right') - 1
+        return tracks, indices - self._offsets[tracks]
 
     def get_file(self, name, source):
         return self.root / name / f"{source}{self.ext}"
 
     def __getitem__(self, index):
-        for name, examples in zip(self.metadata, self.num_examples):
-            if index >= examples:
-                index -= examples
-                continue
-            meta = self.metadata[name]
-            num_frames = -1
-            offset = 0
-            if self.segment is not None:
-                offset = int(meta['samplerate'] * self.shift * index)
-                num_frames = int(math.ceil(meta['samplerate'] * self.segment))
-            mp3s = []
-            for source in self.sources:
-                file = self.get_file(name, source)
+        name, index = self._locate(index)
+        meta = self.metadata[name]
+        num_frames = -1
+        offset = 0
+        if self.segment is not None:
+            offset = int(meta['samplerate'] * self.shift * index)
+            num_frames = int(math.ceil(meta['samplerate'] * self.segment))
+        mp3s = []
+        frame_index = meta.get('index', {})
+        for source in self.sources:
+            file = self.get_file(name, source)
+            if source in frame_index and num_frames > 0:
+                # Decode only the segment, starting from the nearest indexed frame.
+                num_frames = min(num_frames, meta['length'] - offset)
+                mp3, _ = load_segment(file, frame_index[source], offset, num_frames)
+            else:
                 mp3, _ = ta.load(str(file), frame_offset=offset, num_frames=num_frames)
-                mp3 = convert_audio_channels(mp3, self.channels)
-                mp3s.append(mp3)
+            mp3 = convert_audio_channels(mp3, self.channels)
+            mp3s.append(mp3)
+
+        example = th.stack(mp3s)
+        example = julius.resample_frac(example, meta['samplerate'], self.samplerate)
+        if self.normalize:
+            example = (example - meta['mean']) / meta['std']
+        if self.segment:
+            length = int(self.segment * self.samplerate)
+            example = example[..., :length]
+            example = F.pad(example, (0, length - example.shape[-1]))
+        return example
 
-            example = th.stack(mp3s)
-            example = julius.resample_frac(example, meta['samplerate'], self.samplerate)
-            if self.normalize:
-                example = (example - meta['mean']) / meta['std']
-            if self.segment:
-                length = int(self.segment * self.samplerate)
-                example = example[..., :length]
-                example = F.pad(example, (0, length - example.shape[-1]))
-            return example
+
+def _materialize_track(dataset, name, path, dtype):
+    meta = dataset.metadata[name]
+    mp3s = []
+    for source in dataset.sources:
+        mp3, _ = ta.load(str(dataset.get_file(name, source)))
+        mp3s.append(convert_audio_channels(mp3, dataset.channels))
+    example = julius.resample_frac(th.stack(mp3s), meta['samplerate'], dataset.samplerate)
+    if dtype == 'int16':
+        example = (example.clamp(-1, 1) * (2**15 - 1)).round().short()
+    else:
+        example = example.half()
+    tmp = path.parent / (path.name + ".tmp")
+    shard = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=tuple(example.shape))
+    shard[:] = example.numpy()
+    shard.flush()
+    del shard
+    os.replace(tmp, path)
+    return {"length": example.shape[-1], "mean": meta['mean'], "std": meta['std'],
+            "samplerate": dataset.samplerate, "stamp": meta.get("stamp")}
+
+
+def materialize(dataset, path, dtype='float16', workers=8):
+    """
+    Decode once all the tracks of the `Mp3set` `dataset` at its target sample rate
+    and number of channels, into one `.npy` file per track of shape `(sources, channels, time)`
+    and type `dtype` (`float16` or `int16`), in the folder `path`. The metadata, including
+    the normalization statistics, is stored in `shards.json`. Use `ShardSet` to load it.
+    If `path` already contains shards, only the tracks added or modified since are decoded.
+    """
+    path = Path(path)
+    assert dtype in ['float16', 'int16'], dtype
+    previous = {}
+    if (path / SHARDS_INDEX).is_file():
+        previous = json.load(open(path / SHARDS_INDEX))["metadata"]
+    meta = {}
+    pendings = []
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(workers) as pool:
+        for name in dataset.metadata:
+            stamp = dataset.metadata[name].get("stamp")
+            if stamp is not None and previous.get(name, {}).get("stamp") == stamp:
+                meta[name] = previous[name]
+                continue
+            shard = path / (name + ".npy")
+            shard.parent.mkdir(parents=True, exist_ok=True)
+            pendings.append((name, pool.submit(_materialize_track, dataset, name, shard, dtype)))
+        for name, pending in tqdm.tqdm(pendings, ncols=120):
+            meta[name] = pending.result()
+    meta = {name: meta[name] for name in dataset.metadata}
+    index = {"sources": dataset.sources, "channels": dataset.channels,
+             "samplerate": dataset.samplerate, "dtype": dtype, "metadata": meta}
+    tmp = path / (SHARDS_INDEX + ".tmp")
+    json.dump(index, open(tmp, "w"))
+    os.replace(tmp, path / SHARDS_INDEX)
+
+
+class ShardSet(Mp3set):
+    """
+    Same as `Mp3set`, but reading from the memory mapped shards created by `materialize`.
+    Examples are slices of the shards, so that each one only costs a few reads
+    from the page cache and a conversion to float, without any decoding or resampling.
+
+    Args:
+        root (Path or str): folder given to `materialize`.
+        segment, shift, normalize: see `Mp3set`.
+    """
+    def __init__(self, root, segment=None, shift=None, normalize=True):
+        root = Path(root)
+        index = json.load(open(root / SHARDS_INDEX))
+        super().__init__(root, index["metadata"], index["sources"],
+                         segment=segment, shift=shift, normalize=normalize,
+                         samplerate=index["samplerate"], channels=index["channels"])
+        self.dtype = index["dtype"]
+        # Memory maps are opened lazily, so that they are not shared with the workers.
+        self._shards = {}
+
+    def _shard(self, name):
+        if name not in self._shards:
+            # Copy on write, so that torch gets a writable array, the file is never modified.
+            self._shards[name] = np.load(self.root / (name + ".npy"), mmap_mode='c')
+        return self._shards[name]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_shards'] = {}
+        return state
+
+    def __getitem__(self, index):
+        name, index = self._locate(index)
+        meta = self.metadata[name]
+        shard = self._shard(name)
+        offset = 0
+        end = shard.shape[-1]
+        if self.segment is not None:
+            offset = int(self.samplerate * self.shift * index)
+            end = offset + int(self.segment * self.samplerate)
+        # Slicing the memory map is free, the only copy is the conversion to float.
+        example = th.from_numpy(shard[..., offset:end]).float()
+        if self.dtype == 'int16':
+            example /= 2**15 - 1
+        if self.normalize:
+            example = (example - meta['mean']) / meta['std']
+        if self.segment:
+            length = int(self.segment * self.samplerate)
+            example = F.pad(example, (0, length - example.shape[-1]))
+        return example
+
+
+def _shard_path(args, split, sig):
+    return Path(args.dset.shards) / (
+        f"{split}_{sig}_{args.dset.samplerate}_{args.dset.channels}_{args.dset.shards_dtype}")
 
 
 def get_remixes_dataset(args):
@@ -178,11 +393,8 @@ def get_remixes_dataset(args):
     train_path = Path(args.dset.remixdset) / "train"
     valid_path = Path(args.dset.remixdset) / "valid"
 
-    if not metadata_file.is_file() and distrib.rank == 0:
-         metadata_file.parent.mkdir(exist_ok=True, parents=True)
-         train = build_metadata(train_path, args.dset.sources)
-         valid = build_metadata(valid_path, args.dset.sources)
-         json.dump([train, valid], open(metadata_file, "w"))
+    if distrib.rank == 0:
+        _refresh_metadata(metadata_file, [train_path, valid_path], args.dset.sources)
     if distrib.world_size > 1:
         distributed.barrier()
     train, valid = json.load(open(metadata_file))
@@ -195,6 +407,18 @@ def get_remixes_dataset(args):
     valid_set = Mp3set(valid_path, valid, [MIXTURE] + list(args.dset.sources),
                        samplerate=args.dset.samplerate, channels=args.dset.channels,
                        normalize=args.dset.normalize, **kw_cv)
+    if args.dset.shards:
+        # Decode once into memory mapped shards, and train from those.
+        sets = []
+        for split, dset in [("train", train_set), ("valid", valid_set)]:
+            path = _shard_path(args, split, sig)
+            if distrib.rank == 0:
+                materialize(dset, path, args.dset.shards_dtype)
+            if distrib.world_size > 1:
+                distributed.barrier()
+            sets.append(ShardSet(path, segment=dset.segment, shift=dset.shift,
+                                 normalize=dset.normalize))
+        train_set, valid_set = sets
     return train_set, valid_set
 
 
@@ -207,13 +431,11 @@ def get_test_dataset(args):
     metadata_file = Path(args.dset.metadata) / ('testset_' + sig + ".json")
     test_path = Path(args.dset.remixdset) / "test"
 
-    if not metadata_file.is_file() and distrib.rank == 0:
-         metadata_file.parent.mkdir(exist_ok=True, parents=True)
-         metadata = build_metadata(test_path, args.dset.sources)
-         json.dump(metadata, open(metadata_file, "w"))
+    if distrib.rank == 0:
+        _refresh_metadata(metadata_file, [test_path], args.dset.sources)
     if distrib.world_size > 1:
         distributed.barrier()
-    metadata = json.load(open(metadata_file))
+    metadata, = json.load(open(metadata_file))
 
     test_set = Mp3set(test_path, metadata, args.dset.sources,
                        segment=args.dset.segment, shift=args.dset.shift,
@@ -227,13 +449,11 @@ def get_medleydb_dataset(args):
     sig = hashlib.sha1(str(args.dset.medleydb).encode()).hexdigest()[:8]
     metadata_file = Path(args.metadata) / ('medleydb_' + sig + ".json")
     root = Path(args.dset.medleydb)
-    if not metadata_file.is_file() and distrib.rank == 0:
-        metadata_file.parent.mkdir(exist_ok=True, parents=True)
-        metadata = build_metadata(root, args.dset.sources)
-        json.dump(metadata, open(metadata_file, "w"))
+    if distrib.rank == 0:
+        _refresh_metadata(metadata_file, [root], args.dset.sources)
     if distrib.world_size > 1:
         distributed.barrier()
-    metadata = json.load(open(metadata_file))
+    metadata, = json.load(open(metadata_file))
 
     train_set = Mp3set(root, metadata, args.sources,
                        segment=args.segment, shift=args.shift,
@@ -0,0 +1,155 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Frame index of MP3 files, for random access to segments.
+
+Decoders usually have to go through an mp3 file from its start to reach a given offset.
+The index stores the byte offset of every `stride` frames, along with the number of priming
+samples skipped by the decoder, so that a segment is decoded from a few frames before it,
+at a cost that does not depend on its position in the file.
+Only MPEG audio layer III is supported, as used by the datasets.
+"""
+
+import io
+import math
+
+import torchaudio as ta
+
+# Bitrates in kbps for MPEG-1 and MPEG-2/2.5 layer III, by bitrate index.
+_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# Sample rates by version bits (0 is MPEG-2.5, 2 is MPEG-2, 3 is MPEG-1) and index.
+_SAMPLERATES = {
+    0: [11025, 12000, 8000],
+    2: [22050, 24000, 16000],
+    3: [44100, 48000, 32000],
+}
+# Frames decoded and discarded before a segment, as a frame can use data from the previous
+# ones (bit reservoir), and the first decoded frame only holds half of the overlap-add.
+PREROLL = 8
+# Delay of the MPEG decoder, added to the encoder delay from the LAME tag.
+_DECODER_DELAY = 529
+
+
+def _parse_header(data, pos):
+    """Parse the frame header at `pos`, returning `(size, samplerate, samples, channels)`
+    or None if this is not a valid layer III header."""
+    if pos + 4 > len(data):
+        return None
+    header = int.from_bytes(data[pos:pos + 4], 'big')
+    version = (header >> 19) & 3
+    layer = (header >> 17) & 3
+    bitrate_index = (header >> 12) & 15
+    samplerate_index = (header >> 10) & 3
+    if header >> 21 != 0x7ff or version == 1 or layer != 1:
+        return None
+    if bitrate_index in [0, 15] or samplerate_index == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = _BITRATES[1 if mpeg1 else 2][bitrate_index] * 1000
+    samplerate = _SAMPLERATES[version][samplerate_index]
+    samples = 1152 if mpeg1 else 576
+    padding = (header >> 9) & 1
+    size = samples // 8 * bitrate // samplerate + padding
+    channels = 1 if (header >> 6) & 3 == 3 else 2
+    return size, samplerate, samples, channels
+
+
+def _info_tag_delay(data, pos, samples, channels):
+    """If the frame at `pos` is a Xing/Info tag, return the number of samples skipped
+    by the decoder at the start of the file, otherwise None."""
+    if samples == 1152:
+        side_info = 32 if channels == 2 else 17
+    else:
+        side_info = 17 if channels == 2 else 9
+    tag = pos + 4 + side_info
+    if data[tag:tag + 4] not in [b'Xing', b'Info']:
+        return None
+    flags = int.from_bytes(data[tag + 4:tag + 8], 'big')
+    lame = tag + 8
+    lame += 4 * bool(flags & 1) + 4 * bool(flags & 2) + 100 * bool(flags & 4)
+    lame += 4 * bool(flags & 8)
+    if data[lame:lame + 4] not in [b'LAME', b'Lavf', b'Lavc']:
+        return 0
+    delays = int.from_bytes(data[lame + 21:lame + 24], 'big')
+    return (delays >> 12) + _DECODER_DELAY
+
+
+def build_index(path, stride=64):
+    """
+    Build the frame index of the mp3 file at `path`, a json serializable dict with
+    the byte offset of every `stride` frames. See `load_segment`.
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    pos = 0
+    if data[:3] == b'ID3':
+        size = 0
+        for byte in data[6:10]:
+            size = (size << 7) | (byte & 0x7f)
+        pos = 10 + size + 10 * bool(data[5] & 0x10)
+
+    offsets = []
+    frames = 0
+    skip = 0
+    fmt = None
+    end = pos  # End of the last frame.
+    while pos < len(data):
+        parsed = _parse_header(data, pos)
+        if parsed is not None and pos != end:
+            # When resynchronizing after junk, also check the next header to avoid false syncs.
+            after = pos + parsed[0]
+            if after < len(data) and _parse_header(data, after) is None:
+                parsed = None
+        if parsed is None:
+            pos += 1
+            continue
+        size, samplerate, samples, channels = parsed
+        if fmt is None:
+            fmt = samplerate, samples, channels
+            delay = _info_tag_delay(data, pos, samples, channels)
+            if delay is not None:
+                # The tag frame holds no audio.
+                skip = delay
+                pos = end = pos + size
+                continue
+        if frames % stride == 0:
+            offsets.append(pos)
+        frames += 1
+        pos = end = pos + size
+    if fmt is None:
+        raise ValueError(f"No mp3 frame found in {path}.")
+    samplerate, samples, channels = fmt
+    return {"samplerate": samplerate, "channels": channels, "samples_per_frame": samples,
+            "skip": skip, "stride": stride, "frames": frames, "offsets": offsets, "end": end}
+
+
+def load_segment(path, index, offset, num_frames):
+    """
+    Load `num_frames` samples from the mp3 file at `path`, starting at `offset`,
+    using its `index` from `build_index`, as `torchaudio.load` would (positions
+    account for the priming samples skipped by ffmpeg). Returns a tensor
+    of shape `(channels, time)`, and the sample rate.
+    """
+    samples = index["samples_per_frame"]
+    stride = index["stride"]
+    start = offset + index["skip"]
+    first = max(0, start // samples - PREROLL) // stride
+    needed = math.ceil((start + num_frames) / samples)  # Frames up to the end of the segment.
+    last = min(len(index["offsets"]), math.ceil(needed / stride))
+    begin = index["offsets"][first]
+    end = index["offsets"][last] if last < len(index["offsets"]) else index["end"]
+    frames = min(last * stride, index["frames"]) - first * stride
+    with open(path, 'rb') as file:
+        file.seek(begin)
+        data = file.read(end - begin)
+    wav, samplerate = ta.load(io.BytesIO(data), format="mp3")
+    # Align on the end of the decoded audio, as the first frames might be dropped
+    # when their bit reservoir is missing.
+    decoded_start = (first * stride + frames) * samples - wav.shape[-1]
+    wav = wav[..., max(0, start - decoded_start):]
+    return wav[..., :num_frames], samplerate
@@ -0,0 +1,105 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Process based executor to use with `demucs.apply.apply_model`, as an alternative to the
+`ThreadPoolExecutor` created with `num_workers > 0`. Python side overhead is no longer
+limited by the GIL, and each worker has a fixed budget of intra-op threads so that
+the cores are not oversubscribed.
+
+The weights of the model are moved to shared memory once and given to the workers
+when they start. Tensors (the mixture, and the output of each chunk) are exchanged through
+shared memory as well, thanks to the reductions registered by `torch.multiprocessing`,
+so that only small handles are pickled.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+import os
+
+import torch
+import torch.multiprocessing  # noqa, registers the shared memory reductions for tensors.
+
+from .apply import BagOfModels, TensorChunk
+
+_models = None
+
+
+def _init_worker(models, threads):
+    global _models
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set once, before any inter-op parallel work.
+        pass
+    _models = models
+
+
+def _call(func, index, args, kwargs):
+    return func(_models[index], *args, **kwargs)
+
+
+def _share_chunks(value):
+    if isinstance(value, TensorChunk):
+        value.tensor.share_memory_()
+    elif isinstance(value, torch.Tensor):
+        value.share_memory_()
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _share_chunks(item)
+
+
+class ProcessPoolChunkExecutor:
+    """
+    Evaluate chunks in worker processes. Can be given as the `pool` argument
+    of `apply_model`, along with the same `model` (or bag of models) that was used
+    to create the executor.
+
+    Args:
+        model (Model or BagOfModels): model that will be applied.
+        workers (int): number of worker processes.
+        threads (int or None): number of intra-op threads for each worker, by default
+            the available cores are evenly split between the workers.
+        mp_context (str): multiprocessing start method. `spawn` is the default, as forking
+            a process that already used OpenMP can deadlock.
+    """
+    def __init__(self, model, workers, threads=None, mp_context='spawn'):
+        if isinstance(model, BagOfModels):
+            models = list(model.models)
+        else:
+            models = [model]
+        if threads is None:
+            threads = max(1, (os.cpu_count() or 1) // workers)
+        for sub_model in models:
+            sub_model.cpu()
+            sub_model.eval()
+            sub_model.share_memory()
+        self._index = {id(sub_model): index for index, sub_model in enumerate(models)}
+        self._pool = ProcessPoolExecutor(
+            workers, mp_context=mp.get_context(mp_context),
+            initializer=_init_worker, initargs=(models, threads))
+
+    def submit(self, func, model, *args, **kwargs):
+        try:
+            index = self._index[id(model)]
+        except KeyError:
+            raise ValueError("The executor can only apply the model it was created with.")
+        # Moving the mixture to shared memory is only done once, as `share_memory_`
+        # is a no-op on tensors that are already shared. The shared memory is released
+        # with the mixture, the executor does not keep any reference to it.
+        _share_chunks(args)
+        return self._pool.submit(_call, func, index, args, kwargs)
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self._pool.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        # On error, the chunks that are not started yet are dropped, so that their
+        # shared tensors are released without waiting for them.
+        self.shutdown(cancel_futures=exc_type is not None)
@@ -24,20 +24,29 @@ def add_model_flags(parser):
                         help="Folder containing all pre-trained models for use with -n.")
 
 
+def _get_repo(repo: Path) -> AnyModelRepo:
+    model_repo: ModelOnlyRepo
+
+    if not repo.is_dir():
+        fatal(f"{repo} must exist and be a directory.")
+    model_repo = LocalRepo(repo)
+    bag_repo = BagOnlyRepo(repo, model_repo)
+    return AnyModelRepo(model_repo, bag_repo)
+
+
 def get_model(name: str,
               repo: tp.Optional[Path] = None):
     """`name` must be a bag of models name or a pretrained signature
     from the remote AWS model repo or the specified local repo if `repo` is not None.
     """
+    return _get_repo(repo).get_model(name)
 
-    model_repo: ModelOnlyRepo
 
-    if not repo.is_dir():
-        fatal(f"{repo} must exist and be a directory.")
-    model_repo = LocalRepo(repo)
-    bag_repo = BagOnlyRepo(repo, model_repo)
-    any_repo = AnyModelRepo(model_repo, bag_repo)
-    return any_repo.get_model(name)
+def get_model_signature(name: str,
+                        repo: tp.Optional[Path] = None) -> str:
+    """Return a string identifying the exact content of the model `name`,
+    e.g. to use as a cache key."""
+    return _get_repo(repo).get_signature(name)
 
 
 def get_model_from_args(args):
@@ -0,0 +1,105 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Post training int8 quantization, for faster inference on CPU.
+
+This is unrelated to the quantization used during training (DiffQ / QAT, see `states.py`),
+which is only used to reduce the size of the models on disk.
+
+With dynamic quantization, the LSTMs, linear layers and 1x1 convolutions (e.g. in
+`LocalState` and in the `DConv` branches) are quantized, activations being quantized
+on the fly. With static quantization, all the convolutions and transposed convolutions
+are quantized as well, using activation ranges estimated on a few calibration mixtures.
+Normalizations and activations always stay in float, as does the resampling.
+"""
+
+import copy
+import typing as tp
+
+import torch
+from torch import nn
+from torch.ao import quantization as tq
+
+from .apply import BagOfModels, apply_model
+
+
+class PointwiseLinear(nn.Module):
+    """A 1x1 `nn.Conv1d` expressed as a `nn.Linear` over the channels,
+    so that it can be dynamically quantized."""
+    def __init__(self, conv: nn.Conv1d):
+        super().__init__()
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        self.linear.weight.data[:] = conv.weight.data[:, :, 0]
+        if conv.bias is not None:
+            self.linear.bias.data[:] = conv.bias.data
+
+    def forward(self, x):
+        return self.linear(x.transpose(1, 2)).transpose(1, 2)
+
+
+def _is_pointwise(module):
+    return (isinstance(module, nn.Conv1d) and module.kernel_size == (1,) and
+            module.stride == (1,) and module.padding == (0,) and module.groups == 1)
+
+
+def _swap_modules(model, predicate, factory):
+    for parent in list(model.modules()):
+        for name, child in parent.named_children():
+            if predicate(child):
+                setattr(parent, name, factory(child))
+
+
+def _set_engine():
+    engines = torch.backends.quantized.supported_engines
+    if 'fbgemm' in engines:
+        torch.backends.quantized.engine = 'fbgemm'
+    elif 'qnnpack' in engines:
+        torch.backends.quantized.engine = 'qnnpack'
+
+
+def quantize_model(model, dtype: str = 'int8',
+                   calibration: tp.Optional[tp.Iterable[torch.Tensor]] = None):
+    """
+    Return an int8 quantized copy of `model` (or of each model in a bag) for CPU inference.
+
+    Args:
+        model (Model or BagOfModels): model to quantize, it is not modified.
+        dtype (str): only `int8` is supported.
+        calibration (None or iterable of torch.Tensor): if provided, mixtures of shape
+            `(channels, time)` used to calibrate a static quantization of all the
+            convolutions. Otherwise, only dynamic quantization is used.
+    """
+    if dtype != 'int8':
+        raise ValueError(f"Unsupported quantization {dtype}, only int8 is available.")
+    if calibration is not None:
+        calibration = list(calibration)
+    if isinstance(model, BagOfModels):
+        models = [quantize_model(sub_model, dtype, calibration) for sub_model in model.models]
+        return BagOfModels(models, model.weights)
+
+    _set_engine()
+    model = copy.deepcopy(model).cpu().eval()
+    if calibration:
+        qconfig = tq.get_default_qconfig(torch.backends.quantized.engine)
+
+        def wrap(module):
+            wrapper = tq.QuantWrapper(module)
+            # Per channel weight quantization is not available for transposed convolutions.
+            if isinstance(module, nn.ConvTranspose1d):
+                wrapper.qconfig = tq.default_qconfig
+            else:
+                wrapper.qconfig = qconfig
+            return wrapper
+
+        _swap_modules(model, lambda m: isinstance(m, (nn.Conv1d, nn.ConvTranspose1d)), wrap)
+        tq.prepare(model, inplace=True)
+        with torch.no_grad():
+            for mix in calibration:
+                apply_model(model, mix[None], shifts=0, split=True)
+        tq.convert(model, inplace=True)
+    else:
+        _swap_modules(model, _is_pointwise, PointwiseLinear)
+    tq.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
@@ -23,7 +23,7 @@ class ModelLoadingError(RuntimeError):
     pass
 
 
-def check_checksum(path: Path, checksum: str):
+def file_checksum(path: Path) -> str:
     sha = sha256()
     with open(path, 'rb') as file:
         while True:
@@ -31,7 +31,11 @@ def check_checksum(path: Path, checksum: str):
             if not buf:
                 break
             sha.update(buf)
-    actual_checksum = sha.hexdigest()[:len(checksum)]
+    return sha.hexdigest()
+
+
+def check_checksum(path: Path, checksum: str):
+    actual_checksum = file_checksum(path)[:len(checksum)]
     if actual_checksum != checksum:
         raise ModelLoadingError(f'Invalid checksum for file {path}, '
                                 f'expected {checksum} but got {actual_checksum}')
@@ -46,6 +50,10 @@ class ModelOnlyRepo:
     def get_model(self, sig: str) -> Model:
         raise NotImplementedError()
 
+    def get_signature(self, sig: str) -> str:
+        """Return a string identifying the exact content of the model."""
+        raise NotImplementedError()
+
 
 class LocalRepo(ModelOnlyRepo):
     def __init__(self, root: Path):
@@ -80,6 +88,16 @@ class LocalRepo(ModelOnlyRepo):
             check_checksum(file, self._checksums[sig])
         return load_model(file)
 
+    def get_signature(self, sig: str) -> str:
+        try:
+            file = self._models[sig]
+        except KeyError:
+            raise ModelLoadingError(f'Could not find pre-trained model with signature {sig}.')
+        checksum = self._checksums.get(sig)
+        if checksum is None:
+            checksum = file_checksum(file)[:8]
+        return f'{sig}-{checksum}'
+
 class BagOnlyRepo:
     """Handles only YAML files containing bag of models, leaving the actual
     model loading to some Repo.
@@ -112,6 +130,17 @@ class BagOnlyRepo:
         segment = bag.get('segment')
         return BagOfModels(models, weights, segment)
 
+    def get_signature(self, name: str) -> str:
+        try:
+            yaml_file = self._bags[name]
+        except KeyError:
+            raise ModelLoadingError(f'{name} is neither a single pre-trained model or '
+                                    'a bag of models.')
+        bag = yaml.safe_load(open(yaml_file))
+        signatures = [self.model_repo.get_signature(sig) for sig in bag['models']]
+        content = repr((signatures, bag.get('weights'), bag.get('segment')))
+        return f'{name}-{sha256(content.encode()).hexdigest()[:8]}'
+
 
 class AnyModelRepo:
     def __init__(self, model_repo: ModelOnlyRepo, bag_repo: BagOnlyRepo):
@@ -125,4 +154,10 @@ class AnyModelRepo:
         if self.model_repo.has_model(name_or_sig):
             return self.model_repo.get_model(name_or_sig)
         else:
-            return self.bag_repo.get_model(name_or_sig)
\ No newline at end of file
+            return self.bag_repo.get_model(name_or_sig)
+
+    def get_signature(self, name_or_sig: str) -> str:
+        if self.model_repo.has_model(name_or_sig):
+            return self.model_repo.get_signature(name_or_sig)
+        else:
+            return self.bag_repo.get_signature(name_or_sig)
@@ -80,4 +80,25 @@ def svd_penalty(model, min_size=0.1, dim=1, niters=2, powm=False, convtr=True,
             else:
                 estimate = torch.svd_lowrank(p, dim, niters)[1][0].pow(2)
             total += estimate
-    return total / proba
\ No newline at end of file
+    return total / proba
+
+
+def low_rank(m, rank=None, energy=None):
+    """
+    Truncated SVD of the 2D tensor `m`, returning `left` and `right` such that
+    `left @ right` is the best approximation of `m` with the chosen rank.
+    Args:
+        - rank: rank kept.
+        - energy: otherwise, keep the smallest rank preserving this fraction
+            of the energy (sum of the squared singular values) of `m`.
+    The exact SVD is used, as the energy criterion needs all the singular values.
+    """
+    assert m.dim() == 2
+    assert (rank is None) != (energy is None), "Exactly one of rank and energy must be given."
+    u, s, v = torch.svd(m)
+    if rank is None:
+        cumulative = s.square().cumsum(0) / s.square().sum()
+        rank = int((cumulative < energy).sum().item()) + 1
+    rank = min(rank, len(s))
+    scale = s[:rank].sqrt()
+    return u[:, :rank] * scale, scale[:, None] * v[:, :rank].t()
@@ -13,9 +13,12 @@ import json
 import torch as th
 import torchaudio as ta
 from dora.log import fatal
-from demucs.audio import AudioFile, convert_audio, save_audio
-from demucs.pretrained import get_model_from_args, add_model_flags, ModelLoadingError
-from demucs.apply import apply_model
+from demucs.audio import AudioFile, MP3Writer, StemWriter, convert_audio
+from demucs.pretrained import get_model_from_args, get_model_signature, add_model_flags, ModelLoadingError
+from demucs.cache import SeparationCache, set_metadata_cache
+from demucs.autotune import load_profile
+from demucs.quantize import quantize_model
+from demucs.apply import apply_model, apply_model_stream, set_segment
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
@@ -51,6 +54,49 @@ def load_track(track, audio_channels, samplerate):
     return wav
 
 
+def silence_rms(threshold_db):
+    """Convert a silence threshold in dB relative to the RMS of the track into a RMS
+    for `apply_model`, which is given tracks normalized to unit variance."""
+    if threshold_db is None:
+        return None
+    return 10 ** (threshold_db / 20)
+
+
+def separate_stream(model, track, out, args, block_duration=30.):
+    """
+    Separates the track block by block, writing the stems as they are produced,
+    so that memory usage does not depend on the length of the track.
+    """
+    audio = AudioFile(track)
+
+    def blocks():
+        return audio.stream(block_duration, samplerate=model.samplerate,
+                            channels=model.audio_channels)
+
+    # Normalization of the entire track, from a first pass or the metadata cache.
+    mean, std = audio.normalization(samplerate=model.samplerate, channels=model.audio_channels)
+
+    writers = []
+    for name in model.sources:
+        stem = out / args.filename.format(track=track.name.rsplit(".", 1)[0],
+                                          trackext=track.name.rsplit(".", 1)[-1],
+                                          stem=name, ext="mp3")
+        stem.parent.mkdir(parents=True, exist_ok=True)
+        writers.append(MP3Writer(stem, model.samplerate, model.audio_channels, args.mp3_bitrate,
+                                 preset=args.mp3_preset))
+    mixes = (((block - mean) / std)[None] for block in blocks())
+    try:
+        for sources in apply_model_stream(model, mixes, device=args.device, shifts=args.shifts,
+                                          overlap=args.overlap, seed=args.seed,
+                                          silence_threshold=silence_rms(args.silence_threshold)):
+            sources = sources[0] * std + mean
+            for writer, source in zip(writers, sources):
+                writer.write(source)
+    finally:
+        for writer in writers:
+            writer.close()
+
+
 def separate_track(track_location, save_folder):
     parser = argparse.ArgumentParser("demucs.separate",
                                      description="Separate the sources for the given tracks")
@@ -86,6 +132,9 @@ def separate_track(track_location, save_folder):
                         help="Number of random shifts for equivariant stabilization."
                              "Increase separation time but improves quality for Demucs. 10 was used "
                              "in the original paper.")
+    parser.add_argument("--seed",
+                        type=int,
+                        help="Seed for the random shifts, making the separation reproducible.")
     parser.add_argument("--overlap",
                         default=0.25,
                         type=float,
@@ -97,7 +146,7 @@ def separate_track(track_location, save_folder):
                              default=True,
                              help="Doesn't split audio in chunks. "
                                   "This can use large amounts of memory.")
-    split_group.add_argument("--segment", type=int,
+    split_group.add_argument("--segment", type=float,
                              help="Set split size of each chunk. "
                                   "This can help save memory of graphic card. ")
     parser.add_argument("--two-stems",
@@ -108,6 +157,14 @@ def separate_track(track_location, save_folder):
                         type=int,
                         help="Number of jobs. This can increase memory usage but will "
                              "be much faster when multiple cores are available.")
+    parser.add_argument("--threads",
+                        type=int,
+                        help="Number of threads used by torch for intra-op parallelism.")
+    parser.add_argument("-b", "--batch-size",
+                        default=1,
+                        type=int,
+                        help="Number of chunks evaluated together in a single forward "
+                             "when splitting.")
     parser.add_argument("--clip-mode", default="rescale", choices=["rescale", "clamp"],
                         help="Strategy for avoiding clipping: rescaling entire signal "
                              "if necessary  (rescale) or hard clipping (clamp).")
@@ -124,6 +181,13 @@ def separate_track(track_location, save_folder):
     args.__dict__["repo"] = Path(user_settings_dict["repo"])
     args.__dict__["name"] = user_settings_dict["name"]
     args.__dict__["device"] = user_settings_dict["device"]
+    # Chunks below this level (in dB relative to the track) are not evaluated.
+    args.__dict__["silence_threshold"] = user_settings_dict.get("silence_threshold")
+    # Speed of the mp3 encoder, one of "best", "standard" or "fast".
+    args.__dict__["mp3_preset"] = user_settings_dict.get("mp3_preset", "best")
+    # Location of the audio metadata cache (SQLite file), the default one is used if not set.
+    if "metadata_cache" in user_settings_dict:
+        set_metadata_cache(user_settings_dict["metadata_cache"])
 
     try:
         model = get_model_from_args(args)
@@ -134,21 +198,72 @@ def separate_track(track_location, save_folder):
     model.cpu()
     model.eval()
 
+    # Use the settings found by demucs.autotune for this host and model, if any,
+    # unless the "autotune" setting is false.
+    if user_settings_dict.get("autotune", True) and args.repo is not None:
+        try:
+            profile = load_profile(get_model_signature(args.name, args.repo))
+        except ModelLoadingError:
+            profile = None
+        if profile is not None:
+            print(f"Using autotuned settings {profile}")
+            for key, value in profile.items():
+                setattr(args, key, value)
+    if args.segment is not None:
+        set_segment(model, args.segment)
+    if args.threads:
+        th.set_num_threads(args.threads)
+    # Dynamic int8 quantization for faster cpu inference, enabled with the "quantize" setting.
+    quantize = user_settings_dict.get("quantize")
+    if quantize and th.device(args.device).type == 'cpu':
+        model = quantize_model(model, quantize)
+    else:
+        quantize = None
+
     out = args.out
     out.mkdir(parents=True, exist_ok=True)
 
+    if user_settings_dict.get("stream", False):
+        try:
+            separate_stream(model, track, out, args)
+        except:
+            eprint("Error separating tracks.")
+            return -1
+        return 0
+
     wav = load_track(track, model.audio_channels, model.samplerate)
 
-    ref = wav.mean(0)
-    wav = (wav - ref.mean()) / ref.std()
-    try:
-        sources = apply_model(model, wav[None], device=args.device, shifts=args.shifts,
-                              split=args.split, overlap=args.overlap, progress=True,
-                              num_workers=args.jobs)[0]
-    except:
-        eprint("Error separating tracks.")
-        return -1
-    sources = sources * ref.std() + ref.mean()
+    # Cache of separation results, enabled with the "cache" setting (folder)
+    # and "cache_size" (in GB).
+    cache = None
+    sources = None
+    if user_settings_dict.get("cache"):
+        cache = SeparationCache(user_settings_dict["cache"],
+                                int(user_settings_dict.get("cache_size", 10) * 2**30))
+        if args.seed is None:
+            args.seed = 0
+        key = cache.key(wav, get_model_signature(args.name, args.repo), shifts=args.shifts,
+                        overlap=args.overlap, split=args.split, segment=args.segment,
+                        seed=args.seed, quantize=quantize and 'dynamic',
+                        silence_threshold=args.silence_threshold, backend='eager',
+                        batch_size=args.batch_size)
+        sources = cache.get(key)
+
+    if sources is None:
+        ref = wav.mean(0)
+        wav = (wav - ref.mean()) / ref.std()
+        try:
+            sources = apply_model(model, wav[None], device=args.device, shifts=args.shifts,
+                                  split=args.split, overlap=args.overlap, progress=True,
+                                  num_workers=args.jobs, batch_size=args.batch_size,
+                                  seed=args.seed,
+                                  silence_threshold=silence_rms(args.silence_threshold))[0]
+        except:
+            eprint("Error separating tracks.")
+            return -1
+        sources = sources * ref.std() + ref.mean()
+        if cache is not None:
+            cache.put(key, sources)
 
     ext = "mp3"
 
@@ -160,11 +275,13 @@ def separate_track(track_location, save_folder):
         'bits_per_sample': 24 if args.int24 else 16,
     }
 
-    for source, name in zip(sources, model.sources):
-        stem = out / args.filename.format(track=track.name.rsplit(".", 1)[0],
-                                          trackext=track.name.rsplit(".", 1)[-1],
-                                          stem=name, ext=ext)
-        stem.parent.mkdir(parents=True, exist_ok=True)
-        save_audio(source, str(stem), **kwargs)
+    # All the stems are encoded concurrently.
+    with StemWriter(preset=args.mp3_preset, **kwargs) as writer:
+        for source, name in zip(sources, model.sources):
+            stem = out / args.filename.format(track=track.name.rsplit(".", 1)[0],
+                                              trackext=track.name.rsplit(".", 1)[-1],
+                                              stem=name, ext=ext)
+            stem.parent.mkdir(parents=True, exist_ok=True)
+            writer.save(source, str(stem))
 
     return 0
\ No newline at end of file